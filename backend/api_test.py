@@ -132,6 +132,34 @@ def search_user(token, query):
     response = requests.get(url, headers=headers)
     return response
 
+def create_attachment_upload(token, size, recipient_username):
+    """Helper to create an attachment upload."""
+    url = f"{BASE_URL}/attachments/"
+    headers = {
+        "Authorization": f"Bearer {token}",
+        "Content-Type": "application/json"
+    }
+    data = {"size": size, "recipient_username": recipient_username}
+    response = requests.post(url, data=json.dumps(data), headers=headers)
+    return response
+
+def upload_attachment_chunk(token, attachment_id, offset, chunk):
+    """Helper to upload one attachment chunk."""
+    url = f"{BASE_URL}/attachments/{attachment_id}/upload?offset={offset}"
+    headers = {
+        "Authorization": f"Bearer {token}",
+        "Content-Type": "application/octet-stream"
+    }
+    response = requests.put(url, data=chunk, headers=headers)
+    return response
+
+def download_attachment(token, attachment_id, extra_headers=None):
+    """Helper to download an attachment, optionally with Range / conditional headers."""
+    url = f"{BASE_URL}/attachments/{attachment_id}"
+    headers = {"Authorization": f"Bearer {token}", **(extra_headers or {})}
+    response = requests.get(url, headers=headers)
+    return response
+
 # --- Main Test Execution ---
 
 if __name__ == "__main__":
@@ -275,4 +303,40 @@ if __name__ == "__main__":
     assert resp_get_again.status_code == 200
     print("✅ Second fetch successful (as per current backend logic).\n")
 
+    # --- Attachment Tests ---
+    print("\n--- Starting Attachment Tests ---")
+
+    print(f"--- 20. {user1_name} uploads an attachment for {user2_name} in two chunks ---")
+    attachment_data = os.urandom(300 * 1024)
+    resp_upload = create_attachment_upload(token1_new, len(attachment_data), user2_name)
+    assert resp_upload.status_code == 201, f"Failed to create upload. Response: {resp_upload.text}"
+    attachment_id = resp_upload.json()["id"]
+    resp_chunk = upload_attachment_chunk(token1_new, attachment_id, 0, attachment_data[:100 * 1024])
+    assert resp_chunk.status_code == 200 and resp_chunk.json()["offset"] == 100 * 1024
+    resp_chunk = upload_attachment_chunk(token1_new, attachment_id, 0, attachment_data[:100 * 1024])
+    assert resp_chunk.status_code == 409 and resp_chunk.json()["offset"] == 100 * 1024
+    resp_chunk = upload_attachment_chunk(token1_new, attachment_id, 100 * 1024, attachment_data[100 * 1024:])
+    assert resp_chunk.status_code == 200 and resp_chunk.json()["complete"] is True
+    print("✅ Upload resumed from the server offset and completed.\n")
+
+    print(f"--- 21. {user2_name} downloads the attachment, with Range and ETag ---")
+    resp_download = download_attachment(token2, attachment_id)
+    assert resp_download.status_code == 200 and resp_download.content == attachment_data
+    etag = resp_download.headers["ETag"]
+    resp_range = download_attachment(token2, attachment_id, {"Range": "bytes=1000-1999"})
+    assert resp_range.status_code == 206 and resp_range.content == attachment_data[1000:2000]
+    resp_invalid = download_attachment(token2, attachment_id, {"Range": "bytes=2000-1000"})
+    assert resp_invalid.status_code == 200 and resp_invalid.content == attachment_data
+    resp_cached = download_attachment(token2, attachment_id, {"If-None-Match": etag})
+    assert resp_cached.status_code == 304
+    print("✅ Full, ranged, invalid-range and conditional downloads behave as documented.\n")
+
+    print(f"--- 22. A user outside the conversation tries to download the attachment ---")
+    user3_name = f"user3_{timestamp}"
+    assert register_user(user3_name, f"{user3_name}@example.com", password).status_code == 200
+    token3 = login_user(user3_name, password)
+    resp_forbidden = download_attachment(token3, attachment_id)
+    assert resp_forbidden.status_code == 404
+    print("✅ Only the uploader and the recipient can download the attachment.\n")
+
     print("\n🎉 All tests completed! 🎉") 
\ No newline at end of file
@@ -1,9 +1,9 @@
-# 导入 passlib 用于密码哈希
-from passlib.context import CryptContext
 # 导入 jose 用于 JWT (JSON Web Tokens) 操作
 from jose import JWTError, jwt
 # 导入 datetime 用于处理时间，计算令牌过期时间
 from datetime import datetime, timedelta
+import secrets
+import time
 # 导入 FastAPI 的依赖项和异常处理
 from fastapi import Depends, HTTPException, status, WebSocket, Query
 # 导入 FastAPI 的 OAuth2 密码模式
@@ -12,13 +12,15 @@ from fastapi.security import OAuth2PasswordBearer
 from . import schemas
 from . import crud, models
 from .database import get_db
+from .db_executor import db_executor
+from .user_directory import UserEntry
+from .password_hasher import pwd_context
 from sqlalchemy.orm import Session
 from typing import Optional
 
 # --- 密码哈希部分 ---
-
-# 创建一个 CryptContext 实例，指定使用 bcrypt 算法
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# 请求处理路径上请使用 password_hasher 中的异步接口，它在专用进程池中执行 bcrypt；
+# 下面的同步函数只适用于脚本和测试等不在事件循环上的场景。
 
 # 验证密码函数
 def verify_password(plain_password, hashed_password):
@@ -48,6 +50,11 @@ SECRET_KEY = "a_very_secret_key_for_our_chat_app"
 ALGORITHM = "HS256"
 # 访问令牌的过期时间（分钟）
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
+# 刷新令牌的过期时间（天）。客户端用它换取新的访问令牌，而不必每 30 分钟重新用密码登录
+REFRESH_TOKEN_EXPIRE_DAYS = 30
+# 令牌类型，写入 payload 的 "type" 字段，防止刷新令牌被当作访问令牌使用
+TOKEN_TYPE_ACCESS = "access"
+TOKEN_TYPE_REFRESH = "refresh"
 
 # 创建一个 OAuth2PasswordBearer 实例
 # tokenUrl="token" 指明了客户端应该向哪个 URL 发送用户名和密码以获取令牌
@@ -68,10 +75,66 @@ def create_access_token(data: dict, expires_delta: timedelta | None = None):
     else:
         expire = datetime.utcnow() + timedelta(minutes=15)
     to_encode.update({"exp": expire})
+    to_encode.setdefault("type", TOKEN_TYPE_ACCESS)
     # 编码 JWT
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
+# --- 刷新令牌部分 ---
+# 刷新令牌带有随机的 jti，签发时记录在 refresh_tokens 表中（见 models.RefreshToken）。
+# 每个刷新令牌只能使用一次：刷新时旧令牌的记录被删除，同时签发新的刷新令牌（令牌轮换）；
+# 登出时删除用户的全部记录。表在所有 worker 之间共享，因此吊销对整个集群立即生效。
+
+def _refresh_token_exception() -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="刷新令牌无效或已过期",
+        headers={"WWW-Authenticate": "Bearer"},
+    )
+
+def _encode_refresh_token(username: str, jti: str, expires_at: datetime) -> str:
+    to_encode = {
+        "sub": username,
+        "type": TOKEN_TYPE_REFRESH,
+        "jti": jti,
+        "iat": int(time.time()),
+        "exp": expires_at,
+    }
+    return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+
+def create_refresh_token(db: Session, user_id: int, username: str) -> str:
+    """
+    为用户签发刷新令牌并记录在数据库中。在数据库线程中执行 (db_executor.run)。
+    :return: 编码后的 JWT 字符串
+    """
+    jti = secrets.token_urlsafe(16)
+    expires_at = datetime.utcnow() + timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS)
+    crud.create_refresh_token(db, jti=jti, user_id=user_id, expires_at=expires_at)
+    return _encode_refresh_token(username, jti, expires_at)
+
+def rotate_refresh_token(db: Session, token: str) -> tuple[str, str]:
+    """
+    使用刷新令牌：校验签名和过期时间，删除它在数据库中的记录，并签发新的刷新令牌。
+    在数据库线程中执行 (db_executor.run)，不计算密码哈希。
+    :param token: 客户端提交的刷新令牌
+    :return: (用户名, 新的刷新令牌)
+    :raises HTTPException: 令牌无效、已使用、已被吊销，或用户已不存在时返回 401
+    """
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    except JWTError:
+        raise _refresh_token_exception()
+
+    username = payload.get("sub")
+    jti = payload.get("jti")
+    if payload.get("type") != TOKEN_TYPE_REFRESH or not isinstance(username, str) or not isinstance(jti, str):
+        raise _refresh_token_exception()
+    new_jti = secrets.token_urlsafe(16)
+    expires_at = datetime.utcnow() + timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS)
+    if crud.rotate_refresh_token(db, jti=jti, username=username, new_jti=new_jti, expires_at=expires_at) is None:
+        raise _refresh_token_exception()
+    return username, _encode_refresh_token(username, new_jti, expires_at)
+
 # FastAPI 依赖项：获取当前用户
 # 这个函数会从请求头中提取令牌，解码并验证它
 async def get_current_user(token: str = Depends(oauth2_scheme)):
@@ -88,6 +151,9 @@ async def get_current_user(token: str = Depends(oauth2_scheme)):
         username_from_payload = payload.get("sub")
         if username_from_payload is None or not isinstance(username_from_payload, str):
             raise credentials_exception
+        # 刷新令牌只能用于 /token/refresh，不能当作访问令牌
+        if payload.get("type", TOKEN_TYPE_ACCESS) != TOKEN_TYPE_ACCESS:
+            raise credentials_exception
         username: str = username_from_payload
         # 将用户名存入 TokenData 模型
         token_data = schemas.TokenData(username=username)
@@ -103,17 +169,19 @@ async def get_current_user(token: str = Depends(oauth2_scheme)):
     # 目前，我们只返回包含用户名的 token_data
     return token_data
 
-# 新的依赖项：获取当前数据库中的活动用户对象
+# 新的依赖项：获取当前活动用户
+# 通过用户目录缓存解析，命中时不访问数据库；只包含 id 和 username。
+# 需要完整 User 行（例如修改在线状态）的端点应再调用 crud.get_user 加载。
 def get_current_active_user(
     current_user_data: schemas.TokenData = Depends(get_current_user),
     db: Session = Depends(get_db)
-) -> models.User:
+) -> UserEntry:
     if current_user_data.username is None:
         # 这个异常理论上不会被触发，因为 get_current_user 已经检查过了
         # 但这可以让类型检查器满意
         raise HTTPException(status_code=401, detail="无法验证凭据")
     
-    user = crud.get_user_by_username(db, username=current_user_data.username)
+    user = crud.get_user_entry_by_username(db, username=current_user_data.username)
     if user is None:
         raise HTTPException(status_code=401, detail="用户不存在")
     return user
@@ -121,9 +189,8 @@ def get_current_active_user(
 # WebSocket 的认证依赖
 async def get_current_user_from_ws(
     websocket: WebSocket,
-    token: Optional[str] = Query(None),
-    db: Session = Depends(get_db)
-) -> Optional[models.User]:
+    token: Optional[str] = Query(None)
+) -> Optional[UserEntry]:
     if token is None:
         await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason="Token not provided")
         return None
@@ -131,7 +198,7 @@ async def get_current_user_from_ws(
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         username: Optional[str] = payload.get("sub")
-        if username is None:
+        if username is None or payload.get("type", TOKEN_TYPE_ACCESS) != TOKEN_TYPE_ACCESS:
             await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason="Invalid token payload")
             return None
     except JWTError:
@@ -140,7 +207,10 @@ async def get_current_user_from_ws(
         await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason="Token无效")
         return None
 
-    user = crud.get_user_by_username(db, username=username)
+    # 先查用户目录缓存；未命中时在数据库线程中查询，避免阻塞事件循环
+    user = crud.get_cached_user_entry(username)
+    if user is None:
+        user = await db_executor.run(crud.get_user_entry_by_username, username=username)
     if user is None:
         await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason="用户不存在")
         return None
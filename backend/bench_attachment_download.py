@@ -0,0 +1,139 @@
+"""
+基准测试：单个 worker（一个事件循环）同时向多个客户端发送大附件时的吞吐量、服务器 CPU 开销和峰值内存。
+
+对比三种发送方式（服务器端都是 asyncio 流，客户端在独立进程中接收，不占用服务器进程的 CPU）:
+  - read:     在线程池中按 64 KB 分块 read()，再写入 socket（StreamingResponse / FileResponse 的做法）
+  - mmap:     把 blob 映射到内存，按 BLOB_SEND_SLICE_BYTES 发送映射上的 memoryview 切片（BlobResponse 的默认做法）
+  - sendfile: loop.sendfile 由内核直接从文件发送到 socket（服务器支持 ASGI 零拷贝发送扩展时的做法）
+CPU 为服务器进程（含线程池）每发送 1 GB 消耗的 CPU 时间；峰值内存为发送期间 Python 层新分配内存的峰值。
+
+运行方式（在仓库根目录）:
+    python -m backend.bench_attachment_download
+"""
+import asyncio
+import multiprocessing
+import os
+import socket
+import tempfile
+import time
+import tracemalloc
+
+from .blob_store import BLOB_SEND_SLICE_BYTES, BlobStore
+
+BLOB_BYTES = 64 * 1024 * 1024
+READ_CHUNK_BYTES = 64 * 1024
+CONCURRENCY = (1, 8, 32)
+
+
+async def send_read(writer: asyncio.StreamWriter, path: str, size: int):
+    loop = asyncio.get_running_loop()
+    with open(path, "rb") as blob:
+        while True:
+            chunk = await loop.run_in_executor(None, blob.read, READ_CHUNK_BYTES)
+            if not chunk:
+                break
+            writer.write(chunk)
+            await writer.drain()
+
+
+async def send_mmap(writer: asyncio.StreamWriter, path: str, size: int):
+    store, sha256 = path_to_blob(path)
+    view = store.map_range(sha256, 0, size - 1)
+    for position in range(0, size, BLOB_SEND_SLICE_BYTES):
+        writer.write(view[position:position + BLOB_SEND_SLICE_BYTES])
+        await writer.drain()
+
+
+async def send_sendfile(writer: asyncio.StreamWriter, path: str, size: int):
+    loop = asyncio.get_running_loop()
+    with open(path, "rb") as blob:
+        await loop.sendfile(writer.transport, blob, 0, size)
+
+
+STRATEGIES = {"read": send_read, "mmap": send_mmap, "sendfile": send_sendfile}
+
+
+def path_to_blob(path: str):
+    """由 blob 的路径 <root>/<前两位>/<sha256> 还原存储根目录和 SHA-256。"""
+    root = os.path.dirname(os.path.dirname(path))
+    return BlobStore(root), os.path.basename(path)
+
+
+def download(args: tuple) -> None:
+    """客户端进程：下载一个完整的附件，只接收到预先分配的缓冲区中。"""
+    port, size = args
+    buffer = bytearray(1024 * 1024)
+    with socket.create_connection(("127.0.0.1", port)) as conn:
+        conn.sendall(b"GET\n")
+        received = 0
+        while received < size:
+            n = conn.recv_into(buffer)
+            if not n:
+                raise ConnectionError("连接提前关闭")
+            received += n
+
+
+async def serve(strategy, path: str, size: int, clients: int, pool) -> tuple:
+    """启动服务器并让 clients 个客户端同时下载，返回 (耗时秒数, 服务器 CPU 秒数)。"""
+    loop = asyncio.get_running_loop()
+    handlers = []
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        handlers.append(asyncio.current_task())
+        await reader.readline()
+        await strategy(writer, path, size)
+        writer.close()
+        await writer.wait_closed()
+
+    server = await asyncio.start_server(handle, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    started, cpu_started = time.perf_counter(), time.process_time()
+    # 客户端完成时通过回调通知事件循环，不占用 read 方式需要的默认线程池
+    done = loop.create_future()
+    pool.map_async(
+        download, [(port, size)] * clients, chunksize=1,
+        callback=lambda _: loop.call_soon_threadsafe(done.set_result, None),
+        error_callback=lambda e: loop.call_soon_threadsafe(done.set_exception, e),
+    )
+    await done
+    await asyncio.gather(*handlers)
+    elapsed, cpu = time.perf_counter() - started, time.process_time() - cpu_started
+    server.close()
+    await server.wait_closed()
+    return elapsed, cpu
+
+
+def peak_memory(strategy, path: str, size: int, clients: int, pool) -> int:
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    asyncio.run(serve(strategy, path, size, clients, pool))
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def main():
+    with tempfile.TemporaryDirectory() as root:
+        store = BlobStore(root)
+        store.create_upload("bench")
+        store.append("bench", 0, os.urandom(BLOB_BYTES))
+        sha256, size = store.commit("bench")
+        path = store.blob_path(sha256)
+
+        with multiprocessing.get_context("spawn").Pool(max(CONCURRENCY)) as pool:
+            # 预热页缓存和客户端进程
+            asyncio.run(serve(send_read, path, size, max(CONCURRENCY), pool))
+            for clients in CONCURRENCY:
+                total_gb = size * clients / 1024 ** 3
+                print(f"{clients} 个并发下载，每个 {size // 1024 // 1024} MB:")
+                for name, strategy in STRATEGIES.items():
+                    elapsed, cpu = asyncio.run(serve(strategy, path, size, clients, pool))
+                    memory = peak_memory(strategy, path, size, clients, pool)
+                    print(
+                        f"  {name:<9} 吞吐量 {total_gb * 1024 / elapsed:8.0f} MB/s"
+                        f"  CPU {cpu / total_gb:6.3f} s/GB  峰值内存 {memory / 1024:9.1f} KB"
+                    )
+
+
+if __name__ == "__main__":
+    main()
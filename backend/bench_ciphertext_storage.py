@@ -0,0 +1,105 @@
+"""
+基准测试：消息密文以 base64 TEXT 保存与以原始字节 BLOB 保存时的数据库文件大小和离线消息回放耗时。
+
+对每种密文长度分别建立两个相同内容的数据库:
+  - text: encrypted_content 为 base64 文本（改造前的格式）
+  - blob: encrypted_content 为原始字节（以 bin 发送或声明 content_kind 为 binary 的密文的保存格式，见 ciphertext.py）
+回放耗时为按 (sent_at, id) 键集分页读出一个用户的全部未读消息并编码为 offline_batch 帧的时间:
+  - text/json:    读出 base64 文本，编码为 JSON 帧
+  - blob/json:    读出原始字节，在 JSON 出口编码为 base64
+  - blob/msgpack: 读出原始字节，二进制会话直接以 bin 发送，不做 base64 编码
+需要安装 msgpack（见 requirements.txt）。
+
+运行方式（在仓库根目录）:
+    python -m backend.bench_ciphertext_storage
+"""
+import base64
+import os
+import sqlite3
+import statistics
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from .wire_protocol import SUBPROTOCOL_MSGPACK, Envelope, msgpack
+
+MESSAGES = 20_000
+CIPHERTEXT_SIZES = (64, 1024, 16 * 1024)
+PAGE_SIZE = 100
+ROUNDS = 5
+
+SCHEMA = (
+    "CREATE TABLE messages (id INTEGER PRIMARY KEY, sender_id INTEGER NOT NULL, receiver_id INTEGER NOT NULL, "
+    "encrypted_content BLOB NOT NULL, sent_at DATETIME, is_read BOOLEAN)",
+    "CREATE INDEX ix_messages_unread ON messages (receiver_id, is_read, sent_at, id)",
+)
+UNREAD_SQL = (
+    "SELECT id, sent_at, encrypted_content FROM messages "
+    "WHERE receiver_id = 1 AND is_read = 0 AND (sent_at > ? OR (sent_at = ? AND id > ?)) "
+    "ORDER BY sent_at, id LIMIT ?"
+)
+
+
+def build(path: str, contents: list):
+    conn = sqlite3.connect(path)
+    for statement in SCHEMA:
+        conn.execute(statement)
+    started = datetime(2025, 6, 1)
+    conn.executemany(
+        "INSERT INTO messages (sender_id, receiver_id, encrypted_content, sent_at, is_read) VALUES (2, 1, ?, ?, 0)",
+        ((content, (started + timedelta(seconds=i)).isoformat(sep=" ")) for i, content in enumerate(contents)),
+    )
+    conn.commit()
+    conn.close()
+
+
+def replay(path: str, protocol) -> float:
+    """回放全部未读消息，返回耗时（毫秒）。"""
+    conn = sqlite3.connect(path)
+    started = time.perf_counter()
+    after = ("", 0)
+    while True:
+        rows = conn.execute(UNREAD_SQL, (after[0], after[0], after[1], PAGE_SIZE)).fetchall()
+        if not rows:
+            break
+        frame = Envelope({
+            "type": "offline_batch",
+            "messages": [
+                {"type": "offline_message", "sender_username": "alice", "content": content, "timestamp": sent_at}
+                for _, sent_at, content in rows
+            ],
+        })
+        frame.binary() if protocol else frame.text()
+        after = (rows[-1][1], rows[-1][0])
+    elapsed = (time.perf_counter() - started) * 1000
+    conn.close()
+    return elapsed
+
+
+def main():
+    if msgpack is None:
+        print("未安装 msgpack，无法运行二进制协议的基准测试。")
+        return
+    with tempfile.TemporaryDirectory() as root:
+        for size in CIPHERTEXT_SIZES:
+            raw = [os.urandom(size) for _ in range(MESSAGES)]
+            paths = {"text": os.path.join(root, f"text_{size}.db"), "blob": os.path.join(root, f"blob_{size}.db")}
+            build(paths["text"], [base64.b64encode(content).decode("ascii") for content in raw])
+            build(paths["blob"], raw)
+            text_size, blob_size = (os.path.getsize(paths[name]) for name in ("text", "blob"))
+            print(f"{MESSAGES} 条 {size} 字节的密文:")
+            print(f"  数据库大小: text {text_size / 1024 / 1024:8.1f} MB  blob {blob_size / 1024 / 1024:8.1f} MB"
+                  f"  ({blob_size / text_size:.2f}x)")
+            results = {}
+            for name, path, protocol in (
+                ("text/json", paths["text"], None),
+                ("blob/json", paths["blob"], None),
+                ("blob/msgpack", paths["blob"], SUBPROTOCOL_MSGPACK),
+            ):
+                replay(path, protocol)
+                results[name] = statistics.median(replay(path, protocol) for _ in range(ROUNDS))
+                print(f"  {name:<13} 回放 {results[name]:8.1f} ms  ({results[name] / results['text/json']:.2f}x)")
+
+
+if __name__ == "__main__":
+    main()
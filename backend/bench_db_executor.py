@@ -0,0 +1,117 @@
+"""
+基准测试：并发离线消息写入时，在线消息投递的延迟分布。
+
+对比两种方式:
+  - inline:   在事件循环中直接执行同步的 SQLite 写入（改造前 websocket_endpoint 的做法）
+  - executor: 通过 DatabaseExecutor 在线程池中执行写入（改造后的做法）
+
+运行方式（在仓库根目录）:
+    python -m backend.bench_db_executor
+"""
+import asyncio
+import json
+import os
+import statistics
+import tempfile
+import time
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import sessionmaker
+
+from .connection_manager import ConnectionManager
+from .db_executor import DatabaseExecutor
+
+DURATION_SECONDS = 3.0
+OFFLINE_WRITERS = 8
+LIVE_INTERVAL_SECONDS = 0.001
+
+
+class LatencyRecorder:
+    """模拟在线接收者的 WebSocket，记录每条消息从发出到被写入套接字的延迟。"""
+
+    def __init__(self):
+        self.latencies: list[float] = []
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, message: str):
+        sent_at = json.loads(message)["sent_at"]
+        self.latencies.append(time.perf_counter() - sent_at)
+
+    async def close(self, code=None):
+        pass
+
+
+def write_offline_message(db, content: str):
+    """与 crud.create_message 等价的单条插入 + 提交。"""
+    db.execute(
+        text("INSERT INTO messages (sender_id, receiver_id, encrypted_content, is_read) VALUES (1, 2, :c, 0)"),
+        {"c": content},
+    )
+    db.commit()
+
+
+async def run_scenario(mode: str, session_factory) -> list[float]:
+    manager = ConnectionManager()
+    await manager.start()
+    recorder = LatencyRecorder()
+    session_id, _ = await manager.connect(recorder, 1)  # type: ignore
+    executor = DatabaseExecutor(session_factory=session_factory)
+    deadline = time.perf_counter() + DURATION_SECONDS
+    content = "x" * 256
+
+    async def live_sender():
+        while time.perf_counter() < deadline:
+            await manager.send_personal_message(json.dumps({"sent_at": time.perf_counter()}), 1)
+            await asyncio.sleep(LIVE_INTERVAL_SECONDS)
+
+    async def offline_writer():
+        while time.perf_counter() < deadline:
+            if mode == "inline":
+                db = session_factory()
+                try:
+                    write_offline_message(db, content)
+                finally:
+                    db.close()
+                await asyncio.sleep(0)
+            else:
+                await executor.run(write_offline_message, content)
+
+    await asyncio.gather(live_sender(), *(offline_writer() for _ in range(OFFLINE_WRITERS)))
+    await asyncio.sleep(0.05)
+    await manager.disconnect(1, session_id)
+    await manager.close()
+    executor.shutdown()
+    return recorder.latencies
+
+
+def percentile(values: list[float], pct: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(len(ordered) * pct / 100))
+    return ordered[index]
+
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = create_engine(f"sqlite:///{os.path.join(tmp, 'bench.db')}", connect_args={"check_same_thread": False})
+        with engine.begin() as conn:
+            conn.execute(text(
+                "CREATE TABLE messages (id INTEGER PRIMARY KEY, sender_id INTEGER, receiver_id INTEGER, "
+                "encrypted_content TEXT, sent_at DATETIME DEFAULT CURRENT_TIMESTAMP, is_read BOOLEAN)"
+            ))
+        session_factory = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+        print(f"在线消息投递延迟（{OFFLINE_WRITERS} 个并发离线写入协程，持续 {DURATION_SECONDS}s）")
+        for mode in ("inline", "executor"):
+            latencies = asyncio.run(run_scenario(mode, session_factory))
+            ms = [v * 1000 for v in latencies]
+            print(
+                f"  {mode:<9} 消息数={len(ms):<6} p50={statistics.median(ms):7.2f}ms "
+                f"p99={percentile(ms, 99):7.2f}ms max={max(ms):7.2f}ms"
+            )
+        engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
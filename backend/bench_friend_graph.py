@@ -0,0 +1,92 @@
+"""
+基准测试：好友邻接索引的预热时间、内存占用和在线好友查询延迟。
+
+  - 预热:   从 SQLite 的 contacts 表读取所有已接受关系并构建 FriendGraph（启动时的 load_friend_graph）
+  - 内存:   构建完成后索引占用的内存，换算为每百万条好友关系的占用
+  - 查询:   friends() + 在线集合过滤，即 /me/contacts/online 中不访问数据库的部分
+
+运行方式（在仓库根目录）:
+    python -m backend.bench_friend_graph
+"""
+import os
+import random
+import sqlite3
+import statistics
+import tempfile
+import time
+import tracemalloc
+
+from .friend_graph import FriendGraph
+
+USERS = 200_000
+FRIENDSHIPS = 1_000_000
+ONLINE_RATIO = 0.1
+QUERIES = 100_000
+
+
+def build_database(path: str):
+    """生成随机的双向好友关系（每对好友两行 accepted 记录，与 update_contact_status 一致）。"""
+    rng = random.Random(42)
+    conn = sqlite3.connect(path)
+    conn.execute(
+        "CREATE TABLE contacts (id INTEGER PRIMARY KEY, user_id INTEGER, friend_id INTEGER, status TEXT, "
+        "UNIQUE (user_id, friend_id))"
+    )
+    pairs = set()
+    while len(pairs) < FRIENDSHIPS:
+        a, b = rng.randrange(1, USERS + 1), rng.randrange(1, USERS + 1)
+        if a != b:
+            pairs.add((min(a, b), max(a, b)))
+    rows = [(a, b, "accepted") for a, b in pairs] + [(b, a, "accepted") for a, b in pairs]
+    conn.executemany("INSERT INTO contacts (user_id, friend_id, status) VALUES (?, ?, ?)", rows)
+    conn.commit()
+    conn.close()
+
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.db")
+        print(f"生成 {USERS} 个用户、{FRIENDSHIPS} 对好友关系（{FRIENDSHIPS * 2} 行 contacts）...")
+        build_database(path)
+
+        conn = sqlite3.connect(path)
+        query = "SELECT user_id, friend_id FROM contacts WHERE status = 'accepted'"
+
+        # 预热时间单独测量，tracemalloc 本身会显著拖慢分配
+        graph = FriendGraph()
+        started = time.perf_counter()
+        graph.load(conn.execute(query))
+        elapsed = time.perf_counter() - started
+
+        graph = FriendGraph()
+        tracemalloc.start()
+        graph.load(conn.execute(query))
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        conn.close()
+
+        edges = graph.stats()["edges"]
+        per_million = 1_000_000 / edges
+        print(f"预热:   {elapsed:.2f}s（每百万条关系 {elapsed * per_million:.2f}s）")
+        print(
+            f"内存:   常驻 {current / 2**20:.1f} MiB，峰值 {peak / 2**20:.1f} MiB"
+            f"（每百万条关系常驻 {current * per_million / 2**20:.1f} MiB）"
+        )
+
+        rng = random.Random(7)
+        online = {user_id for user_id in range(1, USERS + 1) if rng.random() < ONLINE_RATIO}
+        latencies = []
+        for _ in range(QUERIES):
+            user_id = rng.randrange(1, USERS + 1)
+            started = time.perf_counter()
+            [friend_id for friend_id in graph.friends(user_id) if friend_id in online]
+            latencies.append((time.perf_counter() - started) * 1_000_000)
+        latencies.sort()
+        print(
+            f"查询:   {QUERIES} 次在线好友过滤 p50={statistics.median(latencies):.1f}us "
+            f"p99={latencies[int(len(latencies) * 0.99)]:.1f}us"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+"""
+基准测试：消息表规模增长时，会话历史分页和未读消息查询的延迟。
+
+对每种表规模分别测量:
+  - history:      GET /messages/with/{username} 的查询，按 (conversation_key, id) 索引做键集分页
+                  （第一页，以及用 before 游标翻到会话中间的一页）
+  - unread:       get_unread_messages_page 的查询，使用 (receiver_id, is_read, sent_at, id) 索引
+  - history_scan: 没有会话键和复合索引时的等价查询（按 sender/receiver 两个方向 OR 过滤），作为对照
+
+运行方式（在仓库根目录）:
+    python -m backend.bench_message_history
+"""
+import os
+import random
+import sqlite3
+import statistics
+import tempfile
+import time
+
+TABLE_SIZES = (10_000, 100_000, 1_000_000)
+USERS = 2_000
+UNREAD_RATIO = 0.05
+QUERIES = 500
+SCAN_QUERIES = 20
+PAGE_SIZE = 50
+
+
+def conversation_key(user_a: int, user_b: int) -> int:
+    """与 models.conversation_key 相同（models 依赖 SQLAlchemy，基准测试只使用 sqlite3）。"""
+    low, high = (user_a, user_b) if user_a <= user_b else (user_b, user_a)
+    return (low << 32) | high
+
+
+HISTORY_SQL = (
+    "SELECT id, sender_id, receiver_id, encrypted_content, sent_at FROM messages "
+    "WHERE conversation_key = ? AND id < ? ORDER BY id DESC LIMIT ?"
+)
+UNREAD_SQL = (
+    "SELECT id, sent_at, encrypted_content FROM messages "
+    "WHERE receiver_id = ? AND is_read = 0 ORDER BY sent_at, id LIMIT ?"
+)
+HISTORY_SCAN_SQL = (
+    "SELECT id, sender_id, receiver_id, encrypted_content, sent_at FROM messages NOT INDEXED "
+    "WHERE ((sender_id = ? AND receiver_id = ?) OR (sender_id = ? AND receiver_id = ?)) AND id < ? "
+    "ORDER BY id DESC LIMIT ?"
+)
+
+
+def build_database(path: str, size: int) -> list:
+    """生成 size 条消息，消息集中在少量好友对之间。返回所有会话的 (a, b)。"""
+    rng = random.Random(size)
+    conn = sqlite3.connect(path)
+    conn.execute(
+        "CREATE TABLE messages (id INTEGER PRIMARY KEY, sender_id INTEGER NOT NULL, receiver_id INTEGER NOT NULL, "
+        "encrypted_content TEXT NOT NULL, sent_at DATETIME DEFAULT CURRENT_TIMESTAMP, is_read BOOLEAN, "
+        "conversation_key INTEGER)"
+    )
+    pairs = [tuple(rng.sample(range(1, USERS + 1), 2)) for _ in range(USERS * 5)]
+    content = "x" * 120
+    rows = []
+    for i in range(size):
+        a, b = rng.choice(pairs)
+        if rng.random() < 0.5:
+            a, b = b, a
+        rows.append((a, b, content, f"2025-06-{1 + i * 28 // size:02d} 12:00:00", rng.random() < UNREAD_RATIO))
+    conn.executemany(
+        "INSERT INTO messages (sender_id, receiver_id, encrypted_content, sent_at, is_read) VALUES (?, ?, ?, ?, ?)",
+        [(a, b, c, t, not unread) for a, b, c, t, unread in rows],
+    )
+    # 与 migrations.py 相同的回填和索引
+    conn.execute(
+        "UPDATE messages SET conversation_key = CASE "
+        "WHEN sender_id <= receiver_id THEN (sender_id << 32) | receiver_id "
+        "ELSE (receiver_id << 32) | sender_id END"
+    )
+    conn.execute("CREATE INDEX ix_messages_conversation ON messages (conversation_key, id)")
+    conn.execute("CREATE INDEX ix_messages_unread ON messages (receiver_id, is_read, sent_at, id)")
+    conn.commit()
+    conn.close()
+    return pairs
+
+
+def measure(conn: sqlite3.Connection, sql: str, params: list) -> list:
+    latencies = []
+    for args in params:
+        started = time.perf_counter()
+        conn.execute(sql, args).fetchall()
+        latencies.append((time.perf_counter() - started) * 1000)
+    return latencies
+
+
+def report(label: str, latencies: list):
+    ordered = sorted(latencies)
+    p99 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))]
+    print(f"  {label:<20} p50={statistics.median(ordered):8.3f}ms p99={p99:8.3f}ms")
+
+
+def main():
+    for size in TABLE_SIZES:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "bench.db")
+            pairs = build_database(path, size)
+            conn = sqlite3.connect(path)
+            rng = random.Random(7)
+            max_id = conn.execute("SELECT max(id) FROM messages").fetchone()[0]
+
+            print(f"{size} 条消息:")
+            first_pages = [
+                (conversation_key(*rng.choice(pairs)), max_id + 1, PAGE_SIZE) for _ in range(QUERIES)
+            ]
+            report("history (第一页)", measure(conn, HISTORY_SQL, first_pages))
+            middle_pages = [
+                (conversation_key(*rng.choice(pairs)), rng.randint(1, max_id), PAGE_SIZE) for _ in range(QUERIES)
+            ]
+            report("history (中间页)", measure(conn, HISTORY_SQL, middle_pages))
+            unread = [(rng.randint(1, USERS), PAGE_SIZE) for _ in range(QUERIES)]
+            report("unread", measure(conn, UNREAD_SQL, unread))
+            scans = []
+            for _ in range(SCAN_QUERIES):
+                a, b = rng.choice(pairs)
+                scans.append((a, b, b, a, max_id + 1, PAGE_SIZE))
+            report("history_scan (对照)", measure(conn, HISTORY_SCAN_SQL, scans))
+
+            plan = conn.execute("EXPLAIN QUERY PLAN " + HISTORY_SQL, first_pages[0]).fetchall()
+            print(f"  查询计划: {plan[-1][-1]}")
+            conn.close()
+
+
+if __name__ == "__main__":
+    main()
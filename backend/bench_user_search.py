@@ -0,0 +1,89 @@
+"""
+基准测试：100 万用户时用户名搜索的延迟。
+
+对比两种方式:
+  - like:  SQLite 上的 username LIKE '%q%'（改造前 search_users_by_username 的做法，无法使用索引）
+  - index: UserSearchIndex 内存 n-gram 索引（完全匹配 > 前缀 > 子串排序，键集分页）
+
+运行方式（在仓库根目录）:
+    python -m backend.bench_user_search
+"""
+import os
+import random
+import sqlite3
+import statistics
+import string
+import tempfile
+import time
+
+from .user_search import UserSearchIndex
+
+USERS = 1_000_000
+QUERIES_PER_KIND = 200
+LIKE_QUERIES_PER_KIND = 10
+PAGE_SIZE = 10
+
+
+def random_username(rng: random.Random) -> str:
+    return "".join(rng.choices(string.ascii_lowercase + string.digits, k=rng.randint(6, 12)))
+
+
+def make_queries(rng: random.Random, usernames: list) -> dict:
+    """每类查询: 完整用户名、3 字符前缀、用户名中间的 3~4 个字符、2 个字符。"""
+    queries = {"exact": [], "prefix": [], "substring": [], "two_chars": []}
+    for _ in range(QUERIES_PER_KIND):
+        name = rng.choice(usernames)
+        queries["exact"].append(name)
+        queries["prefix"].append(name[:3])
+        start = rng.randint(1, len(name) - 4)
+        queries["substring"].append(name[start:start + rng.randint(3, 4)])
+        queries["two_chars"].append(name[start:start + 2])
+    return queries
+
+
+def measure(func, queries: list) -> list:
+    latencies = []
+    for query in queries:
+        started = time.perf_counter()
+        func(query)
+        latencies.append((time.perf_counter() - started) * 1000)
+    return latencies
+
+
+def report(label: str, latencies: list):
+    ordered = sorted(latencies)
+    p99 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))]
+    print(f"  {label:<20} p50={statistics.median(ordered):8.3f}ms p99={p99:8.3f}ms")
+
+
+def main():
+    rng = random.Random(42)
+    usernames = list({random_username(rng) for _ in range(USERS)})
+    users = list(enumerate(usernames, start=1))
+    queries = make_queries(rng, usernames)
+
+    index = UserSearchIndex()
+    started = time.perf_counter()
+    index.load(users)
+    print(f"索引构建: {len(users)} 个用户，{time.perf_counter() - started:.2f}s，{index.stats()}")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        conn = sqlite3.connect(os.path.join(tmp, "bench.db"))
+        conn.execute("CREATE TABLE users (id INTEGER PRIMARY KEY, username TEXT UNIQUE)")
+        conn.executemany("INSERT INTO users (id, username) VALUES (?, ?)", users)
+        conn.commit()
+
+        def like(query):
+            return conn.execute(
+                "SELECT id, username FROM users WHERE username LIKE ? LIMIT ?", (f"%{query}%", PAGE_SIZE)
+            ).fetchall()
+
+        for kind, kind_queries in queries.items():
+            print(f"{kind}:")
+            report("like (全表扫描)", measure(like, kind_queries[:LIKE_QUERIES_PER_KIND]))
+            report("index", measure(lambda q: index.search(q, limit=PAGE_SIZE), kind_queries))
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
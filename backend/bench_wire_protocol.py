@@ -0,0 +1,133 @@
+"""
+基准测试：WebSocket 线路协议的帧大小，以及每条消息的服务器 CPU 开销和峰值内存。
+
+对比以下帧格式转发一条聊天消息的完整路径（解码客户端帧 -> 构造转发消息 -> 按接收者协议编码）:
+  - json:         JSON 文本帧，密文以 base64 文本嵌在 JSON 中（默认协议）
+  - json+body:    securechat.detached.v1: JSON 路由头 + 换行 + 分离的消息体，服务器不解析消息体
+  - msgpack:      securechat.msgpack.v1 二进制帧，密文以 bin 原样传输
+  - msgpack+body: MessagePack 路由头 + 分离的消息体，服务器不解码消息体
+峰值内存为转发过程中新分配的内存（不含已收到的客户端帧）。
+
+消息类型:
+  - text:      短文本消息的密文
+  - file_64k / file_1m / file_8m: 附件密文
+  - file_json: 前端当前的 "[FILE]{...}" 文件消息（JSON 字符串内嵌 JSON，两种协议中 content 都是文本）
+
+需要安装 msgpack（见 requirements.txt）。
+运行方式（在仓库根目录）:
+    python -m backend.bench_wire_protocol
+"""
+import base64
+import json
+import os
+import statistics
+import time
+import tracemalloc
+
+from .wire_protocol import SUBPROTOCOL_DETACHED, SUBPROTOCOL_MSGPACK, Envelope, decode_frame, encode, msgpack
+
+ITERATIONS = {"text": 20_000, "file_64k": 2_000, "file_1m": 100, "file_8m": 10, "file_json": 100}
+ROUNDS = 5
+
+
+def ciphertexts() -> dict:
+    data_url = "data:application/octet-stream;base64," + base64.b64encode(os.urandom(768 * 1024)).decode("ascii")
+    file_message = "[FILE]" + json.dumps({
+        "type": "file", "fileName": "report.pdf", "fileSize": 768 * 1024,
+        "fileType": "application/pdf", "fileData": data_url,
+    })
+    return {
+        "text": os.urandom(200),
+        "file_64k": os.urandom(64 * 1024),
+        "file_1m": os.urandom(1024 * 1024),
+        "file_8m": os.urandom(8 * 1024 * 1024),
+        "file_json": file_message,
+    }
+
+
+def client_frames(content) -> dict:
+    """客户端按各种帧格式发出的同一条消息。"""
+    text_content = content if isinstance(content, str) else base64.b64encode(content).decode("ascii")
+    header = {"recipient_username": "bob"}
+    return {
+        "json": {"type": "websocket.receive", "text": json.dumps({**header, "content": text_content})},
+        "json+body": {"type": "websocket.receive", "text": json.dumps(header) + "\n" + text_content},
+        "msgpack": {
+            "type": "websocket.receive",
+            "bytes": msgpack.packb({**header, "content": content}, use_bin_type=True),
+        },
+        "msgpack+body": {
+            "type": "websocket.receive",
+            "bytes": msgpack.packb(header) + msgpack.packb(content, use_bin_type=True),
+        },
+    }
+
+
+def relay(frame: dict, protocol):
+    """服务器转发一条消息的 CPU 路径，与 server.websocket_endpoint 相同。"""
+    message_data = decode_frame(frame, protocol)
+    payload = Envelope({
+        "type": "p2p_message",
+        "sender_id": 1,
+        "sender_username": "alice",
+        "content": message_data["content"],
+        "timestamp": "2025-06-01T12:00:00.000000",
+    })
+    return encode(payload, protocol)
+
+
+def frame_size(frame: dict) -> int:
+    return len(frame["bytes"]) if "bytes" in frame else len(frame["text"].encode("utf-8"))
+
+
+def measure(frame: dict, protocol, iterations: int) -> float:
+    """返回每条消息的 CPU 时间（微秒），取多轮中的中位数。"""
+    rounds = []
+    for _ in range(ROUNDS):
+        started = time.process_time()
+        for _ in range(iterations):
+            relay(frame, protocol)
+        rounds.append((time.process_time() - started) / iterations * 1_000_000)
+    return statistics.median(rounds)
+
+
+def peak_memory(frame: dict, protocol) -> int:
+    """转发一条消息期间新分配内存的峰值（字节）。"""
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    outgoing = relay(frame, protocol)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del outgoing
+    return peak
+
+
+def main():
+    if msgpack is None:
+        print("未安装 msgpack，无法运行二进制协议的基准测试。")
+        return
+    protocols = {
+        "json": None, "json+body": SUBPROTOCOL_DETACHED, "msgpack": SUBPROTOCOL_MSGPACK, "msgpack+body": SUBPROTOCOL_MSGPACK,
+    }
+    for kind, content in ciphertexts().items():
+        print(f"{kind}:")
+        frames = client_frames(content)
+        results = {}
+        for name, protocol in protocols.items():
+            outgoing = relay(frames[name], protocol)
+            out_size = len(outgoing) if isinstance(outgoing, bytes) else len(outgoing.encode("utf-8"))
+            cpu = measure(frames[name], protocol, ITERATIONS[kind])
+            memory = peak_memory(frames[name], protocol)
+            results[name] = (frame_size(frames[name]), out_size, cpu)
+            print(
+                f"  {name:<13} 上行 {results[name][0]:>9} B  下行 {out_size:>9} B"
+                f"  CPU {cpu:10.2f} us/条  峰值内存 {memory / 1024:9.1f} KB"
+            )
+        json_in, _, json_cpu = results["json"]
+        for name in ("msgpack", "msgpack+body", "json+body"):
+            size, _, cpu = results[name]
+            print(f"  {name}/json: 帧大小 {size / json_in:.2f}x, CPU {cpu / json_cpu:.3f}x")
+
+
+if __name__ == "__main__":
+    main()
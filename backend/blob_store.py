@@ -0,0 +1,196 @@
+import hashlib
+import mmap
+import os
+import re
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+# --- 附件存储配置 ---
+# 附件（加密后的文件）不再以 base64 文本存进 messages 表，而是分块上传到磁盘上的内容寻址存储，
+# 聊天消息中只携带附件 ID。
+BLOB_STORE_ROOT = os.environ.get("SECURECHAT_BLOB_DIR", "./blobs")
+# 单个附件的最大字节数
+ATTACHMENT_MAX_BYTES = 200 * 1024 * 1024
+# 单次上传请求（一个分块）的最大字节数；客户端按不超过该大小的分块顺序上传
+ATTACHMENT_CHUNK_MAX_BYTES = 4 * 1024 * 1024
+# 超过这么久（秒）仍未完成的上传会被清理，客户端需要重新开始
+ATTACHMENT_UPLOAD_EXPIRE_SECONDS = 24 * 3600
+# 完成上传时计算 SHA-256 每次从磁盘读取的字节数
+BLOB_READ_CHUNK_BYTES = 256 * 1024
+# 下载时每条 http.response.body 消息携带的字节数。每个分片都是内存映射上的 memoryview 切片，不复制数据；
+# 分片之间由服务器的写流控 (drain) 产生背压。socket 一次没有发完的部分会被 asyncio 传输层复制到它的缓冲区，
+# 分片越大这部分越多（见 bench_attachment_download）
+BLOB_SEND_SLICE_BYTES = 128 * 1024
+
+
+class UploadOffsetMismatch(Exception):
+    """分块的起始偏移与已上传的字节数不一致（重复发送或跳过了分块）。"""
+
+    def __init__(self, offset: int):
+        super().__init__(f"当前偏移为 {offset}")
+        self.offset = offset
+
+
+class BlobStore:
+    """
+    磁盘上的内容寻址存储：完整的 blob 以内容的 SHA-256 命名，保存在 <root>/<前两位>/<sha256>，
+    相同内容只保存一份；未完成的上传保存在 <root>/uploads/<upload_id>.part，已写入的字节数即续传偏移，
+    服务器重启后仍可继续上传。所有方法都是同步的磁盘 I/O，应在线程池中调用。
+    """
+
+    def __init__(self, root: str = BLOB_STORE_ROOT):
+        self.root = root
+        self._uploads_dir = os.path.join(root, "uploads")
+        os.makedirs(self._uploads_dir, exist_ok=True)
+        # 每个上传一把锁：同一上传的并发分块请求按顺序检查偏移并写入
+        self._locks: Dict[str, threading.Lock] = {}
+        self._locks_guard = threading.Lock()
+
+    def _part_path(self, upload_id: str) -> str:
+        return os.path.join(self._uploads_dir, f"{upload_id}.part")
+
+    def blob_path(self, sha256: str) -> str:
+        return os.path.join(self.root, sha256[:2], sha256)
+
+    def _lock(self, upload_id: str) -> threading.Lock:
+        with self._locks_guard:
+            lock = self._locks.get(upload_id)
+            if lock is None:
+                lock = self._locks[upload_id] = threading.Lock()
+            return lock
+
+    def create_upload(self, upload_id: str):
+        open(self._part_path(upload_id), "xb").close()
+
+    def upload_offset(self, upload_id: str) -> Optional[int]:
+        """已上传的字节数；上传不存在（已完成或已清理）时返回 None。"""
+        try:
+            return os.path.getsize(self._part_path(upload_id))
+        except FileNotFoundError:
+            return None
+
+    def append(self, upload_id: str, offset: int, data: bytes) -> int:
+        """
+        把一个分块追加到未完成的上传。
+        :return: 追加后的偏移
+        :raises UploadOffsetMismatch: offset 与已上传的字节数不一致
+        :raises FileNotFoundError: 上传不存在
+        """
+        with self._lock(upload_id):
+            with open(self._part_path(upload_id), "r+b") as part:
+                current = part.seek(0, os.SEEK_END)
+                if offset != current:
+                    raise UploadOffsetMismatch(current)
+                part.write(data)
+                return current + len(data)
+
+    def commit(self, upload_id: str) -> Tuple[str, int]:
+        """
+        完成上传：计算内容的 SHA-256，把文件移动到内容寻址的位置（内容已存在时直接丢弃上传的副本）。
+        :return: (sha256, 字节数)
+        """
+        with self._lock(upload_id):
+            part_path = self._part_path(upload_id)
+            digest = hashlib.sha256()
+            size = 0
+            with open(part_path, "rb") as part:
+                while True:
+                    chunk = part.read(BLOB_READ_CHUNK_BYTES)
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+                    size += len(chunk)
+            sha256 = digest.hexdigest()
+            path = self.blob_path(sha256)
+            if os.path.exists(path):
+                os.remove(part_path)
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(part_path, path)
+        with self._locks_guard:
+            self._locks.pop(upload_id, None)
+        return sha256, size
+
+    def discard(self, upload_id: str):
+        try:
+            os.remove(self._part_path(upload_id))
+        except FileNotFoundError:
+            pass
+        with self._locks_guard:
+            self._locks.pop(upload_id, None)
+
+    def expired_uploads(self, max_age: float = ATTACHMENT_UPLOAD_EXPIRE_SECONDS) -> List[str]:
+        """最后一次写入早于 max_age 秒之前的未完成上传的 ID。"""
+        deadline = time.time() - max_age
+        expired = []
+        with os.scandir(self._uploads_dir) as entries:
+            for entry in entries:
+                if entry.name.endswith(".part") and entry.stat().st_mtime < deadline:
+                    expired.append(entry.name[:-len(".part")])
+        return expired
+
+    def map_range(self, sha256: str, start: int, end: int) -> memoryview:
+        """
+        把 blob 中 [start, end] 闭区间的字节映射到内存，返回只读的 memoryview。
+        数据直接来自页缓存，写入 socket 时由内核从映射的页复制，不经过 Python 的读缓冲区。
+        映射在最后一个引用它的 memoryview 释放后才会解除，调用方不需要（也不能）显式关闭。
+        """
+        with open(self.blob_path(sha256), "rb") as blob:
+            mapped = mmap.mmap(blob.fileno(), 0, access=mmap.ACCESS_READ)
+        # 提示内核异步预读该范围，减少发送时在事件循环线程中发生的缺页等待（Windows 等没有 madvise 的平台跳过）
+        if hasattr(mmap, "MADV_WILLNEED"):
+            aligned = start - start % mmap.PAGESIZE
+            mapped.madvise(mmap.MADV_WILLNEED, aligned, end + 1 - aligned)
+        return memoryview(mapped)[start:end + 1]
+
+
+def blob_etag(sha256: str) -> str:
+    """blob 的强 ETag：内容寻址存储中的 SHA-256 就是内容本身的校验值，内容不变 ETag 就不变。"""
+    return f'"{sha256}"'
+
+
+def etag_matches(header: Optional[str], etag: str) -> bool:
+    """If-None-Match / If-Range 请求头是否匹配给定的 ETag（忽略弱校验前缀 W/）。"""
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    return any(
+        candidate.strip().removeprefix("W/") == etag
+        for candidate in header.split(",")
+    )
+
+
+# 单个字节范围: bytes=a-b、bytes=a-、bytes=-n；多个范围 (bytes=0-1,5-9) 不支持
+_BYTE_RANGE = re.compile(r"bytes=([0-9]*)-([0-9]*)")
+
+
+def parse_range(header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """
+    解析单个字节范围的 Range 请求头（bytes=a-b、bytes=a-、bytes=-n）。
+    :return: [start, end] 闭区间；没有 Range 头或格式不正确、不支持时返回 None（返回整个文件）
+    :raises ValueError: 范围无法满足（应返回 416）
+    """
+    match = _BYTE_RANGE.fullmatch(header.strip()) if header else None
+    if match is None or not (match[1] or match[2]):
+        return None
+    first, last = match[1], match[2]
+    if first:
+        start = int(first)
+        end = int(last) if last else size - 1
+        # bytes=a-b 且 a > b 在语法上无效 (RFC 9110 14.1.1)，与其他格式错误一样忽略，而不是返回 416
+        if last and start > end:
+            return None
+    else:
+        # 后缀范围: 最后 n 个字节；n 为 0 时无法满足
+        suffix = int(last)
+        start = max(size - suffix, 0) if suffix else size
+        end = size - 1
+    if start >= size:
+        raise ValueError("范围无法满足")
+    return start, min(end, size - 1)
+
+
+# 全局单例
+blob_store = BlobStore()
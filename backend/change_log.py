@@ -0,0 +1,110 @@
+import json
+from typing import Callable, Iterable, List, Optional, Tuple
+
+from sqlalchemy import and_, delete, func, insert, or_, select
+from sqlalchemy.orm import Session
+
+import models
+
+# 变更类型，同一类型同一对象的多次变更只保留最新一条
+CHANGE_CONTACT = "contact"
+CHANGE_REQUEST = "request"
+CHANGE_PRESENCE = "presence"
+
+# 变更监听器: (变更类型, [(接收变更的用户 ID, 变更内容)])
+ChangeListener = Callable[[str, List[Tuple[Optional[int], dict]]], None]
+
+
+class ChangeLog:
+    """
+    联系人、好友请求和好友在线状态的增量同步日志，供 GET /me/sync 使用。
+    日志保存在数据库的 sync_changes 表中（见 models.SyncChange），所有 worker 共用同一个版本序列，
+    客户端无论请求落在哪个 worker 上都能从自己的 since 继续增量同步。
+    日志按 (类型, 接收者, 对象) 压缩，只保留最终状态，因此行数只与用户和好友关系的数量有关。
+    在线状态变更每次只写一行，查询时通过好友关系找到接收者，而不是为每个好友各写一行。
+    变更在调用方的事务中写入；提交之后调用方再用 notify 交给已注册的监听器（例如通过 WebSocket 实时推送），
+    监听器可能在数据库线程中被调用。
+    """
+
+    def __init__(self):
+        self._listeners: List[ChangeListener] = []
+        # 运行指标：本进程写入的变更条数
+        self.recorded = 0
+
+    def add_listener(self, listener: ChangeListener):
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener: ChangeListener):
+        if listener in self._listeners:
+            self._listeners.remove(listener)
+
+    def record(
+        self, db: Session, kind: str, changes: Iterable[Tuple[Optional[int], int, dict]]
+    ) -> List[Tuple[Optional[int], dict]]:
+        """
+        在调用方的事务中记录一次事件产生的所有变更（不提交），每条变更替换同一 (类型, 接收者, 对象) 的旧记录。
+        :param kind: 变更类型
+        :param changes: (接收变更的用户 ID, 对象 ID, 变更内容) 列表；在线状态变更的接收者为 None
+        :return: 带版本号的 (接收者, 变更) 列表，事务提交后交给 notify
+        """
+        table = models.SyncChange
+        recorded = []
+        for user_id, subject_id, change in changes:
+            recipient = table.user_id.is_(None) if user_id is None else table.user_id == user_id
+            db.execute(delete(table).where(table.kind == kind, table.subject_id == subject_id, recipient))
+            version = db.execute(
+                insert(table)
+                .values(kind=kind, user_id=user_id, subject_id=subject_id, payload=json.dumps(change))
+                .returning(table.version)
+            ).scalar_one()
+            recorded.append((user_id, {"type": kind, **change, "version": version}))
+        self.recorded += len(recorded)
+        return recorded
+
+    def notify(self, kind: str, recorded: List[Tuple[Optional[int], dict]]):
+        """把已提交的变更交给监听器，监听器出错不影响已经提交的数据库操作。"""
+        if not recorded:
+            return
+        for listener in self._listeners:
+            try:
+                listener(kind, recorded)
+            except Exception as e:
+                print(f"变更监听器出错: {e}")
+
+    @staticmethod
+    def version(db: Session) -> int:
+        """当前的版本号：已提交的最大版本号，还没有任何变更时为 0。"""
+        return db.execute(select(func.coalesce(func.max(models.SyncChange.version), 0))).scalar_one()
+
+    def changes_since(self, db: Session, user_id: int, since: int) -> Optional[Tuple[int, List[dict]]]:
+        """
+        返回用户在 since 之后的所有变更（按版本号递增）。
+        :return: (当前版本号, 变更列表)；since 无法增量同步（超前，例如来自旧版本的内存日志或已重建的数据库）时返回 None
+        """
+        version = self.version(db)
+        if since < 0 or since > version:
+            return None
+        table = models.SyncChange
+        friends = select(models.Contact.friend_id).where(
+            models.Contact.user_id == user_id, models.Contact.status == "accepted"
+        )
+        rows = db.execute(
+            select(table.version, table.kind, table.payload)
+            .where(
+                table.version > since,
+                table.version <= version,
+                or_(
+                    table.user_id == user_id,
+                    and_(table.kind == CHANGE_PRESENCE, table.user_id.is_(None), table.subject_id.in_(friends)),
+                ),
+            )
+            .order_by(table.version)
+        ).all()
+        return version, [{"type": kind, **json.loads(payload), "version": row_version} for row_version, kind, payload in rows]
+
+    def stats(self) -> dict:
+        return {"recorded": self.recorded, "listeners": len(self._listeners)}
+
+
+# 全局单例
+change_log = ChangeLog()
@@ -0,0 +1,43 @@
+import base64
+import binascii
+from typing import Optional, Union
+
+# --- 消息密文的线路约定与存储格式 ---
+# 消息内容的种类由客户端在消息中显式声明（content_kind 字段，WebSocket 帧和 REST 请求体相同），服务器不做猜测:
+#   省略或 "text": content 是文本，原样以 TEXT 保存，即使它看起来像 base64；
+#   "binary":      content 是二进制密文。JSON 中 content 为其标准 base64 文本，服务器在入口按声明解码为字节，
+#                  以原始字节 (BLOB) 保存，比 base64 文本小约 25%；二进制 WebSocket 会话直接发送 bin，bin 本身即声明。
+# 内容的种类同时记录在 messages.content_kind 列中，不依赖 SQLite 按值保留的存储类型。
+# 只有 JSON 出口（REST 响应、JSON 文本帧）才把 bytes 编码为 base64，并带上 "content_kind": "binary"；
+# 二进制会话直接收到 bin。
+Ciphertext = Union[str, bytes]
+
+# messages.content_kind 的取值
+CONTENT_KIND_TEXT = "text"
+CONTENT_KIND_BINARY = "binary"
+
+
+def content_kind(content: Ciphertext) -> str:
+    """消息内容的种类：只有以 bin 收到的密文 (bytes) 是二进制，文本一律是文本。"""
+    return CONTENT_KIND_BINARY if isinstance(content, bytes) else CONTENT_KIND_TEXT
+
+
+def to_text(content: Ciphertext) -> str:
+    """消息内容在 JSON 中的形式：bytes 编码为标准 base64，文本原样返回。"""
+    if isinstance(content, bytes):
+        # b2a_base64 比 b64encode 少一层包装，大密文时稍快
+        return binascii.b2a_base64(content, newline=False).decode("ascii")
+    return content
+
+
+def from_declared(content: str, kind: Optional[str]) -> Ciphertext:
+    """
+    按客户端声明的种类解释文本形式的 content：binary 按标准 base64 严格解码为字节，text 或省略时原样返回。
+    :raises ValueError: 种类未知，或声明为 binary 的 content 不是有效的标准 base64
+    """
+    if kind is None or kind == CONTENT_KIND_TEXT:
+        return content
+    if kind != CONTENT_KIND_BINARY:
+        raise ValueError(f"未知的 content_kind: {kind}")
+    # validate=True 拒绝字母表以外的字符（包括换行），binascii.Error 是 ValueError 的子类
+    return base64.b64decode(content, validate=True)
@@ -1,50 +1,425 @@
-from typing import Dict, List, Optional
-from fastapi import WebSocket
+import asyncio
+import itertools
+import json
+import time
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+from fastapi import WebSocket, status
+from .message_bus import MessageBus, create_message_bus
+from .reliable_delivery import DeliveryBuffer
+from .wire_protocol import OutboundMessage, encode
+
+# --- 出站队列配置 ---
+# 每个连接都有一个有界的出站队列，由独立的写协程负责发送，
+# 这样一个慢速客户端不会阻塞发送方的循环，也不会拖慢广播中的其他接收者。
+# 队列长度达到高水位后，该连接被视为"拥塞"，新消息按慢消费者策略处理；
+# 写协程把队列排空到低水位以下后，连接恢复正常。
+OUTBOUND_QUEUE_HIGH_WATERMARK = 256
+OUTBOUND_QUEUE_LOW_WATERMARK = 64
+# 慢消费者策略:
+#   "drop"       - 拥塞期间直接丢弃新消息
+#   "coalesce"   - 拥塞期间带 coalesce_key 的消息覆盖队列中同 key 的旧消息，其余消息丢弃
+#   "disconnect" - 拥塞时直接关闭该连接，由客户端重连后走离线消息流程
+SLOW_CONSUMER_POLICY = "coalesce"
+SLOW_CONSUMER_POLICIES = ("drop", "coalesce", "disconnect")
+
+# --- WebSocket 存活检测配置 ---
+# 服务器每隔 WS_PING_INTERVAL_SECONDS 向每个会话发送 {"type": "ping"}，客户端回复 {"type": "pong"}。
+# 客户端发来的任何帧都视为存活信号；超过 WS_PING_TIMEOUT_SECONDS 没有收到任何帧的会话会被关闭，
+# 随后由接收循环的断开流程更新在线状态，不再依赖 HTTP 心跳。
+WS_PING_INTERVAL_SECONDS = 20.0
+WS_PING_TIMEOUT_SECONDS = 60.0
+
+# 未确认消息转存回调: (接收者 user_id, 带序号的消息列表) -> None。
+# 可靠投递的消息在缓冲区溢出、断线超过宽限期或应用关闭时仍未被确认，交给它转存为离线消息。
+UndeliveredHandler = Callable[[int, List[OutboundMessage]], Awaitable[None]]
+
+
+class _Connection:
+    """
+    单个设备会话（一个 WebSocket 连接）的状态：线路协议 + 有界出站队列 + 写协程 + 投递统计。
+    使用 __slots__ 并延迟创建合并索引，保持每个会话的内存占用紧凑，
+    这样即使有数万个会话，内存也基本保持平稳。
+    """
+    __slots__ = (
+        "session_id", "device", "protocol", "websocket", "queue", "pending_keys", "wakeup",
+        "congested", "closed", "writer_task", "delivered", "dropped", "last_seen_at",
+    )
+
+    def __init__(
+        self, session_id: int, websocket: WebSocket, device: Optional[str] = None, protocol: Optional[str] = None
+    ):
+        self.session_id = session_id
+        self.device = device
+        # 握手时协商的子协议（见 wire_protocol），None 表示 JSON 文本协议
+        self.protocol = protocol
+        self.websocket = websocket
+        # 队列元素为 [coalesce_key, message]，使用列表以便合并时原地替换消息
+        self.queue: Deque[list] = deque()
+        # coalesce_key -> 队列元素，只有出现带 key 的消息时才创建
+        self.pending_keys: Optional[Dict[str, list]] = None
+        self.wakeup = asyncio.Event()
+        self.congested = False
+        self.closed = False
+        self.writer_task: Optional[asyncio.Task] = None
+        # 每个设备的投递统计
+        self.delivered = 0
+        self.dropped = 0
+        # 最近一次收到客户端帧的时间 (time.monotonic)，用于存活检测
+        self.last_seen_at = time.monotonic()
+
 
 class ConnectionManager:
-    def __init__(self):
-        # 使用字典来存储活跃的连接，键为 user_id，值为 WebSocket 对象
-        self.active_connections: Dict[int, WebSocket] = {}
+    def __init__(
+        self,
+        high_watermark: int = OUTBOUND_QUEUE_HIGH_WATERMARK,
+        low_watermark: int = OUTBOUND_QUEUE_LOW_WATERMARK,
+        slow_consumer_policy: str = SLOW_CONSUMER_POLICY,
+        bus: Optional[MessageBus] = None,
+        ping_interval: float = WS_PING_INTERVAL_SECONDS,
+        ping_timeout: float = WS_PING_TIMEOUT_SECONDS,
+        delivery: Optional[DeliveryBuffer] = None,
+    ):
+        if slow_consumer_policy not in SLOW_CONSUMER_POLICIES:
+            raise ValueError(f"未知的慢消费者策略: {slow_consumer_policy}")
+        if not 0 <= low_watermark < high_watermark:
+            raise ValueError("低水位必须小于高水位")
+        if not 0 < ping_interval < ping_timeout:
+            raise ValueError("ping 间隔必须小于存活超时")
+        # 每个用户的设备会话列表，键为 user_id。同一用户可以同时在多个设备上登录，
+        # 列表长度即该用户在本 worker 上的在线引用计数。
+        self._sessions: Dict[int, List[_Connection]] = {}
+        self._session_ids = itertools.count(1)
+        # 已断开会话的累计投递统计
+        self._retired_delivered = 0
+        self._retired_dropped = 0
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.slow_consumer_policy = slow_consumer_policy
+        # 消息总线负责跨 worker 路由；单 worker 部署时使用进程内总线
+        self.bus = bus if bus is not None else create_message_bus()
+        self.ping_interval = ping_interval
+        self.ping_timeout = ping_timeout
+        self._liveness_task: Optional[asyncio.Task] = None
+        # 可靠投递消息的序号和未确认缓冲区
+        self.delivery = delivery if delivery is not None else DeliveryBuffer()
+        self._undelivered_handler: Optional[UndeliveredHandler] = None
+        # 正在进行的转存任务，保留引用以免被提前回收
+        self._spill_tasks: set = set()
+
+    def set_undelivered_handler(self, handler: UndeliveredHandler):
+        """注册未确认消息的转存回调（例如写入离线消息）。"""
+        self._undelivered_handler = handler
+
+    async def start(self):
+        """
+        启动消息总线（并把本地投递/广播回调注册给它）和存活检测任务。应在应用启动时调用。
+        """
+        await self.bus.start(self._deliver_local, self._broadcast_local)
+        self._liveness_task = asyncio.create_task(self._liveness_loop())
+
+    async def close(self):
+        """
+        停止存活检测并关闭消息总线，然后把所有仍未确认的可靠消息转存。应在应用关闭时调用。
+        """
+        if self._liveness_task is not None:
+            self._liveness_task.cancel()
+            self._liveness_task = None
+        await self.bus.close()
+        for user_id, messages in self.delivery.drain():
+            self._spill(user_id, messages)
+        if self._spill_tasks:
+            await asyncio.gather(*self._spill_tasks, return_exceptions=True)
+
+    async def connect(
+        self, websocket: WebSocket, user_id: int, device: Optional[str] = None, protocol: Optional[str] = None
+    ) -> Tuple[int, bool]:
+        """
+        接受新的WebSocket连接（并确认协商好的子协议），为其创建一个设备会话并启动写协程。
+        同一用户的已有会话不受影响。
+        :return: (会话ID, 是否为该用户在本 worker 上的第一个设备)
+        """
+        await websocket.accept(subprotocol=protocol)
+        conn = _Connection(next(self._session_ids), websocket, device, protocol)
+        conn.writer_task = asyncio.create_task(self._writer(conn))
+        sessions = self._sessions.setdefault(user_id, [])
+        sessions.append(conn)
+        first_device = len(sessions) == 1
+        if first_device:
+            self.delivery.attach(user_id)
+            await self.bus.register(user_id)
+        print(f"用户 {user_id} 的WebSocket已连接 (会话 {conn.session_id}，设备数 {len(sessions)})。当前在线人数: {len(self._sessions)}")
+        return conn.session_id, first_device
+
+    async def disconnect(self, user_id: int, session_id: int) -> bool:
+        """
+        断开指定用户的某个设备会话，并停止其写协程。
+        最后一个设备断开时向总线注销该用户：注销帧在返回前按调用顺序写出，
+        之后同一用户重新连接时的登记帧一定排在它后面，代理不会在重连后误删路由。
+        :return: 是否为该用户在本 worker 上的最后一个设备
+        """
+        sessions = self._sessions.get(user_id)
+        if not sessions:
+            return False
+        for conn in sessions:
+            if conn.session_id == session_id:
+                sessions.remove(conn)
+                self._close_connection(conn)
+                self._retired_delivered += conn.delivered
+                self._retired_dropped += conn.dropped
+                break
+        else:
+            return False
+
+        last_device = not sessions
+        if last_device:
+            del self._sessions[user_id]
+            self.delivery.detach(user_id)
+            await self.bus.unregister(user_id)
+        print(f"用户 {user_id} 的WebSocket已断开 (会话 {session_id}，剩余设备数 {len(sessions)})。当前在线人数: {len(self._sessions)}")
+        return last_device
+
+    def mark_alive(self, user_id: int, session_id: int):
+        """记录收到了某个会话的客户端帧（任何帧，包括 pong）。"""
+        for conn in self._sessions.get(user_id, ()):
+            if conn.session_id == session_id:
+                conn.last_seen_at = time.monotonic()
+                return
+
+    def ack(self, user_id: int, seq: int):
+        """客户端确认已处理序号 <= seq 的可靠消息（累积确认，任意设备的确认对所有设备生效）。"""
+        self.delivery.ack(user_id, seq)
+
+    def resume(self, user_id: int, session_id: int, resume_from: Optional[int] = None) -> int:
+        """
+        设备连接后调用：把序号大于 resume_from、仍未确认的可靠消息重发到该设备会话。
+        :return: 重发的消息数
+        """
+        messages = self.delivery.resume(user_id, resume_from)
+        for conn in self._sessions.get(user_id, ()):
+            if conn.session_id == session_id:
+                for message in messages:
+                    self._enqueue(conn, message, None)
+                break
+        return len(messages)
 
-    async def connect(self, websocket: WebSocket, user_id: int):
+    def _spill(self, user_id: int, messages: List[OutboundMessage]):
+        """把未确认的可靠消息交给转存回调。"""
+        if not messages:
+            return
+        if self._undelivered_handler is None:
+            print(f"没有注册转存回调，丢弃用户 {user_id} 的 {len(messages)} 条未确认消息。")
+            return
+        task = asyncio.create_task(self._undelivered_handler(user_id, messages))
+        self._spill_tasks.add(task)
+        task.add_done_callback(self._spill_tasks.discard)
+
+    async def _liveness_loop(self):
+        """
+        定期向所有本地会话发送 ping，并关闭超时未响应的会话。
+        ping 使用固定的合并键，拥塞的队列里最多只有一个待发送的 ping。
+        """
+        ping = json.dumps({"type": "ping"})
+        while True:
+            await asyncio.sleep(self.ping_interval)
+            deadline = time.monotonic() - self.ping_timeout
+            for user_id, sessions in list(self._sessions.items()):
+                for conn in list(sessions):
+                    if conn.closed:
+                        continue
+                    if conn.last_seen_at < deadline:
+                        print(f"用户 {user_id} 的会话 {conn.session_id} 超过 {self.ping_timeout}s 未响应，关闭连接。")
+                        self._close_connection(conn, code=status.WS_1001_GOING_AWAY)
+                    else:
+                        self._enqueue(conn, ping, "ping")
+            # 断线超过宽限期仍未重连的用户，未确认消息转存为离线消息
+            for user_id, messages in self.delivery.expire():
+                self._spill(user_id, messages)
+
+    def is_connected(self, user_id: int) -> bool:
+        """用户是否在本 worker 上至少有一个设备会话。"""
+        return user_id in self._sessions
+
+    async def is_online_elsewhere(self, user_id: int) -> bool:
+        """用户是否在其他 worker 上仍有设备会话（单 worker 部署时总为 False）。"""
+        return await self.bus.is_online_elsewhere(user_id)
+
+    async def send_personal_message(
+        self, message: OutboundMessage, user_id: int, coalesce_key: Optional[str] = None, reliable: bool = False
+    ) -> bool:
+        """
+        向指定用户发送个人消息，用户可能连接在任意一个 worker 上。
+        消息只会被放入该用户的出站队列，不会等待网络发送完成，由每个设备的写协程按其协议编码。
+        reliable 为 True 时（消息必须是 JSON 对象或 Envelope），消息带上总线为该接收者分配的 "seq" 字段，
+        由接收者所在的 worker 保留到客户端确认；未确认的消息可以在重连时续传，最终未送达的会交给转存回调。
+        :return: 消息是否已被投递到某个出站队列（用户不在线或被慢消费者策略丢弃时为 False）
+        """
+        return await self.bus.send_personal(user_id, message, coalesce_key, reliable)
+
+    async def send_to_session(self, user_id: int, session_id: int, message: OutboundMessage) -> bool:
+        """
+        只向用户的某一个设备会话发送消息（例如离线消息推送、发给发送方设备的回执）。
+        会话总是位于当前 worker 上，因此不经过消息总线。
+        """
+        for conn in self._sessions.get(user_id, ()):
+            if conn.session_id == session_id:
+                return self._enqueue(conn, message, None)
+        return False
+
+    async def broadcast(self, message: str, coalesce_key: Optional[str] = None):
+        """
+        向所有 worker 上的所有在线用户广播消息。
         """
-        接受新的WebSocket连接并将其与用户ID关联。
+        await self.bus.broadcast(message, coalesce_key)
+
+    async def _deliver_local(
+        self, user_id: int, message: OutboundMessage, coalesce_key: Optional[str], seq: Optional[int] = None
+    ) -> bool:
+        """
+        消息总线的本地投递回调：扇出到本进程中该用户所有设备会话的出站队列。
+        可靠消息（seq 不为 None）先加上序号，至少一个设备接收后才记入未确认缓冲区；
+        没有设备接收时返回 False，由发送方走离线消息流程。
+        :return: 是否至少有一个设备接收了该消息
         """
-        await websocket.accept()
-        self.active_connections[user_id] = websocket
-        print(f"用户 {user_id} 的WebSocket已连接。当前在线人数: {len(self.active_connections)}")
+        sessions = self._sessions.get(user_id)
+        if not sessions:
+            return False
+        if seq is not None:
+            message = self.delivery.stamp(message, seq)
+        accepted = False
+        for conn in list(sessions):
+            if self._enqueue(conn, message, coalesce_key):
+                accepted = True
+        if seq is not None and accepted:
+            self._spill(user_id, self.delivery.record(user_id, seq, message))
+        return accepted
 
-    def disconnect(self, user_id: int):
+    async def _broadcast_local(self, message: str, coalesce_key: Optional[str]):
         """
-        断开指定用户的WebSocket连接。
+        消息总线的本地广播回调。
+        每个接收者只是入队，因此单个慢速或已断开的连接不会拖慢整个广播。
         """
-        if user_id in self.active_connections:
-            del self.active_connections[user_id]
-            print(f"用户 {user_id} 的WebSocket已断开。当前在线人数: {len(self.active_connections)}")
+        # 创建一个要迭代的会话列表副本，以防在迭代期间会话发生变化
+        connections_to_broadcast = [conn for sessions in self._sessions.values() for conn in sessions]
+        for conn in connections_to_broadcast:
+            self._enqueue(conn, message, coalesce_key)
 
-    async def send_personal_message(self, message: str, user_id: int):
+    def stats(self) -> dict:
         """
-        向指定用户发送个人消息。
+        本 worker 上的会话和出站队列统计（供 /metrics 使用）。
+        delivered/dropped 为累计值，包括已断开的会话；其余为当前值。
         """
-        websocket = self.active_connections.get(user_id)
-        if websocket:
-            await websocket.send_text(message)
+        connections = [conn for sessions in self._sessions.values() for conn in sessions]
+        depths = [len(conn.queue) for conn in connections]
+        return {
+            "users": len(self._sessions),
+            "sessions": len(connections),
+            "queued": sum(depths),
+            "max_queue_depth": max(depths, default=0),
+            "congested": sum(conn.congested for conn in connections),
+            "delivered": self._retired_delivered + sum(conn.delivered for conn in connections),
+            "dropped": self._retired_dropped + sum(conn.dropped for conn in connections),
+            "slow_consumer_policy": self.slow_consumer_policy,
+        }
 
-    async def broadcast(self, message: str):
+    def _enqueue(self, conn: _Connection, message: OutboundMessage, coalesce_key: Optional[str]) -> bool:
         """
-        向所有在线用户广播消息。
-        通过为每个发送操作添加 try-except 块来增强健壮性，
-        以防止单个断开的连接中断整个广播。
+        将消息放入连接的出站队列，并在拥塞时应用慢消费者策略。
         """
-        # 创建一个要迭代的连接列表副本，以防在迭代期间 active_connections 发生变化
-        connections_to_broadcast = list(self.active_connections.values())
-        for connection in connections_to_broadcast:
-            try:
-                await connection.send_text(message)
-            except Exception as e:
-                # 如果发送失败（例如，连接已意外关闭），则打印错误但继续
-                print(f"向某个客户端广播消息时出错: {e}")
+        if conn.closed:
+            return False
+
+        if not conn.congested and len(conn.queue) >= self.high_watermark:
+            conn.congested = True
+
+        if conn.congested:
+            if self.slow_consumer_policy == "disconnect":
+                print(f"出站队列超过高水位 ({self.high_watermark})，断开慢速连接 (会话 {conn.session_id})。")
+                conn.dropped += 1
+                self._close_connection(conn, code=status.WS_1013_TRY_AGAIN_LATER)
+                return False
+            if self.slow_consumer_policy == "coalesce" and coalesce_key is not None:
+                pending = conn.pending_keys.get(coalesce_key) if conn.pending_keys else None
+                if pending is not None:
+                    # 原地替换队列中尚未发送的同 key 消息
+                    pending[1] = message
+                    conn.dropped += 1
+                    return True
+                # 没有可合并的旧消息时，允许在硬上限内入队
+                if len(conn.queue) < self.high_watermark * 2:
+                    self._append(conn, message, coalesce_key)
+                    return True
+            conn.dropped += 1
+            return False
+
+        self._append(conn, message, coalesce_key)
+        return True
+
+    def _append(self, conn: _Connection, message: OutboundMessage, coalesce_key: Optional[str]):
+        entry = [coalesce_key, message]
+        conn.queue.append(entry)
+        if coalesce_key is not None:
+            if conn.pending_keys is None:
+                conn.pending_keys = {}
+            conn.pending_keys[coalesce_key] = entry
+        conn.wakeup.set()
+
+    async def _writer(self, conn: _Connection):
+        """
+        写协程：按顺序排空连接的出站队列，按会话协议编码为文本帧或二进制帧。
+        """
+        try:
+            while not conn.closed:
+                if not conn.queue:
+                    conn.wakeup.clear()
+                    await conn.wakeup.wait()
+                    continue
+                entry = conn.queue.popleft()
+                coalesce_key, message = entry
+                if coalesce_key is not None and conn.pending_keys and conn.pending_keys.get(coalesce_key) is entry:
+                    del conn.pending_keys[coalesce_key]
+                if conn.congested and len(conn.queue) <= self.low_watermark:
+                    conn.congested = False
+                try:
+                    frame = encode(message, conn.protocol)
+                except ValueError as e:
+                    # 分离的消息体没有经过服务器解码，只有在需要转换格式时才会发现它无效，此时只丢弃这条消息
+                    print(f"无法编码发往会话 {conn.session_id} 的消息，已丢弃: {e}")
+                    conn.dropped += 1
+                    continue
+                if isinstance(frame, str):
+                    await conn.websocket.send_text(frame)
+                else:
+                    await conn.websocket.send_bytes(frame)
+                conn.delivered += 1
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            # 发送失败（例如连接已意外关闭），停止写协程，连接的清理由接收循环负责
+            print(f"向客户端发送消息时出错: {e}")
+            conn.closed = True
+
+    def _close_connection(self, conn: _Connection, code: Optional[int] = None):
+        """
+        停止连接的写协程并丢弃未发送的消息；如果给出 code，则同时主动关闭 WebSocket。
+        """
+        conn.closed = True
+        conn.queue.clear()
+        conn.pending_keys = None
+        if code is not None:
+            asyncio.create_task(self._close_websocket(conn.websocket, code))
+        if conn.writer_task is not None and not conn.writer_task.done():
+            if code is None:
+                conn.writer_task.cancel()
+            else:
+                conn.wakeup.set()
+
+    async def _close_websocket(self, websocket: WebSocket, code: int):
+        try:
+            await websocket.close(code=code)
+        except Exception:
+            pass
 
 # 创建一个ConnectionManager的全局单例
 # 这样在整个应用中，我们都将使用这同一个管理器实例
-manager = ConnectionManager() 
\ No newline at end of file
+manager = ConnectionManager()
@@ -0,0 +1,65 @@
+import asyncio
+import json
+from datetime import datetime
+from typing import List, Optional, Set, Tuple
+
+from . import crud
+from .change_log import CHANGE_CONTACT, CHANGE_REQUEST
+from .connection_manager import manager
+
+# 增量同步日志中的变更类型 -> WebSocket 事件类型
+CONTACT_EVENT_TYPES = {
+    CHANGE_REQUEST: "friend_request",
+    CHANGE_CONTACT: "contact_update",
+}
+
+
+class ContactEventPusher:
+    """
+    好友请求和好友关系变化的实时推送：订阅增量同步日志，把 request/contact 变更
+    作为带类型的事件推送到受影响用户的所有在线设备，客户端不再需要轮询联系人接口。
+    变更在数据库线程中产生，推送被转交给事件循环执行。
+    客户端断线期间错过的事件由重连后的 GET /me/sync 补齐。
+    """
+
+    def __init__(self):
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        # 正在进行的推送任务，保留引用以免被提前回收
+        self._tasks: Set[asyncio.Task] = set()
+
+    def start(self):
+        """订阅变更日志。应在事件循环中调用（应用启动时）。"""
+        self._loop = asyncio.get_running_loop()
+        crud.change_log.add_listener(self._on_change)
+
+    def close(self):
+        crud.change_log.remove_listener(self._on_change)
+        self._loop = None
+
+    def _on_change(self, kind: str, changes: List[Tuple[int, dict]]):
+        event_type = CONTACT_EVENT_TYPES.get(kind)
+        loop = self._loop
+        if event_type is None or loop is None:
+            return
+        timestamp = datetime.utcnow().isoformat()
+        messages = [
+            (user_id, json.dumps({**change, "type": event_type, "timestamp": timestamp}))
+            for user_id, change in changes
+        ]
+        loop.call_soon_threadsafe(self._schedule, messages)
+
+    def _schedule(self, messages: List[Tuple[int, str]]):
+        task = asyncio.create_task(self._push(messages))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _push(self, messages: List[Tuple[int, str]]):
+        for user_id, message in messages:
+            try:
+                await manager.send_personal_message(message, user_id)
+            except Exception as e:
+                print(f"推送好友事件给用户 {user_id} 时出错: {e}")
+
+
+# 全局单例
+contact_event_pusher = ContactEventPusher()
@@ -1,11 +1,18 @@
-from typing import Optional
+import json
+from typing import Callable, Optional
 from datetime import datetime
 # 导入 SQLAlchemy 的 Session 用于类型提示
 from sqlalchemy.orm import Session
+from sqlalchemy import String, case, delete, func, insert, update, bindparam, type_coerce
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 # 从同级目录导入 models, schemas, 和 auth 模块
 import models
 import schemas
-import auth
+from ciphertext import content_kind
+from user_directory import UserEntry, user_directory
+from friend_graph import friend_graph
+from user_search import user_search_index
+from change_log import CHANGE_CONTACT, CHANGE_PRESENCE, CHANGE_REQUEST, change_log
 
 # --- 用户相关的 CRUD (Create, Read, Update, Delete) 操作 ---
 
@@ -27,6 +34,53 @@ def get_user_by_username(db: Session, username: str):
     """
     return db.query(models.User).filter(models.User.username == username).first()
 
+def get_user_entry_by_username(db: Session, username: str) -> Optional[UserEntry]:
+    """
+    通过用户目录缓存按用户名查询用户的 ID 和用户名。
+    未命中时只查询 id、username 两列，不加载 password_hash、public_key 等字段。
+    :param db: 数据库会话
+    :param username: 用户名
+    :return: UserEntry 或 None
+    """
+    def load() -> Optional[UserEntry]:
+        row = db.query(models.User.id, models.User.username).filter(models.User.username == username).first()
+        return UserEntry(row[0], row[1]) if row else None
+    return user_directory.get_by_username(username, load)
+
+def get_user_entry(db: Session, user_id: int) -> Optional[UserEntry]:
+    """
+    通过用户目录缓存按用户 ID 查询用户的 ID 和用户名。
+    :param db: 数据库会话
+    :param user_id: 用户 ID
+    :return: UserEntry 或 None
+    """
+    def load() -> Optional[UserEntry]:
+        row = db.query(models.User.id, models.User.username).filter(models.User.id == user_id).first()
+        return UserEntry(row[0], row[1]) if row else None
+    return user_directory.get_by_id(user_id, load)
+
+def get_user_entries(db: Session, user_ids: list[int]) -> dict[int, UserEntry]:
+    """
+    通过用户目录缓存按用户 ID 批量查询用户的 ID 和用户名，不存在的用户不出现在结果中。
+    :param db: 数据库会话
+    :param user_ids: 用户 ID 列表
+    :return: user_id -> UserEntry
+    """
+    entries = {}
+    for user_id in user_ids:
+        entry = get_user_entry(db, user_id)
+        if entry is not None:
+            entries[user_id] = entry
+    return entries
+
+def get_cached_user_entry(username: str) -> Optional[UserEntry]:
+    """
+    只查询用户目录缓存，不访问数据库。供事件循环上的代码在命中时跳过数据库线程。
+    :param username: 用户名
+    :return: 缓存中的 UserEntry，未命中时为 None
+    """
+    return user_directory.peek_by_username(username)
+
 def get_user_by_email(db: Session, email: str):
     """
     根据邮箱从数据库中查询用户
@@ -46,30 +100,49 @@ def get_users(db: Session, skip: int = 0, limit: int = 100):
     """
     return db.query(models.User).offset(skip).limit(limit).all()
 
-def search_users_by_username(db: Session, username_query: str, skip: int = 0, limit: int = 10):
+def search_users_by_username(db: Session, username_query: str, after: Optional[str] = None, limit: int = 10) -> list[UserEntry]:
     """
-    根据用户名模糊搜索用户
+    根据用户名关键词搜索用户，使用内存 n-gram 索引。
+    搜索前先把其他 worker 注册的新用户补进索引（按主键的范围查询，通常没有结果），然后只在索引中查找。
+    结果按完全匹配、前缀匹配、子串匹配排序，以上一页最后一个用户名作为游标分页。
     :param db: 数据库会话
     :param username_query: 用户名搜索关键词
-    :param skip: 跳过的记录数
+    :param after: 上一页最后一个用户名
     :param limit: 返回的最大记录数
-    :return: User 对象列表
+    :return: UserEntry 列表
     """
-    return db.query(models.User).filter(
-        models.User.username.ilike(f"%{username_query}%")
-    ).offset(skip).limit(limit).all()
+    catch_up_user_search_index(db)
+    return [UserEntry(user_id, username) for user_id, username in user_search_index.search(username_query, after, limit)]
+
+def load_user_search_index(db: Session) -> int:
+    """
+    从 users 表加载所有用户名，重建用户搜索索引。应在应用启动时调用。
+    :return: 加载的用户数
+    """
+    rows = db.query(models.User.id, models.User.username).yield_per(10000)
+    users = [(user_id, username) for user_id, username in rows]
+    user_search_index.load(users)
+    return len(users)
+
+def catch_up_user_search_index(db: Session) -> int:
+    """
+    把 ID 大于索引 high_water 的用户（例如在其他 worker 上注册的）加入用户搜索索引。
+    :return: 新加入索引的用户数
+    """
+    rows = db.query(models.User.id, models.User.username).filter(
+        models.User.id > user_search_index.high_water
+    ).order_by(models.User.id)
+    return user_search_index.catch_up(rows.all())
 
-def create_user(db: Session, user_data: schemas.UserCreate, ip_address: str):
+def create_user(db: Session, user_data: schemas.UserCreate, ip_address: str, hashed_password: str):
     """
     在数据库中创建新用户
     :param db: 数据库会话
     :param user_data: 包含用户信息的 Pydantic 模型 (UserCreate)
     :param ip_address: 用户的IP地址
+    :param hashed_password: 已经哈希过的密码（由调用方在 bcrypt 进程池中计算）
     :return: 创建的 User 对象
     """
-    # 从传入的 Pydantic 模型中获取明文密码，并进行哈希处理
-    hashed_password = auth.get_password_hash(user_data.password)
-    
     # 使用 Pydantic 模型的数据和哈希后的密码，创建一个 SQLAlchemy User 模型实例
     db_user = models.User(
         username=user_data.username,
@@ -85,6 +158,9 @@ def create_user(db: Session, user_data: schemas.UserCreate, ip_address: str):
     db.commit()
     # 刷新 db_user 实例，以获取数据库生成的新数据（如 ID）
     db.refresh(db_user)
+    # 用户名可能曾被缓存为其他用户（例如被删除后重新注册），显式失效
+    user_directory.invalidate(username=db_user.username)  # type: ignore
+    user_search_index.add(db_user.id, db_user.username)  # type: ignore
     return db_user
 
 def update_user_status(db: Session, user: models.User, is_online: bool, ip_address: Optional[str] = None, port: Optional[int] = None):
@@ -108,9 +184,65 @@ def update_user_status(db: Session, user: models.User, is_online: bool, ip_addre
     db.add(user)
     db.commit()
     db.refresh(user)
+    user_directory.invalidate(user_id=user.id)  # type: ignore
     return user
 
-# --- 联系人相关的 CRUD (待实现) ---
+def update_user_connection(db: Session, user_id: int, is_online: bool, ip_address: Optional[str] = None, port: Optional[int] = None):
+    """
+    用单条 UPDATE 更新用户的在线状态、IP 地址和端口号，不需要先加载 User 对象。
+    :param db: 数据库会话
+    :param user_id: 用户 ID
+    :param is_online: 是否在线
+    :param ip_address: IP 地址
+    :param port: 端口号
+    """
+    values: dict = {"is_online": is_online, "ip_address": ip_address, "port": port}
+    if is_online:
+        values["last_seen"] = datetime.utcnow()
+    db.query(models.User).filter(models.User.id == user_id).update(values, synchronize_session=False)
+    db.commit()
+    user_directory.invalidate(user_id=user_id)
+
+# SQLite 对单条语句的参数个数有上限，批量 IN 查询按此大小分块
+IN_CLAUSE_CHUNK_SIZE = 500
+
+def get_online_user_last_seen(db: Session) -> list[tuple]:
+    """
+    获取数据库中记录为在线的所有用户及其 last_seen，用于启动时恢复内存在线状态表。
+    :return: (user_id, last_seen) 元组列表
+    """
+    rows = db.query(models.User.id, models.User.last_seen).filter(models.User.is_online == True).all()
+    return [tuple(row) for row in rows]
+
+def bulk_set_users_online(
+    db: Session, online_ids: list[int], offline_ids: list[int], transitions: Optional[dict[int, bool]] = None
+):
+    """
+    用批量 UPDATE 同步一批用户的在线状态，只提交一次。上线的用户同时刷新 last_seen。
+    :param db: 数据库会话
+    :param online_ids: 需要标记为在线的用户 ID 列表
+    :param offline_ids: 需要标记为离线的用户 ID 列表
+    :param transitions: 上线/离线的转变 (user_id -> 是否在线)，在同一事务中记入好友的增量同步日志
+    """
+    now = datetime.utcnow()
+    for start in range(0, len(online_ids), IN_CLAUSE_CHUNK_SIZE):
+        chunk = online_ids[start:start + IN_CLAUSE_CHUNK_SIZE]
+        db.query(models.User).filter(models.User.id.in_(chunk)).update(
+            {"is_online": True, "last_seen": now}, synchronize_session=False
+        )
+    for start in range(0, len(offline_ids), IN_CLAUSE_CHUNK_SIZE):
+        chunk = offline_ids[start:start + IN_CLAUSE_CHUNK_SIZE]
+        db.query(models.User).filter(models.User.id.in_(chunk)).update(
+            {"is_online": False}, synchronize_session=False
+        )
+    recorded = change_log.record(db, CHANGE_PRESENCE, [
+        (None, user_id, {"user_id": user_id, "is_online": is_online})
+        for user_id, is_online in (transitions or {}).items()
+    ])
+    db.commit()
+    change_log.notify(CHANGE_PRESENCE, recorded)
+
+# --- 联系人相关的 CRUD ---
 
 def add_contact(db: Session, user_id: int, friend_id: int) -> Optional[models.Contact]:
     """
@@ -138,14 +270,17 @@ def add_contact(db: Session, user_id: int, friend_id: int) -> Optional[models.Co
     if not friend_user:
         return None
 
+    # 新请求总是 pending，好友邻接索引只在接受时 (update_contact_status) 才增加边
     db_contact = models.Contact(
         user_id=user_id,
         friend_id=friend_id,
         status="pending"  # 默认为待处理
     )
     db.add(db_contact)
+    recorded = change_log.record(db, CHANGE_REQUEST, [(friend_id, user_id, {"user_id": user_id, "status": "pending"})])
     db.commit()
     db.refresh(db_contact)
+    change_log.notify(CHANGE_REQUEST, recorded)
     return db_contact
 
 def get_contacts(db: Session, user_id: int, skip: int = 0, limit: int = 100):
@@ -210,8 +345,19 @@ def update_contact_status(db: Session, user_id: int, friend_id: int, status: str
             )
             db.add(reciprocal_contact)
 
+    requests = change_log.record(db, CHANGE_REQUEST, [(user_id, friend_id, {"user_id": friend_id, "status": status})])
+    contacts = []
+    if status == "accepted":
+        contacts = change_log.record(db, CHANGE_CONTACT, [
+            (user_id, friend_id, {"friend_id": friend_id, "status": "accepted"}),
+            (friend_id, user_id, {"friend_id": user_id, "status": "accepted"}),
+        ])
     db.commit()
     db.refresh(contact_request)
+    if status == "accepted":
+        friend_graph.add_edge(user_id, friend_id)
+    change_log.notify(CHANGE_REQUEST, requests)
+    change_log.notify(CHANGE_CONTACT, contacts)
     return contact_request
 
 def delete_contact(db: Session, user_id: int, friend_id: int) -> bool:
@@ -228,50 +374,226 @@ def delete_contact(db: Session, user_id: int, friend_id: int) -> bool:
     if not contacts_to_delete:
         return False # 没有找到关系
 
+    # 提交前记下被删除的关系，用于生成增量同步的变更：已接受的关系通知双方，待处理的请求通知接收者
+    removed_contacts = []
+    removed_requests = []
     for contact in contacts_to_delete:
+        if contact.status == "accepted":  # type: ignore
+            removed_contacts.append((contact.user_id, contact.friend_id, {"friend_id": contact.friend_id, "status": "deleted"}))
+        else:
+            removed_requests.append((contact.friend_id, contact.user_id, {"user_id": contact.user_id, "status": "deleted"}))
         db.delete(contact)
-    
+    contacts = change_log.record(db, CHANGE_CONTACT, removed_contacts)
+    requests = change_log.record(db, CHANGE_REQUEST, removed_requests)
+
     db.commit()
+    friend_graph.remove_edge(user_id, friend_id)
+    change_log.notify(CHANGE_CONTACT, contacts)
+    change_log.notify(CHANGE_REQUEST, requests)
     return True
 
-def get_online_friends(db: Session, user_id: int) -> list[models.User]:
+def get_sync_snapshot(db: Session, user_id: int) -> tuple:
     """
-    获取指定用户的所有在线好友。
+    全量同步时使用的快照：所有已接受的好友关系和所有收到的待处理请求（不分页）。
+    先取版本号再读取快照，读取期间发生的变更会在下一次增量同步中重复出现（按最终状态应用是幂等的）。
+    :return: (版本号, 好友关系列表, 待处理请求列表)
     """
-    # 步骤 1: 获取当前用户所有已接受的好友的 ID 列表
-    friend_ids_query = db.query(models.Contact.friend_id).filter(
+    version = change_log.version(db)
+    contacts = db.query(models.Contact).filter(
         models.Contact.user_id == user_id,
         models.Contact.status == "accepted"
-    )
-    friend_ids = [item[0] for item in friend_ids_query.all()]
+    ).all()
+    pending = db.query(models.Contact).filter(
+        models.Contact.friend_id == user_id,
+        models.Contact.status == "pending"
+    ).all()
+    return version, contacts, pending
+
+def get_online_friends(db: Session, user_id: int, is_online: Callable[[int], bool]) -> list[models.User]:
+    """
+    获取指定用户的所有在线好友。
+    好友关系来自内存邻接索引（先追上其他 worker 的变化），在线状态由调用方提供的判断函数决定（内存在线状态表），
+    只有存在在线好友时才按主键加载这些好友的连接信息。
+    :param db: 数据库会话
+    :param user_id: 用户ID
+    :param is_online: user_id -> 是否在线
+    """
+    catch_up_friend_graph(db)
+    friend_ids = [friend_id for friend_id in friend_graph.friends(user_id) if is_online(friend_id)]
 
     if not friend_ids:
         return []
 
-    # 步骤 2: 从好友 ID 列表中，查询所有在线的用户
-    online_friends = db.query(models.User).filter(
-        models.User.id.in_(friend_ids),
-        models.User.is_online == True
-    ).all()
-
+    online_friends = []
+    for start in range(0, len(friend_ids), IN_CLAUSE_CHUNK_SIZE):
+        online_friends.extend(db.query(models.User).filter(
+            models.User.id.in_(friend_ids[start:start + IN_CLAUSE_CHUNK_SIZE])
+        ).all())
     return online_friends
 
+def load_friend_graph(db: Session) -> int:
+    """
+    从 contacts 表加载所有已接受的好友关系，重建内存邻接索引。应在应用启动时调用。
+    :return: 加载的关系行数
+    """
+    rows = db.query(models.Contact.user_id, models.Contact.friend_id).filter(
+        models.Contact.status == "accepted"
+    ).yield_per(10000)
+    count = 0
+
+    def edges():
+        nonlocal count
+        for user_id, friend_id in rows:
+            count += 1
+            yield user_id, friend_id
+
+    # 先取日志版本号再读取 contacts 表，读取期间的变化会在追赶时重复应用（幂等）
+    version = change_log.version(db)
+    friend_graph.load(edges(), version)
+    return count
+
+def catch_up_friend_graph(db: Session) -> int:
+    """
+    把增量同步日志中版本号大于索引 version 的好友关系变化（例如在其他 worker 上接受或删除的好友）应用到内存邻接索引。
+    日志按 (类型, 接收者, 对象) 压缩，同一关系只有最终状态这一行。
+    :return: 应用的变化条数
+    """
+    rows = db.query(
+        models.SyncChange.version, models.SyncChange.user_id, models.SyncChange.subject_id, models.SyncChange.payload
+    ).filter(
+        models.SyncChange.kind == CHANGE_CONTACT,
+        models.SyncChange.version > friend_graph.version,
+    ).order_by(models.SyncChange.version).all()
+    return friend_graph.apply(
+        (version, user_id, friend_id, json.loads(payload)["status"] == "accepted")
+        for version, user_id, friend_id, payload in rows
+    )
+
 # --- 消息相关的 CRUD ---
 
-def create_message(db: Session, sender_id: int, receiver_id: int, encrypted_content: str) -> models.Message:
+def create_message(db: Session, sender_id: int, receiver_id: int, encrypted_content: str):
     """
-    在数据库中创建一条新的消息记录。
+    在数据库中创建一条新的消息记录，并在同一事务中更新双方的会话摘要。
     默认情况下，新消息的 is_read 状态为 False。
+    :return: 插入的消息行 (id, sender_id, receiver_id, encrypted_content, content_kind, sent_at)
     """
-    db_message = models.Message(
-        sender_id=sender_id,
-        receiver_id=receiver_id,
-        encrypted_content=encrypted_content
-    )
-    db.add(db_message)
+    inserted = _insert_messages(db, [{
+        "sender_id": sender_id,
+        "receiver_id": receiver_id,
+        "encrypted_content": encrypted_content,
+    }])
     db.commit()
-    db.refresh(db_message)
-    return db_message
+    return inserted[0]
+
+def create_messages(db: Session, rows: list[dict]):
+    """
+    在一个事务中批量插入多条消息（多行 INSERT），并更新相关的会话摘要，只提交一次。
+    :param db: 数据库会话
+    :param rows: 每项包含 sender_id、receiver_id、encrypted_content 的字典列表，可以带 delivery_id
+    """
+    if not rows:
+        return
+    _insert_messages(db, rows)
+    db.commit()
+
+def _insert_messages(db: Session, rows: list[dict]) -> list:
+    """
+    插入消息（不提交），通过 RETURNING 取回消息 ID 和发送时间，用于更新会话摘要。
+    内容的种类按值的类型记录：只有以 bin 收到的 bytes 是二进制，文本即使看起来像 base64 也原样保存。
+    """
+    for row in rows:
+        row.setdefault("conversation_key", models.conversation_key(row["sender_id"], row["receiver_id"]))
+        row.setdefault("content_kind", content_kind(row["encrypted_content"]))
+    inserted = db.execute(
+        insert(models.Message).returning(
+            models.Message.id,
+            models.Message.sender_id,
+            models.Message.receiver_id,
+            models.Message.encrypted_content,
+            models.Message.content_kind,
+            models.Message.sent_at,
+        ),
+        rows,
+    ).all()
+    _record_conversation_messages(db, inserted)
+    return inserted
+
+def _record_conversation_messages(db: Session, messages: list):
+    """
+    把新消息合并进会话摘要：双方的最后一条消息都更新为其中 ID 最大的一条，
+    接收方的未读数加上收到的条数。同一批次中同一会话的多条消息合并为一次 upsert。
+    """
+    # (user_id, peer_id) -> [最后一条消息 ID, 发送时间, 新增未读数]
+    summaries: dict[tuple, list] = {}
+    for message in messages:
+        unread = 0 if message.sender_id == message.receiver_id else 1
+        for user_id, peer_id, unread_delta in (
+            (message.sender_id, message.receiver_id, 0),
+            (message.receiver_id, message.sender_id, unread),
+        ):
+            summary = summaries.get((user_id, peer_id))
+            if summary is None:
+                summaries[(user_id, peer_id)] = [message.id, message.sent_at, unread_delta]
+                continue
+            if message.id > summary[0]:
+                summary[0], summary[1] = message.id, message.sent_at
+            summary[2] += unread_delta
+    if not summaries:
+        return
+
+    conversations = models.Conversation.__table__
+    stmt = sqlite_insert(conversations)
+    # 并发的写入可能乱序提交，只有更新的消息才替换最后一条消息
+    is_newer = stmt.excluded.last_message_id > conversations.c.last_message_id
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[conversations.c.user_id, conversations.c.peer_id],
+        set_={
+            "last_message_id": case((is_newer, stmt.excluded.last_message_id), else_=conversations.c.last_message_id),
+            "last_message_at": case((is_newer, stmt.excluded.last_message_at), else_=conversations.c.last_message_at),
+            "unread_count": conversations.c.unread_count + stmt.excluded.unread_count,
+        },
+    )
+    db.execute(stmt, [
+        {
+            "user_id": user_id,
+            "peer_id": peer_id,
+            "last_message_id": last_message_id,
+            "last_message_at": last_message_at,
+            "unread_count": unread_count,
+        }
+        for (user_id, peer_id), (last_message_id, last_message_at, unread_count) in summaries.items()
+    ])
+
+def get_conversations(db: Session, user_id: int, before: Optional[int] = None, limit: int = 50) -> list[tuple]:
+    """
+    获取用户的会话列表（按最后一条消息从新到旧），一次按 (user_id, last_message_id) 索引读取，
+    对方用户名和最后一条消息内容按主键 JOIN 取得。
+    :param db: 数据库会话
+    :param user_id: 用户 ID
+    :param before: 上一页最后一个会话的 last_message_id，为 None 时从最新的会话开始
+    :param limit: 返回的最大条数
+    :return: (peer_id, peer_username, last_message_id, last_message_at, last_message_sender_id,
+              last_message_content, last_message_content_kind, unread_count) 元组列表
+    """
+    limit = max(1, min(limit, MESSAGE_HISTORY_MAX_LIMIT))
+    query = db.query(
+        models.Conversation.peer_id,
+        models.User.username,
+        models.Conversation.last_message_id,
+        models.Conversation.last_message_at,
+        models.Message.sender_id,
+        models.Message.encrypted_content,
+        models.Message.content_kind,
+        models.Conversation.unread_count,
+    ).join(
+        models.User, models.Conversation.peer_id == models.User.id
+    ).join(
+        models.Message, models.Conversation.last_message_id == models.Message.id
+    ).filter(models.Conversation.user_id == user_id)
+    if before is not None:
+        query = query.filter(models.Conversation.last_message_id < before)
+    rows = query.order_by(models.Conversation.last_message_id.desc()).limit(limit).all()
+    return [tuple(row) for row in rows]
 
 def get_unread_messages_for_user(db: Session, user_id: int) -> list[models.Message]:
     """
@@ -283,11 +605,172 @@ def get_unread_messages_for_user(db: Session, user_id: int) -> list[models.Messa
     ).all()
     return messages
 
+def get_unread_messages_page(db: Session, user_id: int, after: Optional[tuple] = None, limit: int = 100) -> list[tuple]:
+    """
+    按 (sent_at, id) 键集分页获取指定用户的未读离线消息，发送者用户名通过一次 JOIN 取得。
+    :param db: 数据库会话
+    :param user_id: 接收者 ID
+    :param after: 上一页最后一条消息的 (sent_at, id)，为 None 时从头开始
+    :param limit: 返回的最大条数
+    :return: (id, sent_at, encrypted_content, content_kind, sender_username, delivery_id) 元组列表
+    """
+    query = db.query(
+        models.Message.id,
+        models.Message.sent_at,
+        models.Message.encrypted_content,
+        models.Message.content_kind,
+        models.User.username,
+        models.Message.delivery_id,
+    ).join(models.User, models.Message.sender_id == models.User.id).filter(
+        models.Message.receiver_id == user_id,
+        models.Message.is_read == False
+    )
+    if after is not None:
+        after_sent_at, after_id = after
+        # sent_at 由数据库默认值写入，以 'YYYY-MM-DD HH:MM:SS' 文本保存；按 DateTime 绑定的游标会带上
+        # '.000000'，与同一秒的行比较时既不相等也不更大，同一秒内的后续消息会被跳过。
+        # 因此按保存的文本格式比较（isoformat 只在有微秒时输出小数部分），仍然使用同一个索引
+        sent_at_text = type_coerce(models.Message.sent_at, String)
+        after_text = after_sent_at.isoformat(sep=" ")
+        query = query.filter(
+            (sent_at_text > after_text) |
+            ((sent_at_text == after_text) & (models.Message.id > after_id))
+        )
+    rows = query.order_by(models.Message.sent_at, models.Message.id).limit(limit).all()
+    return [tuple(row) for row in rows]
+
+MESSAGE_HISTORY_MAX_LIMIT = 100
+
+def get_conversation_page(db: Session, user_id: int, peer_id: int, before: Optional[int] = None, limit: int = 50) -> list[models.Message]:
+    """
+    按消息 ID 从新到旧键集分页获取两个用户之间的会话历史（两个方向的消息）。
+    查询只使用 (conversation_key, id) 索引上的一段，耗时与表中的消息总数无关。
+    :param db: 数据库会话
+    :param user_id: 当前用户 ID
+    :param peer_id: 对方用户 ID
+    :param before: 上一页最早一条消息的 ID，为 None 时从最新的消息开始
+    :param limit: 返回的最大条数
+    :return: Message 对象列表，按 ID 从新到旧排列
+    """
+    limit = max(1, min(limit, MESSAGE_HISTORY_MAX_LIMIT))
+    query = db.query(models.Message).filter(
+        models.Message.conversation_key == models.conversation_key(user_id, peer_id)
+    )
+    if before is not None:
+        query = query.filter(models.Message.id < before)
+    return query.order_by(models.Message.id.desc()).limit(limit).all()
+
 def mark_messages_as_read(db: Session, message_ids: list[int]):
     """
-    将一组消息标记为已读。
+    将一组消息标记为已读，并在同一事务中扣减相应会话的未读数。
+    只有这次真正从未读变为已读的消息才会被计入（UPDATE ... RETURNING），重复标记不会多扣。
+    """
+    if not message_ids:
+        return
+    marked = db.execute(
+        update(models.Message.__table__)
+        .where(models.Message.id.in_(message_ids), models.Message.is_read == False)
+        .values(is_read=True)
+        .returning(models.Message.receiver_id, models.Message.sender_id)
+    ).all()
+
+    # (接收者, 发送者) -> 变为已读的条数
+    read_counts: dict[tuple, int] = {}
+    for receiver_id, sender_id in marked:
+        if receiver_id != sender_id:
+            read_counts[(receiver_id, sender_id)] = read_counts.get((receiver_id, sender_id), 0) + 1
+    if read_counts:
+        conversations = models.Conversation.__table__
+        db.execute(
+            update(conversations)
+            .where(
+                conversations.c.user_id == bindparam("b_user_id"),
+                conversations.c.peer_id == bindparam("b_peer_id"),
+            )
+            .values(unread_count=func.max(conversations.c.unread_count - bindparam("b_read"), 0)),
+            [
+                {"b_user_id": user_id, "b_peer_id": peer_id, "b_read": count}
+                for (user_id, peer_id), count in read_counts.items()
+            ],
+        )
+    db.commit()
+
+
+# --- 刷新令牌相关的 CRUD 操作 ---
+
+def create_refresh_token(db: Session, jti: str, user_id: int, expires_at: datetime):
+    """
+    记录一个新签发的刷新令牌，并顺带删除该用户已过期的令牌记录。
     """
-    db.query(models.Message).filter(
-        models.Message.id.in_(message_ids)
-    ).update({"is_read": True}, synchronize_session=False)
-    db.commit()
\ No newline at end of file
+    db.execute(delete(models.RefreshToken).where(
+        models.RefreshToken.user_id == user_id, models.RefreshToken.expires_at <= datetime.utcnow()
+    ))
+    db.add(models.RefreshToken(jti=jti, user_id=user_id, expires_at=expires_at))
+    db.commit()
+
+def rotate_refresh_token(db: Session, jti: str, username: str, new_jti: str, expires_at: datetime) -> Optional[models.User]:
+    """
+    在一个事务中使用一个刷新令牌：删除 jti 对应的记录，并为同一用户记录新的令牌 new_jti。
+    删除与读取在同一条 DELETE ... RETURNING 中完成，同一个令牌被并发使用时只有一个请求成功。
+    :return: 令牌所属的用户；令牌不存在（已使用、已吊销或已过期）、用户已被删除或用户名不符时返回 None
+    """
+    user_id = db.execute(
+        delete(models.RefreshToken)
+        .where(models.RefreshToken.jti == jti, models.RefreshToken.expires_at > datetime.utcnow())
+        .returning(models.RefreshToken.user_id)
+    ).scalar()
+    user = get_user(db, user_id) if user_id is not None else None
+    if user is None or user.username != username:
+        db.commit()
+        return None
+    db.add(models.RefreshToken(jti=new_jti, user_id=user_id, expires_at=expires_at))
+    db.commit()
+    return user
+
+def revoke_refresh_tokens(db: Session, user_id: int):
+    """
+    删除用户的全部刷新令牌（登出时调用）。
+    """
+    db.execute(delete(models.RefreshToken).where(models.RefreshToken.user_id == user_id))
+    db.commit()
+
+
+# --- 附件相关的 CRUD 操作 ---
+
+def create_attachment(db: Session, attachment_id: str, owner_id: int, recipient_id: int, size: int) -> models.Attachment:
+    """
+    记录一个新的附件上传，内容由客户端随后分块上传到 blob 存储。
+    """
+    attachment = models.Attachment(id=attachment_id, owner_id=owner_id, recipient_id=recipient_id, size=size)
+    db.add(attachment)
+    db.commit()
+    db.refresh(attachment)
+    return attachment
+
+def get_attachment(db: Session, attachment_id: str) -> Optional[models.Attachment]:
+    """
+    根据 ID 获取附件的元数据。
+    """
+    return db.query(models.Attachment).filter(models.Attachment.id == attachment_id).first()
+
+def complete_attachment(db: Session, attachment_id: str, sha256: str):
+    """
+    上传完成后记录内容的 SHA-256（即 blob 的存储位置）。
+    """
+    db.execute(
+        update(models.Attachment.__table__)
+        .where(models.Attachment.id == attachment_id)
+        .values(sha256=sha256, completed_at=datetime.utcnow())
+    )
+    db.commit()
+
+def delete_incomplete_attachments(db: Session, attachment_ids: list[str]):
+    """
+    删除一组未完成上传的附件记录（上传已过期、磁盘上的临时文件已被清理）。
+    """
+    if not attachment_ids:
+        return
+    db.query(models.Attachment).filter(
+        models.Attachment.id.in_(attachment_ids), models.Attachment.sha256.is_(None)
+    ).delete(synchronize_session=False)
+    db.commit()
@@ -0,0 +1,67 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable
+
+from .database import SessionLocal
+
+# --- 数据库执行器配置 ---
+# WebSocket 循环运行在事件循环上，任何同步的 SQLAlchemy 调用（尤其是 SQLite 的 fsync）
+# 都会阻塞该 worker 上的所有连接。因此热路径上的数据库操作统一交给专用线程池执行。
+DB_EXECUTOR_MAX_WORKERS = 4
+# 同时等待或正在执行的数据库任务上限。达到上限后，新的调用方会在协程中等待，
+# 而不是无限堆积任务，从而对数据库形成背压。
+DB_EXECUTOR_MAX_PENDING = 1000
+
+
+class DatabaseExecutor:
+    """
+    在专用线程池中执行同步的数据库函数，让事件循环永远不会阻塞在数据库 I/O 上。
+    每次调用都会创建独立的数据库会话，并在函数返回后关闭。
+    """
+
+    def __init__(
+        self,
+        session_factory: Callable = SessionLocal,
+        max_workers: int = DB_EXECUTOR_MAX_WORKERS,
+        max_pending: int = DB_EXECUTOR_MAX_PENDING,
+    ):
+        self.session_factory = session_factory
+        self.max_pending = max_pending
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="db-executor")
+        self._slots = asyncio.Semaphore(max_pending)
+        self._pending = 0
+
+    @property
+    def pending(self) -> int:
+        """当前排队或正在执行的数据库任务数量。"""
+        return self._pending
+
+    async def run(self, func: Callable[..., Any], *args, **kwargs) -> Any:
+        """
+        在线程池中执行 func(db, *args, **kwargs) 并返回其结果。
+        注意: 返回的 ORM 对象已脱离会话，只能访问已加载的属性，不能再触发懒加载。
+        """
+        self._pending += 1
+        try:
+            async with self._slots:
+                loop = asyncio.get_running_loop()
+                call = functools.partial(self._call, func, args, kwargs)
+                return await loop.run_in_executor(self._pool, call)
+        finally:
+            self._pending -= 1
+
+    def _call(self, func: Callable[..., Any], args: tuple, kwargs: dict) -> Any:
+        db = self.session_factory()
+        try:
+            return func(db, *args, **kwargs)
+        finally:
+            db.close()
+
+    def shutdown(self):
+        """等待所有已提交的任务完成并关闭线程池。"""
+        self._pool.shutdown(wait=True)
+
+
+# 全局单例，供 WebSocket 端点等异步代码使用
+db_executor = DatabaseExecutor()
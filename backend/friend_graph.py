@@ -0,0 +1,114 @@
+import threading
+from array import array
+from typing import Dict, Iterable, Tuple
+
+# 邻接数组的元素类型: 有符号 32 位整数，每条边每个方向占 4 字节
+ADJACENCY_TYPECODE = "i"
+
+
+class FriendGraph:
+    """
+    已接受好友关系的内存邻接索引：user_id -> 好友 ID 的紧凑整数数组。
+    接受好友请求时会同时写入双向关系，因此索引按无向图维护，每条边在两端各存一次。
+    由 crud 中修改好友关系的函数增量更新，在线好友查询和 presence 扇出都直接读取它，不再查询 contacts 表。
+    每个 worker 各有一份索引：version 记录已经应用到的增量同步日志版本号，
+    其他 worker 上的好友关系变化通过 apply 从日志中的 contact 变更补进来。
+    """
+
+    def __init__(self):
+        self._adjacency: Dict[int, array] = {}
+        # 已应用的增量同步日志（sync_changes）版本号
+        self.version = 0
+        # 数据库线程和请求线程都会修改索引，因此需要加锁
+        self._lock = threading.Lock()
+        self.loaded = False
+
+    def load(self, edges: Iterable[Tuple[int, int]], version: int = 0):
+        """
+        用 contacts 表中所有已接受的 (user_id, friend_id) 行重建索引。
+        :param version: 读取 contacts 表之前的日志版本号，之后的变化由 apply 补上
+        """
+        adjacency: Dict[int, array] = {}
+        for user_id, friend_id in edges:
+            self._append(adjacency, user_id, friend_id)
+            self._append(adjacency, friend_id, user_id)
+        # 重复行（双向关系各一行）在加载完成后统一去重
+        for user_id, friends in adjacency.items():
+            if len(friends) > 1:
+                adjacency[user_id] = array(ADJACENCY_TYPECODE, sorted(set(friends)))
+        with self._lock:
+            self._adjacency = adjacency
+            self.version = version
+            self.loaded = True
+
+    @staticmethod
+    def _append(adjacency: Dict[int, array], user_id: int, friend_id: int):
+        friends = adjacency.get(user_id)
+        if friends is None:
+            adjacency[user_id] = array(ADJACENCY_TYPECODE, (friend_id,))
+        else:
+            friends.append(friend_id)
+
+    def add_edge(self, user_id: int, friend_id: int):
+        """记录一对已接受的好友关系（双向）。"""
+        with self._lock:
+            self._add_edge(user_id, friend_id)
+
+    def _add_edge(self, user_id: int, friend_id: int):
+        for a, b in ((user_id, friend_id), (friend_id, user_id)):
+            friends = self._adjacency.get(a)
+            if friends is None:
+                self._adjacency[a] = array(ADJACENCY_TYPECODE, (b,))
+            elif b not in friends:
+                friends.append(b)
+
+    def remove_edge(self, user_id: int, friend_id: int):
+        """删除一对好友关系（双向）。"""
+        with self._lock:
+            self._remove_edge(user_id, friend_id)
+
+    def _remove_edge(self, user_id: int, friend_id: int):
+        for a, b in ((user_id, friend_id), (friend_id, user_id)):
+            friends = self._adjacency.get(a)
+            if friends is None or b not in friends:
+                continue
+            friends.remove(b)
+            if not friends:
+                del self._adjacency[a]
+
+    def apply(self, changes: Iterable[Tuple[int, int, int, bool]]) -> int:
+        """
+        按版本号顺序应用增量同步日志中的好友关系变化，并推进 version。
+        日志只保留每个关系的最终状态，重复应用本 worker 已经增量更新过的变化是幂等的。
+        :param changes: (版本号, user_id, friend_id, 是否为已接受的好友) 列表
+        :return: 应用的变化条数
+        """
+        applied = 0
+        with self._lock:
+            for version, user_id, friend_id, accepted in changes:
+                if accepted:
+                    self._add_edge(user_id, friend_id)
+                else:
+                    self._remove_edge(user_id, friend_id)
+                self.version = max(self.version, version)
+                applied += 1
+        return applied
+
+    def friends(self, user_id: int) -> Tuple[int, ...]:
+        """返回用户所有已接受好友的 ID（快照，调用方可以自由迭代）。"""
+        with self._lock:
+            friends = self._adjacency.get(user_id)
+            return tuple(friends) if friends is not None else ()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "users": len(self._adjacency),
+                "edges": sum(len(friends) for friends in self._adjacency.values()) // 2,
+                "loaded": self.loaded,
+                "version": self.version,
+            }
+
+
+# 全局单例
+friend_graph = FriendGraph()
@@ -0,0 +1,626 @@
+import asyncio
+import itertools
+from abc import ABC, abstractmethod
+import json
+import os
+from typing import Awaitable, Callable, Dict, Optional, Set
+
+from .wire_protocol import OutboundMessage, from_bus, to_bus
+
+# --- 消息总线配置 ---
+# "local": 进程内总线，只适用于单个 uvicorn worker（默认）
+# "unix":  基于 Unix 域套接字的本机代理，多个 worker 通过它互相路由消息
+MESSAGE_BUS_BACKEND = os.environ.get("SECURECHAT_MESSAGE_BUS", "local")
+MESSAGE_BUS_SOCKET_PATH = os.environ.get("SECURECHAT_BUS_SOCKET", "/tmp/securechat-bus.sock")
+# 等待代理转回投递结果的超时时间（秒），超时按未投递处理（消息可能其实已经送达，见 MessageBus.send_personal）
+MESSAGE_BUS_ACK_TIMEOUT_SECONDS = 2.0
+# 与代理的连接断开后重新连接的间隔（秒）
+MESSAGE_BUS_RECONNECT_SECONDS = 1.0
+# 单个总线帧的最大字节数（文件消息以 base64 形式整体转发，需要足够大的上限）
+MESSAGE_BUS_MAX_FRAME_BYTES = 64 * 1024 * 1024
+
+# 本地投递回调: (user_id, message, coalesce_key, seq) -> 是否已进入本地出站队列。
+# seq 为可靠投递的消息在该接收者下的序号，普通消息为 None
+DeliverCallback = Callable[[int, OutboundMessage, Optional[str], Optional[int]], Awaitable[bool]]
+# 本地广播回调: (message, coalesce_key) -> None
+BroadcastCallback = Callable[[str, Optional[str]], Awaitable[None]]
+# 集群在线状态转变回调: (user_id, 是否在线, 是否由当前 worker 负责写库和通知好友) -> None
+PresenceCallback = Callable[[int, bool, bool], None]
+# 清除租约回调（登出或最后一个 WebSocket 断开）: user_id -> None
+DropLeasesCallback = Callable[[int], None]
+
+
+class MessageBus(ABC):
+    """
+    消息路由总线的接口。ConnectionManager 通过它决定一条消息应该交给哪个 worker 进程。
+    实现类必须覆盖所有抽象方法，缺少实现时在构造总线时即报错。
+    """
+
+    @abstractmethod
+    async def start(self, deliver: DeliverCallback, broadcast: BroadcastCallback):
+        ...
+
+    @abstractmethod
+    async def close(self):
+        ...
+
+    @abstractmethod
+    async def register(self, user_id: int):
+        """声明某用户在当前 worker 上有活跃连接。"""
+
+    @abstractmethod
+    async def unregister(self, user_id: int):
+        """声明某用户在当前 worker 上已没有活跃连接。"""
+
+    @abstractmethod
+    async def is_online_elsewhere(self, user_id: int) -> bool:
+        """用户是否在其他 worker 上仍有活跃连接。"""
+
+    @abstractmethod
+    async def send_personal(
+        self, user_id: int, message: OutboundMessage, coalesce_key: Optional[str] = None, reliable: bool = False
+    ) -> bool:
+        """
+        把消息路由到用户所在的 worker（用户的多个设备可能分布在不同 worker 上）。
+        reliable 为 True 时，总线为消息分配该接收者下一个序号（所有 worker 共用同一个按接收者递增的计数器），
+        接收者所在的 worker 把消息保留到客户端确认（见 reliable_delivery）。
+        投递语义为"至少一次"：返回 False 时消息不一定没有送达（例如等待代理确认超时，而确认其实只是迟到了），
+        调用方转存离线副本时必须沿用消息原来的 id，由客户端按 id 去重，而不是把 False 当作"确定未送达"。
+        :return: 是否确认至少有一个 worker 接收了该消息
+        """
+
+    @abstractmethod
+    async def broadcast(self, message: str, coalesce_key: Optional[str] = None):
+        """向所有 worker 上的所有连接广播消息。"""
+
+    # --- 集群在线状态 ---
+    # 每个 worker 声明哪些用户在本 worker 上在线（持有 WebSocket 连接或未到期的 HTTP 租约），
+    # 用户在任一 worker 上在线即视为在线。集群范围的上线/离线转变通知给所有 worker，
+    # 其中恰好一个 worker 的回调收到 origin=True，由它负责写库、记入增量同步日志和通知好友。
+    _on_presence: Optional[PresenceCallback] = None
+    _on_drop_leases: Optional[DropLeasesCallback] = None
+
+    def set_presence_handlers(self, on_presence: PresenceCallback, on_drop_leases: DropLeasesCallback):
+        self._on_presence = on_presence
+        self._on_drop_leases = on_drop_leases
+
+    @abstractmethod
+    def set_presence(self, user_id: int, online: bool):
+        """声明某用户在当前 worker 上是否在线。"""
+
+    @abstractmethod
+    def drop_leases(self, user_id: int):
+        """让所有 worker（包括当前 worker）清除该用户的 HTTP 租约。"""
+
+    @abstractmethod
+    def is_online(self, user_id: int) -> bool:
+        """用户是否在任一 worker 上在线（集群视图）。"""
+
+    @abstractmethod
+    def online_count(self) -> int:
+        """集群视图中的在线用户数。"""
+
+
+class LocalMessageBus(MessageBus):
+    """
+    进程内总线：所有连接都在当前进程中，直接调用本地投递回调。
+    """
+
+    def __init__(self):
+        self._deliver: Optional[DeliverCallback] = None
+        self._broadcast: Optional[BroadcastCallback] = None
+        self._online: Set[int] = set()
+        # user_id -> 最近分配的可靠投递序号
+        self._seqs: Dict[int, int] = {}
+
+    async def start(self, deliver: DeliverCallback, broadcast: BroadcastCallback):
+        self._deliver = deliver
+        self._broadcast = broadcast
+
+    async def close(self):
+        pass
+
+    async def register(self, user_id: int):
+        pass
+
+    async def unregister(self, user_id: int):
+        pass
+
+    async def is_online_elsewhere(self, user_id: int) -> bool:
+        return False
+
+    async def send_personal(
+        self, user_id: int, message: OutboundMessage, coalesce_key: Optional[str] = None, reliable: bool = False
+    ) -> bool:
+        if self._deliver is None:
+            return False
+        seq = None
+        if reliable:
+            seq = self._seqs[user_id] = self._seqs.get(user_id, 0) + 1
+        accepted = await self._deliver(user_id, message, coalesce_key, seq)
+        if not accepted and seq is not None:
+            _release_seq(self._seqs, user_id, seq)
+        return accepted
+
+    async def broadcast(self, message: str, coalesce_key: Optional[str] = None):
+        if self._broadcast is not None:
+            await self._broadcast(message, coalesce_key)
+
+    def set_presence(self, user_id: int, online: bool):
+        if online == (user_id in self._online):
+            return
+        if online:
+            self._online.add(user_id)
+        else:
+            self._online.discard(user_id)
+        if self._on_presence is not None:
+            self._on_presence(user_id, online, True)
+
+    def drop_leases(self, user_id: int):
+        if self._on_drop_leases is not None:
+            self._on_drop_leases(user_id)
+
+    def is_online(self, user_id: int) -> bool:
+        return user_id in self._online
+
+    def online_count(self) -> int:
+        return len(self._online)
+
+
+def _release_seq(seqs: Dict[int, int], user_id: int, seq: int):
+    """
+    没有任何设备接收的可靠消息（接收者离线或全部拒收）退还它的序号，客户端收到的序号因此没有空缺。
+    只有该序号仍是最近分配的序号时才能退还；期间已为后续消息分配了序号时保留空缺（见 reliable_delivery）。
+    """
+    if seqs.get(user_id) == seq:
+        seqs[user_id] = seq - 1
+
+
+def _encode_frame(frame: dict) -> bytes:
+    return json.dumps(frame, ensure_ascii=False).encode("utf-8") + b"\n"
+
+
+class _PendingSend:
+    """代理已转发、还在等待接收者所在 worker 回报投递结果的一条消息。"""
+
+    __slots__ = ("sender", "req", "waiting", "user_id", "seq")
+
+    def __init__(
+        self, sender: asyncio.StreamWriter, req: int, waiting: Set[asyncio.StreamWriter], user_id: int, seq: Optional[int]
+    ):
+        self.sender = sender
+        self.req = req
+        self.waiting = waiting
+        self.user_id = user_id
+        self.seq = seq
+
+
+class BusBroker:
+    """
+    本机消息代理：各 worker 通过 Unix 域套接字连接到它，登记自己持有的用户，
+    代理据此把消息转发给正确的 worker。协议为按行分隔的 JSON 帧。
+    代理为可靠投递的消息按接收者分配递增的序号，所有 worker 上的设备看到同一个序号。
+    代理同时是集群在线状态的权威：记录每个用户在哪些 worker 上在线，用户的第一个 worker 上线或
+    最后一个 worker 离线（包括 worker 断开）时，把转变通知给所有 worker。
+    不依赖任何外部服务，可以在测试中直接启动。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._server: Optional[asyncio.AbstractServer] = None
+        # user_id -> 持有该用户连接的 worker 写端集合
+        self._owners: Dict[int, Set[asyncio.StreamWriter]] = {}
+        # user_id -> 该用户在其上在线（WebSocket 或 HTTP 租约）的 worker 写端集合
+        self._online: Dict[int, Set[asyncio.StreamWriter]] = {}
+        self._workers: Set[asyncio.StreamWriter] = set()
+        # 投递 ID -> 等待投递结果的消息
+        self._pending: Dict[int, _PendingSend] = {}
+        self._delivery_ids = itertools.count(1)
+        # user_id -> 最近分配的可靠投递序号；代理迁移后由各 worker 报告的 seq_floor 恢复
+        self._seqs: Dict[int, int] = {}
+
+    async def start(self):
+        self._server = await asyncio.start_unix_server(
+            self._handle_worker, path=self.path, limit=MESSAGE_BUS_MAX_FRAME_BYTES
+        )
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        for writer in list(self._workers):
+            writer.close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+    async def _handle_worker(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        if self._server is None:
+            # 代理关闭前已建立、关闭后才开始处理的连接：直接关闭，让该 worker 重新连接
+            writer.close()
+            return
+        self._workers.add(writer)
+        # 新连接的 worker（或代理迁移后重新连接的 worker）先收到当前的在线用户快照，之后只收到转变
+        writer.write(_encode_frame({"op": "presence_snapshot", "online": list(self._online)}))
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                frame = json.loads(line)
+                op = frame.get("op")
+                if op == "register":
+                    self._owners.setdefault(frame["user_id"], set()).add(writer)
+                elif op == "unregister":
+                    self._remove_owner(frame["user_id"], writer)
+                elif op == "send":
+                    await self._send(writer, frame)
+                elif op == "delivered":
+                    self._resolve(frame["id"], writer, frame["accepted"])
+                elif op == "query":
+                    others = self._owners.get(frame["user_id"], set()) - {writer}
+                    self._ack(writer, frame["req"], bool(others))
+                elif op == "seq_floor":
+                    user_id = frame["user_id"]
+                    self._seqs[user_id] = max(self._seqs.get(user_id, 0), frame["seq"])
+                elif op == "presence":
+                    await self._set_presence(writer, frame["user_id"], frame["online"])
+                elif op in ("broadcast", "drop_leases"):
+                    data = _encode_frame(frame)
+                    for worker in list(self._workers):
+                        await self._forward(worker, data)
+        except (ConnectionError, ValueError) as e:
+            print(f"消息代理: worker 连接异常: {e}")
+        finally:
+            self._workers.discard(writer)
+            for user_id in [uid for uid, owners in self._owners.items() if writer in owners]:
+                self._remove_owner(user_id, writer)
+            # 断开的 worker 上的用户不再在线；由任一仍连接的 worker 负责写库和通知好友
+            origin = next(iter(self._workers), None)
+            for user_id in [uid for uid, holders in self._online.items() if writer in holders]:
+                holders = self._online[user_id]
+                holders.discard(writer)
+                if not holders:
+                    del self._online[user_id]
+                    await self._publish_presence(user_id, False, origin)
+            # 断开的 worker 不会再回报投递结果，按未投递处理；它自己发出的请求不再需要确认
+            for delivery_id, pending in list(self._pending.items()):
+                if pending.sender is writer:
+                    del self._pending[delivery_id]
+                elif writer in pending.waiting:
+                    self._resolve(delivery_id, writer, False)
+            writer.close()
+
+    async def _send(self, sender: asyncio.StreamWriter, frame: dict):
+        """
+        把消息转发给接收者所在的每个 worker。确认不在转发时发出，而是等各 worker 回报本地投递的结果
+        (delivered)：任一 worker 接收了消息即确认已路由，全部拒绝（例如连接在此期间断开）才确认未路由，
+        发送方据此决定是否转存为离线消息。
+        """
+        owners = set(self._owners.get(frame["user_id"], ()))
+        if not owners:
+            self._ack(sender, frame["req"], False)
+            return
+        delivery_id = next(self._delivery_ids)
+        user_id = frame["user_id"]
+        seq = None
+        if frame.get("reliable", False):
+            seq = self._seqs[user_id] = self._seqs.get(user_id, 0) + 1
+        self._pending[delivery_id] = _PendingSend(sender, frame["req"], owners, user_id, seq)
+        deliver = _encode_frame({
+            "op": "deliver",
+            "id": delivery_id,
+            "user_id": user_id,
+            **{key: frame[key] for key in ("message", "envelope", "binary_content") if key in frame},
+            "coalesce_key": frame.get("coalesce_key"),
+            "seq": seq,
+        })
+        for owner in owners:
+            if not await self._forward(owner, deliver):
+                self._resolve(delivery_id, owner, False)
+
+    async def _set_presence(self, writer: asyncio.StreamWriter, user_id: int, online: bool):
+        holders = self._online.get(user_id)
+        if online:
+            if holders is None:
+                self._online[user_id] = {writer}
+                await self._publish_presence(user_id, True, writer)
+            else:
+                holders.add(writer)
+        elif holders is not None and writer in holders:
+            holders.discard(writer)
+            if not holders:
+                del self._online[user_id]
+                await self._publish_presence(user_id, False, writer)
+
+    async def _publish_presence(self, user_id: int, online: bool, origin: Optional[asyncio.StreamWriter]):
+        """把集群范围的上线/离线转变通知给所有 worker，引起转变的 worker 收到 origin=True。"""
+        frames = {
+            is_origin: _encode_frame({"op": "presence", "user_id": user_id, "online": online, "origin": is_origin})
+            for is_origin in (True, False)
+        }
+        for worker in list(self._workers):
+            await self._forward(worker, frames[worker is origin])
+
+    def _resolve(self, delivery_id: int, owner: asyncio.StreamWriter, accepted: bool):
+        pending = self._pending.get(delivery_id)
+        if pending is None:
+            return
+        pending.waiting.discard(owner)
+        if accepted or not pending.waiting:
+            del self._pending[delivery_id]
+            if not accepted and pending.seq is not None:
+                _release_seq(self._seqs, pending.user_id, pending.seq)
+            self._ack(pending.sender, pending.req, accepted)
+
+    @staticmethod
+    async def _forward(writer: asyncio.StreamWriter, data: bytes) -> bool:
+        """
+        向 worker 转发一帧并等待写缓冲区排空：接收方处理不过来时，背压传导到发送方的连接上，
+        而不是在代理的内存中无限堆积。
+        :return: 是否写入成功（连接已断开时返回 False）
+        """
+        if writer.is_closing():
+            return False
+        try:
+            writer.write(data)
+            await writer.drain()
+        except ConnectionError:
+            return False
+        return True
+
+    @staticmethod
+    def _ack(writer: asyncio.StreamWriter, req: int, routed: bool):
+        # 确认帧很小，每个请求只有一个，不等待排空：回报投递结果的 worker 不会因为发送方读得慢而阻塞
+        if not writer.is_closing():
+            writer.write(_encode_frame({"op": "ack", "req": req, "routed": routed}))
+
+    def _remove_owner(self, user_id: int, writer: asyncio.StreamWriter):
+        owners = self._owners.get(user_id)
+        if owners is not None:
+            owners.discard(writer)
+            if not owners:
+                del self._owners[user_id]
+
+
+class UnixSocketMessageBus(MessageBus):
+    """
+    跨 worker 的消息总线。第一个启动的 worker 会在本进程内托管 BusBroker，
+    其余 worker 作为客户端连接；代理所在的 worker 退出后，其他 worker 会自动接管。
+    """
+
+    def __init__(self, path: str = MESSAGE_BUS_SOCKET_PATH):
+        self.path = path
+        self._deliver: Optional[DeliverCallback] = None
+        self._broadcast: Optional[BroadcastCallback] = None
+        self._broker: Optional[BusBroker] = None
+        self._broker_lock_fd: Optional[int] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._reader_task: Optional[asyncio.Task] = None
+        self._connected = asyncio.Event()
+        self._closing = False
+        self._local_users: Set[int] = set()
+        # 在本 worker 上在线的用户（随重新连接重新声明），以及代理通知的集群在线用户副本
+        self._local_online: Set[int] = set()
+        self._cluster_online: Set[int] = set()
+        # user_id -> 本 worker 收到的最大可靠投递序号，重新连接时报告给（可能是新的）代理，保证序号继续递增
+        self._seq_floors: Dict[int, int] = {}
+        self._pending_acks: Dict[int, asyncio.Future] = {}
+        self._req_ids = itertools.count(1)
+
+    async def start(self, deliver: DeliverCallback, broadcast: BroadcastCallback):
+        self._deliver = deliver
+        self._broadcast = broadcast
+        await self._connect()
+        self._reader_task = asyncio.create_task(self._run())
+
+    async def close(self):
+        self._closing = True
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+        if self._writer is not None:
+            self._writer.close()
+        if self._broker is not None:
+            await self._broker.close()
+            self._broker = None
+        if self._broker_lock_fd is not None:
+            os.close(self._broker_lock_fd)
+            self._broker_lock_fd = None
+
+    async def _connect(self):
+        """连接到代理；如果代理不存在，则在本进程内启动一个。"""
+        while True:
+            try:
+                reader, writer = await asyncio.open_unix_connection(self.path, limit=MESSAGE_BUS_MAX_FRAME_BYTES)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                # 没有可用的代理（或者是残留的套接字文件），尝试自己成为代理
+                if not await self._try_become_broker():
+                    # 另一个 worker 正在启动代理，稍后重新连接即可
+                    await asyncio.sleep(0.05)
+
+        self._reader = reader
+        self._writer = writer
+        # 重新登记本 worker 持有的用户，保证代理重启后路由表完整
+        for user_id in self._local_users:
+            writer.write(_encode_frame({"op": "register", "user_id": user_id}))
+        for user_id in self._local_online:
+            writer.write(_encode_frame({"op": "presence", "user_id": user_id, "online": True}))
+        for user_id, seq in self._seq_floors.items():
+            writer.write(_encode_frame({"op": "seq_floor", "user_id": user_id, "seq": seq}))
+        await writer.drain()
+        self._connected.set()
+
+    async def _try_become_broker(self) -> bool:
+        """
+        通过文件锁选举代理：持有锁的进程负责托管代理，锁随进程退出自动释放。
+        """
+        # fcntl 只在 Unix 上可用，只在使用该后端时导入；进程内总线（默认）在 Windows 上不依赖它
+        import fcntl
+
+        lock_fd = os.open(self.path + ".lock", os.O_CREAT | os.O_RDWR, 0o600)
+        try:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(lock_fd)
+            return False
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+        broker = BusBroker(self.path)
+        await broker.start()
+        self._broker = broker
+        self._broker_lock_fd = lock_fd
+        print(f"消息总线: 本进程 (PID {os.getpid()}) 托管代理 {self.path}")
+        return True
+
+    async def _run(self):
+        while not self._closing:
+            try:
+                while True:
+                    line = await self._reader.readline()
+                    if not line:
+                        break
+                    await self._handle_frame(json.loads(line))
+            except asyncio.CancelledError:
+                return
+            except Exception as e:
+                print(f"消息总线: 读取代理消息时出错: {e}")
+
+            if self._closing:
+                return
+            # 与代理的连接断开：未确认的请求视为未投递，然后重新连接
+            self._connected.clear()
+            for future in self._pending_acks.values():
+                if not future.done():
+                    future.set_result(False)
+            self._pending_acks.clear()
+            await asyncio.sleep(MESSAGE_BUS_RECONNECT_SECONDS)
+            try:
+                await self._connect()
+            except Exception as e:
+                print(f"消息总线: 重新连接代理失败: {e}")
+
+    async def _handle_frame(self, frame: dict):
+        op = frame.get("op")
+        if op == "deliver":
+            seq = frame.get("seq")
+            accepted = self._deliver is not None and await self._deliver(
+                frame["user_id"], from_bus(frame), frame.get("coalesce_key"), seq
+            )
+            # 只记录设备实际收到的序号：被拒收的序号可能由代理退还，之后重新分配给下一条消息
+            if accepted and seq is not None:
+                self._seq_floors[frame["user_id"]] = max(self._seq_floors.get(frame["user_id"], 0), seq)
+            self._reply({"op": "delivered", "id": frame["id"], "accepted": accepted})
+        elif op == "broadcast" and self._broadcast is not None:
+            await self._broadcast(frame["message"], frame.get("coalesce_key"))
+        elif op == "presence":
+            self._apply_presence(frame["user_id"], frame["online"], frame["origin"])
+        elif op == "presence_snapshot":
+            self._cluster_online = set(frame["online"])
+        elif op == "drop_leases" and self._on_drop_leases is not None:
+            self._on_drop_leases(frame["user_id"])
+        elif op == "ack":
+            future = self._pending_acks.pop(frame["req"], None)
+            if future is not None and not future.done():
+                future.set_result(frame["routed"])
+
+    def _reply(self, frame: dict):
+        """
+        回报投递结果。不等待排空：读循环如果阻塞在写上，而代理也正阻塞在向本 worker 转发上，双方会互相等待；
+        回报帧与收到的帧一一对应，数量受代理一侧的背压限制。
+        """
+        if self._connected.is_set() and self._writer is not None:
+            self._writer.write(_encode_frame(frame))
+
+    async def _write(self, frame: dict) -> bool:
+        if not self._connected.is_set() or self._writer is None:
+            return False
+        self._writer.write(_encode_frame(frame))
+        await self._writer.drain()
+        return True
+
+    async def register(self, user_id: int):
+        self._local_users.add(user_id)
+        await self._write({"op": "register", "user_id": user_id})
+
+    async def unregister(self, user_id: int):
+        self._local_users.discard(user_id)
+        await self._write({"op": "unregister", "user_id": user_id})
+
+    async def is_online_elsewhere(self, user_id: int) -> bool:
+        return await self._request({"op": "query", "user_id": user_id})
+
+    async def send_personal(
+        self, user_id: int, message: OutboundMessage, coalesce_key: Optional[str] = None, reliable: bool = False
+    ) -> bool:
+        return await self._request({
+            "op": "send", "user_id": user_id, **to_bus(message), "coalesce_key": coalesce_key, "reliable": reliable,
+        })
+
+    async def _request(self, frame: dict) -> bool:
+        """发送一个需要代理确认的请求帧，并等待确认结果；超时或未连接时返回 False，迟到的确认被忽略。"""
+        req = next(self._req_ids)
+        future = asyncio.get_running_loop().create_future()
+        self._pending_acks[req] = future
+        frame["req"] = req
+        if not await self._write(frame):
+            self._pending_acks.pop(req, None)
+            return False
+        try:
+            return await asyncio.wait_for(future, MESSAGE_BUS_ACK_TIMEOUT_SECONDS)
+        except asyncio.TimeoutError:
+            self._pending_acks.pop(req, None)
+            return False
+
+    async def broadcast(self, message: str, coalesce_key: Optional[str] = None):
+        await self._write({"op": "broadcast", "message": message, "coalesce_key": coalesce_key})
+
+    def set_presence(self, user_id: int, online: bool):
+        if online == (user_id in self._local_online):
+            return
+        if online:
+            self._local_online.add(user_id)
+        else:
+            self._local_online.discard(user_id)
+        # 与回报投递结果一样不等待排空，调用方不需要是协程
+        if self._connected.is_set() and self._writer is not None:
+            self._writer.write(_encode_frame({"op": "presence", "user_id": user_id, "online": online}))
+        else:
+            # 与代理断开期间只能按本 worker 的视图处理；重新连接后会向新代理重新声明在线用户
+            self._apply_presence(user_id, online, True)
+
+    def _apply_presence(self, user_id: int, online: bool, origin: bool):
+        if online:
+            self._cluster_online.add(user_id)
+        else:
+            self._cluster_online.discard(user_id)
+        if self._on_presence is not None:
+            self._on_presence(user_id, online, origin)
+
+    def drop_leases(self, user_id: int):
+        if self._connected.is_set() and self._writer is not None:
+            self._writer.write(_encode_frame({"op": "drop_leases", "user_id": user_id}))
+        elif self._on_drop_leases is not None:
+            self._on_drop_leases(user_id)
+
+    def is_online(self, user_id: int) -> bool:
+        # 本 worker 的声明立即生效，不必等代理转回的转变通知
+        return user_id in self._local_online or user_id in self._cluster_online
+
+    def online_count(self) -> int:
+        return len(self._local_online | self._cluster_online)
+
+
+def create_message_bus(backend: str = MESSAGE_BUS_BACKEND) -> MessageBus:
+    """
+    根据配置创建消息总线实例。
+    """
+    if backend == "local":
+        return LocalMessageBus()
+    if backend == "unix":
+        return UnixSocketMessageBus()
+    raise ValueError(f"未知的消息总线类型: {backend}")
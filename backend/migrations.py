@@ -0,0 +1,139 @@
+from sqlalchemy import MetaData, inspect, text
+from sqlalchemy.engine import Engine
+
+from .ciphertext import CONTENT_KIND_BINARY, CONTENT_KIND_TEXT
+
+# create_all 只会创建不存在的表，不会给已有的表添加列或索引。
+# 这里的每个迁移步骤都是幂等的：先检查数据库的当前结构，只在缺少时才修改，
+# 因此无论是新建的数据库还是旧版本的 chat.db，启动时都可以安全地重复执行。
+# 多个 worker 同时启动时，建表和迁移在同一个 BEGIN IMMEDIATE 事务中串行执行（见 run_migrations）。
+
+# 等待其他 worker 完成迁移的最长时间（毫秒）：迁移期间数据库的写锁一直被占用
+MIGRATION_BUSY_TIMEOUT_MS = 120_000
+
+
+def _columns(conn, table: str) -> set:
+    return {column["name"] for column in inspect(conn).get_columns(table)}
+
+
+def add_message_conversation_key(conn):
+    """
+    messages 表增加 conversation_key 列，并为已有消息回填。
+    回填表达式与 models.conversation_key 一致: (较小 ID << 32) | 较大 ID。
+    """
+    if "conversation_key" in _columns(conn, "messages"):
+        return
+    conn.execute(text("ALTER TABLE messages ADD COLUMN conversation_key INTEGER"))
+    conn.execute(text(
+        "UPDATE messages SET conversation_key = CASE "
+        "WHEN sender_id <= receiver_id THEN (sender_id << 32) | receiver_id "
+        "ELSE (receiver_id << 32) | sender_id END "
+        "WHERE conversation_key IS NULL"
+    ))
+
+
+def create_message_indexes(conn):
+    """补建会话历史和未读消息的复合索引。"""
+    conn.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_messages_conversation ON messages (conversation_key, id)"
+    ))
+    conn.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_messages_unread ON messages (receiver_id, is_read, sent_at, id)"
+    ))
+
+
+def backfill_conversations(conn):
+    """
+    conversations 表由 create_all 新建时为空，根据已有消息一次性生成会话摘要。
+    表中已有数据（已经回填过或由 crud 维护）时跳过。
+    """
+    if conn.execute(text("SELECT 1 FROM conversations LIMIT 1")).first() is not None:
+        return
+    conn.execute(text(
+        "INSERT INTO conversations (user_id, peer_id, last_message_id, unread_count) "
+        "SELECT user_id, peer_id, MAX(id), SUM(unread) FROM ("
+        "  SELECT sender_id AS user_id, receiver_id AS peer_id, id, 0 AS unread FROM messages"
+        "  UNION ALL"
+        "  SELECT receiver_id, sender_id, id,"
+        "         CASE WHEN is_read = 0 AND sender_id != receiver_id THEN 1 ELSE 0 END FROM messages"
+        ") GROUP BY user_id, peer_id"
+    ))
+    conn.execute(text(
+        "UPDATE conversations SET last_message_at = "
+        "(SELECT sent_at FROM messages WHERE messages.id = conversations.last_message_id)"
+    ))
+
+
+def add_attachment_recipient(conn):
+    """attachments 表增加 recipient_id 列。之前创建的附件没有记录接收者，只有上传者可以下载。"""
+    if "recipient_id" in _columns(conn, "attachments"):
+        return
+    conn.execute(text("ALTER TABLE attachments ADD COLUMN recipient_id INTEGER REFERENCES users (id)"))
+
+
+def record_ciphertext_kind(conn):
+    """
+    messages 表增加 content_kind 列，按已有消息实际保存的形式记录种类，不转换任何内容:
+    以 BLOB 保存的消息记为 binary，继续以原始字节保存；TEXT 消息记为 text。
+    已保存为 TEXT 的 base64 文本无法确定客户端是否把它当作二进制密文，不做猜测，保持原样；
+    之后由客户端用 content_kind 声明的二进制密文才以 BLOB 保存。
+    旧版本按猜测解码为 BLOB 的消息（例如 "good"）记为 binary，JSON 出口编码得到的 base64 文本与原文相同。
+    """
+    if "content_kind" in _columns(conn, "messages"):
+        return
+    conn.execute(text(
+        f"ALTER TABLE messages ADD COLUMN content_kind VARCHAR NOT NULL DEFAULT '{CONTENT_KIND_TEXT}'"
+    ))
+    conn.execute(text(
+        f"UPDATE messages SET content_kind = '{CONTENT_KIND_BINARY}' WHERE typeof(encrypted_content) = 'blob'"
+    ))
+
+
+def add_message_delivery_id(conn):
+    """messages 表增加 delivery_id 列（实时消息的 ID），已有消息没有 ID。"""
+    if "delivery_id" in _columns(conn, "messages"):
+        return
+    conn.execute(text("ALTER TABLE messages ADD COLUMN delivery_id VARCHAR"))
+
+
+# 按顺序执行的迁移步骤
+MIGRATIONS = [
+    add_message_conversation_key,
+    create_message_indexes,
+    backfill_conversations,
+    add_attachment_recipient,
+    record_ciphertext_kind,
+    add_message_delivery_id,
+]
+
+
+def run_migrations(engine: Engine, metadata: MetaData):
+    """
+    创建缺少的表（create_all）并依次执行所有迁移步骤。应在应用开始处理请求之前调用。
+    SQLite 上整个过程在一个 BEGIN IMMEDIATE 事务中执行：同时启动的多个 worker 中只有一个持有写锁，
+    其余的等待它提交后再检查数据库结构，此时发现已经迁移完毕，不会重复建表或添加列。
+    """
+    if engine.dialect.name != "sqlite":
+        with engine.begin() as conn:
+            _migrate(conn, metadata)
+        return
+    # pysqlite 只在 DML 之前隐式开始事务，DDL 不在事务中；改为自动提交模式后由这里显式控制事务
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        busy_timeout = conn.execute(text("PRAGMA busy_timeout")).scalar()
+        conn.execute(text(f"PRAGMA busy_timeout = {MIGRATION_BUSY_TIMEOUT_MS}"))
+        try:
+            conn.execute(text("BEGIN IMMEDIATE"))
+            try:
+                _migrate(conn, metadata)
+            except BaseException:
+                conn.execute(text("ROLLBACK"))
+                raise
+            conn.execute(text("COMMIT"))
+        finally:
+            conn.execute(text(f"PRAGMA busy_timeout = {busy_timeout}"))
+
+
+def _migrate(conn, metadata: MetaData):
+    metadata.create_all(bind=conn)
+    for migration in MIGRATIONS:
+        migration(conn)
@@ -1,9 +1,21 @@
 # 导入 SQLAlchemy 的相关模块
-from sqlalchemy import Boolean, Column, Integer, String, Text, DateTime, ForeignKey, UniqueConstraint
+from sqlalchemy import Boolean, Column, Integer, String, Text, DateTime, ForeignKey, UniqueConstraint, Index
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
+from sqlalchemy.types import UserDefinedType
 # 从同级目录的 database.py 导入 Base 类
 from database import Base
+from ciphertext import CONTENT_KIND_TEXT
+
+
+# 消息密文的列类型 (见 ciphertext.py)：声明为 BLOB（没有类型亲和性），bytes 以 BLOB、str 以 TEXT 保存，
+# 写入和读取时都不做转换。
+class CiphertextType(UserDefinedType):
+    cache_ok = True
+
+    def get_col_spec(self, **kw):
+        return "BLOB"
+
 
 # 定义用户模型 (User Model)
 class User(Base):
@@ -54,12 +66,103 @@ class Message(Base):
     id = Column(Integer, primary_key=True, index=True)  # 消息ID，主键
     sender_id = Column(Integer, ForeignKey("users.id"), nullable=False)  # 发送者ID，外键
     receiver_id = Column(Integer, ForeignKey("users.id"), nullable=False)  # 接收者ID，外键
-    encrypted_content = Column(Text, nullable=False)  # 加密后的消息内容
+    encrypted_content = Column(CiphertextType, nullable=False)  # 加密后的消息内容，二进制密文以 BLOB 保存
+    # 消息内容的种类: "text" 或 "binary"（以 bin 收到的密文），见 ciphertext.py
+    content_kind = Column(String, nullable=False, server_default=CONTENT_KIND_TEXT)
     sent_at = Column(DateTime(timezone=True), server_default=func.now())  # 发送时间
     is_read = Column(Boolean, default=False)  # 消息是否已读
+    # 会话键: 由双方用户 ID 计算 (见 conversation_key)，同一对用户之间两个方向的消息共用一个值
+    conversation_key = Column(Integer, nullable=True)
+    # 服务器在收到实时消息时分配的消息 ID（WebSocket 消息的 "id" 字段）。实时投递未确认而转存的消息
+    # 在离线推送中保留同一个 ID，客户端据此去重；之前版本保存的消息为 NULL
+    delivery_id = Column(String, nullable=True)
 
     # --- 关系定义 (Relationships) ---
     # 关联到发送者
     sender = relationship("User", foreign_keys=[sender_id], back_populates="sent_messages")
     # 关联到接收者
-    receiver = relationship("User", foreign_keys=[receiver_id], back_populates="received_messages")
\ No newline at end of file
+    receiver = relationship("User", foreign_keys=[receiver_id], back_populates="received_messages")
+
+    # 复合索引（已有数据库由 migrations.py 补建）:
+    # - 会话历史按 (conversation_key, id) 做键集分页，每页只读取索引上的一段
+    # - 未读消息按 (receiver_id, is_read, sent_at, id) 查询和排序，不再扫描整张表
+    __table_args__ = (
+        Index("ix_messages_conversation", "conversation_key", "id"),
+        Index("ix_messages_unread", "receiver_id", "is_read", "sent_at", "id"),
+    )
+
+
+# 定义会话摘要模型 (Conversation Model)
+# 每个用户与每个聊过天的对方各有一行，由 crud 中的消息写入和标记已读操作增量维护，
+# 会话列表 (GET /me/conversations) 只需按索引读取这张表，不再扫描 messages。
+class Conversation(Base):
+    __tablename__ = "conversations"  # 数据库中的表名
+
+    id = Column(Integer, primary_key=True)  # 主键
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)  # 会话所属的用户
+    peer_id = Column(Integer, ForeignKey("users.id"), nullable=False)  # 会话的对方
+    last_message_id = Column(Integer, ForeignKey("messages.id"), nullable=False)  # 最后一条消息的ID
+    last_message_at = Column(DateTime(timezone=True), nullable=True)  # 最后一条消息的发送时间
+    unread_count = Column(Integer, default=0, nullable=False)  # 对方发来、当前用户尚未读取的消息数
+
+    # 每个 (用户, 对方) 只有一行；会话列表按 (user_id, last_message_id) 索引从新到旧读取
+    __table_args__ = (
+        UniqueConstraint("user_id", "peer_id", name="_conversation_user_peer_uc"),
+        Index("ix_conversations_user_recent", "user_id", "last_message_id"),
+    )
+
+
+# 定义附件模型 (Attachment Model)
+# 附件的加密内容分块上传到磁盘上的内容寻址存储 (blob_store.py)，数据库只保存元数据；
+# 聊天消息中只携带附件 ID，不再内嵌整个文件。
+class Attachment(Base):
+    __tablename__ = "attachments"  # 数据库中的表名
+
+    id = Column(String, primary_key=True)  # 附件ID，随机生成、不可猜测
+    owner_id = Column(Integer, ForeignKey("users.id"), nullable=False)  # 上传者ID
+    recipient_id = Column(Integer, ForeignKey("users.id"), nullable=True)  # 接收者ID：附件所在会话的另一方
+    size = Column(Integer, nullable=False)  # 附件（密文）的总字节数，创建上传时声明
+    sha256 = Column(String, nullable=True, index=True)  # 内容的 SHA-256，即 blob 的存储位置；上传完成前为空
+    created_at = Column(DateTime(timezone=True), server_default=func.now())  # 创建时间
+    completed_at = Column(DateTime(timezone=True), nullable=True)  # 上传完成时间
+
+
+# 定义增量同步变更模型 (SyncChange Model)
+# 联系人、好友请求和在线状态的变更日志 (见 change_log.py)，供 GET /me/sync 使用。
+# 版本号是自增主键：SQLite 的写事务是串行的，所有 worker 共用一个单调递增的版本序列，
+# 读到某个版本的客户端一定也能读到所有更小的版本。每个 (类型, 接收者, 对象) 只保留最新一行。
+class SyncChange(Base):
+    __tablename__ = "sync_changes"  # 数据库中的表名
+
+    version = Column(Integer, primary_key=True)  # 版本号，AUTOINCREMENT 保证删除后也不会复用
+    kind = Column(String, nullable=False)  # 变更类型: contact / request / presence
+    # 接收变更的用户；在线状态变更只记录一次，接收者是 subject_id 的所有好友，此列为空
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=True)
+    subject_id = Column(Integer, nullable=False)  # 变更的对象（好友、请求者或状态变化的用户）的 ID
+    payload = Column(Text, nullable=False)  # 变更内容 (JSON)，不含 type 和 version
+
+    __table_args__ = (
+        Index("ix_sync_changes_user", "user_id", "version"),
+        Index("ix_sync_changes_subject", "kind", "subject_id", "version"),
+        {"sqlite_autoincrement": True},
+    )
+
+
+# 定义刷新令牌模型 (RefreshToken Model)
+# 每个已签发且尚未使用的刷新令牌一行，以令牌中的 jti 为主键。刷新时删除旧行、写入新行（令牌轮换），
+# 登出时删除该用户的全部行；所有 worker 共用这张表，吊销立即对整个集群生效。
+class RefreshToken(Base):
+    __tablename__ = "refresh_tokens"  # 数据库中的表名
+
+    jti = Column(String, primary_key=True)  # 令牌 ID，随机生成，写入 JWT 的 jti 字段
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)  # 令牌所属的用户
+    expires_at = Column(DateTime, nullable=False)  # 过期时间 (UTC)，与 JWT 的 exp 一致
+    created_at = Column(DateTime(timezone=True), server_default=func.now())  # 签发时间
+
+
+def conversation_key(user_a: int, user_b: int) -> int:
+    """
+    计算两个用户之间会话的键：较小的 ID 占高 32 位，较大的 ID 占低 32 位，与消息方向无关。
+    """
+    low, high = (user_a, user_b) if user_a <= user_b else (user_b, user_a)
+    return (low << 32) | high
\ No newline at end of file
@@ -0,0 +1,103 @@
+import asyncio
+from typing import Optional
+
+from . import crud
+from .connection_manager import manager
+from .db_executor import db_executor
+from .wire_protocol import Envelope
+
+# --- 离线消息回放配置 ---
+# 每批推送的离线消息条数。每批只占用一页的内存，并合并为一个 WebSocket 帧发送。
+OFFLINE_REPLAY_BATCH_SIZE = 100
+# 等待客户端确认一批消息的超时时间（秒）。超时后停止回放，未确认的消息保持未读，
+# 下次连接时会重新推送。
+OFFLINE_REPLAY_ACK_TIMEOUT_SECONDS = 30.0
+
+
+class OfflineReplay:
+    """
+    连接建立后，把用户的未读离线消息按 (sent_at, id) 键集分页，逐批推送到当前设备会话。
+    每批消息只有在客户端回复 {"type": "offline_ack", "batch_id": n} 后才会被标记为已读，
+    然后才推送下一批，因此断线或客户端崩溃都不会丢失消息。
+    """
+
+    def __init__(
+        self,
+        user_id: int,
+        session_id: int,
+        batch_size: int = OFFLINE_REPLAY_BATCH_SIZE,
+        ack_timeout: float = OFFLINE_REPLAY_ACK_TIMEOUT_SECONDS,
+    ):
+        self.user_id = user_id
+        self.session_id = session_id
+        self.batch_size = batch_size
+        self.ack_timeout = ack_timeout
+        self._batch_id = 0
+        self._acked = asyncio.Event()
+
+    def ack(self, batch_id: int):
+        """由 WebSocket 接收循环调用，确认当前批次已被客户端处理。"""
+        if batch_id == self._batch_id:
+            self._acked.set()
+
+    async def run(self):
+        """
+        逐批推送离线消息，直到没有未读消息、客户端未及时确认或连接不可写。
+        """
+        try:
+            await self._replay()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"推送离线消息时出错: {e}")
+
+    async def _replay(self):
+        after: Optional[tuple] = None
+        total = 0
+        while True:
+            # 多取一条用于判断是否还有下一页
+            rows = await db_executor.run(
+                crud.get_unread_messages_page, user_id=self.user_id, after=after, limit=self.batch_size + 1
+            )
+            if not rows:
+                break
+            has_more = len(rows) > self.batch_size
+            rows = rows[:self.batch_size]
+
+            self._batch_id += 1
+            self._acked.clear()
+            # 以 BLOB 保存的密文是 bytes：二进制会话直接收到 bin，JSON 会话中编码为 base64
+            frame = Envelope({
+                "type": "offline_batch",
+                "batch_id": self._batch_id,
+                "messages": [
+                    {
+                        "type": "offline_message",
+                        "id": delivery_id,
+                        "sender_username": sender_username,
+                        "content_kind": content_kind,
+                        "content": content,
+                        "timestamp": sent_at.isoformat(),
+                    }
+                    for _, sent_at, content, content_kind, sender_username, delivery_id in rows
+                ],
+                "has_more": has_more,
+            })
+            if not await manager.send_to_session(self.user_id, self.session_id, frame):
+                break
+
+            try:
+                await asyncio.wait_for(self._acked.wait(), timeout=self.ack_timeout)
+            except asyncio.TimeoutError:
+                print(f"用户 {self.user_id} 未在 {self.ack_timeout}s 内确认离线消息批次 {self._batch_id}，停止回放。")
+                break
+
+            await db_executor.run(crud.mark_messages_as_read, message_ids=[row[0] for row in rows])
+            total += len(rows)
+            if not has_more:
+                break
+            last_id, last_sent_at = rows[-1][0], rows[-1][1]
+            after = (last_sent_at, last_id)
+
+        if total:
+            print(f"为用户 {self.user_id} 推送并确认了 {total} 条离线消息（{self._batch_id} 批）。")
@@ -0,0 +1,94 @@
+import asyncio
+from typing import List, Optional, Tuple
+
+from . import crud
+from .ciphertext import Ciphertext
+from .db_executor import db_executor
+
+# --- 离线消息写入合并配置 ---
+# 每条离线消息单独提交意味着每条消息一次 SQLite 事务和一次 fsync。
+# 写入器把所有连接在一个短窗口内产生的离线消息收集起来，用一个多行 INSERT 事务写入。
+# 收集窗口（秒）：第一条消息到达后最多等待这么久再写入
+OFFLINE_WRITE_BATCH_WINDOW_SECONDS = 0.005
+# 单个批次的最大行数，达到后立即写入，不再等待窗口结束
+OFFLINE_WRITE_MAX_BATCH = 500
+
+
+class OfflineMessageWriter:
+    """
+    离线消息的组提交（write-behind）写入器。
+    write() 只有在消息所在的批次提交成功后才返回，因此调用方可以在返回后再告诉发送方"消息已保存"；
+    批次写入失败时，该批次中每个 write() 调用都会收到同一个异常。
+    """
+
+    def __init__(self, window: float = OFFLINE_WRITE_BATCH_WINDOW_SECONDS, max_batch: int = OFFLINE_WRITE_MAX_BATCH):
+        self.window = window
+        self.max_batch = max_batch
+        # 当前正在收集的批次: (待插入的行, 等待该行落盘的 Future)
+        self._pending: List[Tuple[dict, asyncio.Future]] = []
+        self._window_task: Optional[asyncio.Task] = None
+        # 运行指标
+        self.batches = 0
+        self.rows = 0
+
+    async def write(
+        self, sender_id: int, receiver_id: int, encrypted_content: Ciphertext, delivery_id: Optional[str] = None
+    ):
+        """
+        把一条离线消息加入当前批次，并等待该批次提交完成。
+        :param delivery_id: 实时消息的 ID，离线推送时原样带给客户端用于去重
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((
+            {
+                "sender_id": sender_id, "receiver_id": receiver_id,
+                "encrypted_content": encrypted_content, "delivery_id": delivery_id,
+            },
+            future,
+        ))
+        if len(self._pending) >= self.max_batch:
+            asyncio.create_task(self.flush())
+        elif self._window_task is None or self._window_task.done():
+            self._window_task = asyncio.create_task(self._flush_after_window())
+        await future
+
+    async def _flush_after_window(self):
+        await asyncio.sleep(self.window)
+        await self.flush()
+
+    async def flush(self):
+        """
+        立即把当前收集到的消息作为一个事务写入，并唤醒等待这些消息的调用方。
+        写入期间到达的消息会进入下一个批次。
+        """
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+
+        try:
+            await db_executor.run(crud.create_messages, rows=[row for row, _ in batch])
+        except Exception as e:
+            print(f"批量写入 {len(batch)} 条离线消息时出错: {e}")
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        self.batches += 1
+        self.rows += len(batch)
+        for _, future in batch:
+            if not future.done():
+                future.set_result(None)
+
+    def stats(self) -> dict:
+        """返回已提交的批次数、行数、平均批大小和当前收集中的行数。"""
+        return {
+            "batches": self.batches,
+            "rows": self.rows,
+            "avg_batch_size": self.rows / self.batches if self.batches else 0.0,
+            "pending": len(self._pending),
+        }
+
+
+# 全局单例，所有 WebSocket 连接共享同一个写入器，才能把不同连接的消息合并到同一批次
+offline_writer = OfflineMessageWriter()
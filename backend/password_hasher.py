@@ -0,0 +1,144 @@
+import asyncio
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, Optional, Tuple
+
+from passlib.context import CryptContext
+
+# --- 密码哈希进程池配置 ---
+# bcrypt 是刻意设计的慢哈希，直接在 FastAPI 线程池中执行时，登录高峰会占满线程池，
+# 连 /me/contacts/online 这类廉价接口也要排在密码哈希后面。
+# 因此所有 bcrypt 计算都交给专用的进程池，进程数即同时进行的哈希计算数。
+PASSWORD_HASHER_MAX_WORKERS = 2
+# 同时排队或正在计算的哈希任务上限。达到上限后新请求立即被拒绝（503），
+# 而不是继续排队，让客户端按 Retry-After 稍后重试。
+PASSWORD_HASHER_MAX_PENDING = 32
+# 拒绝时建议客户端等待的秒数
+PASSWORD_HASHER_RETRY_AFTER_SECONDS = 2
+
+# 创建一个 CryptContext 实例，指定使用 bcrypt 算法
+# 定义在本模块中，使进程池的子进程只需导入本模块即可完成哈希计算
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+
+def _timed(func: Callable[..., Any], *args) -> Tuple[float, Any]:
+    """在子进程中执行，返回 (开始计算的时间, 结果)，用于统计排队时间。"""
+    started_at = time.time()
+    return started_at, func(*args)
+
+
+def _verify(plain_password: str, hashed_password: str) -> bool:
+    return pwd_context.verify(plain_password, hashed_password)
+
+
+def _hash(password: str) -> str:
+    return pwd_context.hash(password)
+
+
+class PasswordHasherBusy(Exception):
+    """哈希队列已满，请求被准入控制拒绝。"""
+
+    def __init__(self, retry_after: int = PASSWORD_HASHER_RETRY_AFTER_SECONDS):
+        super().__init__("密码哈希队列已满")
+        self.retry_after = retry_after
+
+
+class PasswordHasher:
+    """
+    在专用进程池中执行 bcrypt 哈希和校验，并对等待队列做准入控制。
+    进程池在第一次使用时才创建，使用 spawn 方式启动子进程，避免复制事件循环和数据库连接。
+    """
+
+    def __init__(
+        self,
+        max_workers: int = PASSWORD_HASHER_MAX_WORKERS,
+        max_pending: int = PASSWORD_HASHER_MAX_PENDING,
+        retry_after: int = PASSWORD_HASHER_RETRY_AFTER_SECONDS,
+    ):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.retry_after = retry_after
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._pending = 0
+        # 运行指标
+        self.completed = 0
+        self.rejected = 0
+        self.max_depth = 0
+        self.total_wait = 0.0
+        self.total_run = 0.0
+        self.max_wait = 0.0
+
+    @property
+    def pending(self) -> int:
+        """当前排队或正在计算的哈希任务数量。"""
+        return self._pending
+
+    async def verify(self, plain_password: str, hashed_password: str) -> bool:
+        """
+        在进程池中验证明文密码是否与哈希后的密码匹配
+        :raises PasswordHasherBusy: 哈希队列已满
+        """
+        return await self._submit(_verify, plain_password, hashed_password)
+
+    async def hash(self, password: str) -> str:
+        """
+        在进程池中计算给定密码的哈希值
+        :raises PasswordHasherBusy: 哈希队列已满
+        """
+        return await self._submit(_hash, password)
+
+    async def _submit(self, func: Callable[..., Any], *args) -> Any:
+        if self._pending >= self.max_pending:
+            self.rejected += 1
+            raise PasswordHasherBusy(self.retry_after)
+
+        self._pending += 1
+        self.max_depth = max(self.max_depth, self._pending)
+        submitted_at = time.time()
+        try:
+            loop = asyncio.get_running_loop()
+            started_at, result = await loop.run_in_executor(self._get_pool(), _timed, func, *args)
+        finally:
+            self._pending -= 1
+
+        finished_at = time.time()
+        wait = max(0.0, started_at - submitted_at)
+        self.completed += 1
+        self.total_wait += wait
+        self.total_run += max(0.0, finished_at - started_at)
+        self.max_wait = max(self.max_wait, wait)
+        return result
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return self._pool
+
+    def stats(self) -> dict:
+        """返回哈希队列深度、拒绝次数以及平均排队/计算时间（毫秒）。"""
+        completed = self.completed
+        return {
+            "workers": self.max_workers,
+            "queue_depth": self._pending,
+            "max_queue_depth": self.max_depth,
+            "max_pending": self.max_pending,
+            "completed": completed,
+            "rejected": self.rejected,
+            "avg_wait_ms": self.total_wait / completed * 1000 if completed else 0.0,
+            "max_wait_ms": self.max_wait * 1000,
+            "avg_hash_ms": self.total_run / completed * 1000 if completed else 0.0,
+        }
+
+    def shutdown(self):
+        """关闭进程池。"""
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
+
+
+# 全局单例，供登录和注册端点使用
+password_hasher = PasswordHasher()
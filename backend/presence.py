@@ -0,0 +1,78 @@
+import asyncio
+import json
+from datetime import datetime
+from typing import Dict, Optional, Tuple
+
+from . import crud
+from .connection_manager import manager
+from .db_executor import db_executor
+
+# 在线状态变化的合并窗口（秒）。窗口内同一用户的多次上下线只保留最终状态，
+# 每个好友每个窗口最多收到一条 presence 事件。
+PRESENCE_COALESCE_WINDOW_SECONDS = 1.0
+
+
+class PresenceNotifier:
+    """
+    在线状态扇出：只把上下线事件推送给用户已接受的好友，而不是广播给所有连接。
+    状态变化来自 PresenceRegistry 的集群范围转变，每次转变只由一个 worker 发布。
+    """
+
+    def __init__(self, window: float = PRESENCE_COALESCE_WINDOW_SECONDS):
+        self.window = window
+        # 窗口内待发布的状态变化: user_id -> (窗口开始前是否在线, 最终是否在线)，
+        # 用于过滤"上线又下线"这类无净变化的抖动
+        self._pending: Dict[int, Tuple[bool, bool]] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+
+    def publish(self, user_id: int, is_online: bool):
+        """
+        记录一次上线/离线转变，事件会在合并窗口结束时统一发送。
+        """
+        before = self._pending[user_id][0] if user_id in self._pending else not is_online
+        self._pending[user_id] = (before, is_online)
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_after_window())
+
+    async def _flush_after_window(self):
+        await asyncio.sleep(self.window)
+        try:
+            await self.flush()
+        except Exception as e:
+            print(f"推送在线状态时出错: {e}")
+
+    async def flush(self):
+        """
+        立即发送所有待发布的状态变化：按好友分组，每个好友一条 JSON 事件。
+        """
+        pending, self._pending = self._pending, {}
+
+        # 最终状态与窗口开始前相同（窗口内抖动），无需通知
+        final = {user_id: is_online for user_id, (before, is_online) in pending.items() if is_online != before}
+        if not final:
+            return
+
+        # 用户名来自用户目录缓存；好友关系来自内存邻接索引，先追上其他 worker 上的好友关系变化
+        # （每个合并窗口最多一次查询），再反转为 好友 -> 其关心的状态变化列表
+        entries = await db_executor.run(crud.get_user_entries, user_ids=list(final))
+        try:
+            await db_executor.run(crud.catch_up_friend_graph)
+        except Exception as e:
+            print(f"同步好友关系索引时出错: {e}")
+        changes = {
+            user_id: {"user_id": user_id, "username": entries[user_id].username, "is_online": is_online}
+            for user_id, is_online in final.items() if user_id in entries
+        }
+        changes_by_recipient: Dict[int, list] = {}
+        for user_id, change in changes.items():
+            for friend_id in crud.friend_graph.friends(user_id):
+                changes_by_recipient.setdefault(friend_id, []).append(change)
+
+        timestamp = datetime.utcnow().isoformat()
+        for recipient_id, users in changes_by_recipient.items():
+            event = {"type": "presence", "users": users, "timestamp": timestamp}
+            await manager.send_personal_message(json.dumps(event), recipient_id)
+
+
+# 全局单例，与 connection_manager.manager 一样在整个应用中共享
+presence_notifier = PresenceNotifier()
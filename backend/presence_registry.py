@@ -0,0 +1,221 @@
+import asyncio
+import heapq
+import time
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from . import crud
+from .db_executor import db_executor
+from .message_bus import LocalMessageBus, MessageBus
+from .presence import presence_notifier
+
+# --- 在线状态表配置 ---
+# HTTP 登录/心跳得到的在线租约时长（秒），超过后未续约的用户被视为离线
+PRESENCE_LEASE_SECONDS = 120.0
+# 检查到期租约的间隔（秒），用户最迟在租约到期后这么久被标记为离线
+PRESENCE_SWEEP_INTERVAL_SECONDS = 1.0
+# 把状态变化批量同步到 users 表的间隔（秒）
+PRESENCE_DB_SYNC_INTERVAL_SECONDS = 5.0
+
+
+class PresenceRegistry:
+    """
+    权威的内存在线状态表，在线判断是 O(1) 的集合查询，不再读取 users.is_online。
+    - 持有 WebSocket 连接的用户始终在线，直到最后一个设备断开；
+    - 只通过 HTTP 登录/心跳上线的用户持有一个租约，到期未续约即离线。
+    租约到期时间放在最小堆中（惰性删除），清扫任务每秒只弹出已到期的条目，而不是扫描所有用户。
+    每个 worker 只掌握自己处理过的连接和心跳，把"用户在本 worker 上是否在线"声明给消息总线；
+    总线汇总出集群视图（用户在任一 worker 上在线即在线），is_online 查询的是集群视图。
+    集群范围的上线/离线转变只由一个 worker 处理：记入脏表，由同步任务定期用两条批量 UPDATE 写回数据库，
+    同一次同步中记入好友的增量同步日志 (GET /me/sync)，并交给 PresenceNotifier 实时推送给好友。
+    """
+
+    def __init__(
+        self,
+        lease: float = PRESENCE_LEASE_SECONDS,
+        sweep_interval: float = PRESENCE_SWEEP_INTERVAL_SECONDS,
+        sync_interval: float = PRESENCE_DB_SYNC_INTERVAL_SECONDS,
+    ):
+        self.lease = lease
+        self.sweep_interval = sweep_interval
+        self.sync_interval = sync_interval
+        # user_id -> 租约到期时间 (time.monotonic)
+        self._deadlines: Dict[int, float] = {}
+        # 持有 WebSocket 连接的用户，不受租约到期影响
+        self._connected: Set[int] = set()
+        # (到期时间, user_id)，续约后旧条目保留在堆中，弹出时与 _deadlines 比对后丢弃
+        self._expiry_heap: List[Tuple[float, int]] = []
+        # 最近一次写入数据库的连接端点: user_id -> (IP, 端口)，用于判断心跳是否需要真正写库
+        self._endpoints: Dict[int, Tuple[str, int]] = {}
+        # 尚未写回数据库的状态变化: user_id -> 是否在线
+        self._dirty: Dict[int, bool] = {}
+        # 尚未记入增量同步日志的上线/离线转变: user_id -> 是否在线（续约不算转变）
+        self._transitions: Dict[int, bool] = {}
+        self._tasks: List[asyncio.Task] = []
+        self._bus: MessageBus = LocalMessageBus()
+        self._bus.set_presence_handlers(self._on_cluster_presence, self._drop_leases)
+
+    async def start(self, bus: Optional[MessageBus] = None):
+        """
+        从数据库加载上次记录为在线的用户作为初始租约，并启动清扫和同步任务。应在应用启动时、消息总线启动之后调用。
+        :param bus: 汇总各 worker 在线状态的消息总线（ConnectionManager 的总线），默认为进程内总线
+        """
+        if bus is not None:
+            self._bus = bus
+            bus.set_presence_handlers(self._on_cluster_presence, self._drop_leases)
+        now = time.monotonic()
+        utcnow = datetime.utcnow()
+        for user_id, last_seen in await db_executor.run(crud.get_online_user_last_seen):
+            remaining = self.lease
+            if last_seen is not None:
+                remaining -= (utcnow - last_seen.replace(tzinfo=None)).total_seconds()
+            self._set_deadline(user_id, now + max(0.0, remaining))
+            self._publish_local(user_id)
+        self._tasks = [
+            asyncio.create_task(self._sweep_loop()),
+            asyncio.create_task(self._sync_loop()),
+        ]
+
+    async def close(self):
+        """停止后台任务，并把尚未同步的状态变化写回数据库。"""
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+        await self.sync()
+
+    def is_online(self, user_id: int) -> bool:
+        """用户是否在任一 worker 上在线。"""
+        return self._bus.is_online(user_id)
+
+    def filter_online(self, user_ids: Iterable[int]) -> List[int]:
+        """返回给定用户中当前在线的那些。"""
+        return [user_id for user_id in user_ids if self.is_online(user_id)]
+
+    def touch(self, user_id: int):
+        """HTTP 登录或心跳：续约在线租约。下次同步时一并刷新数据库中的 last_seen。"""
+        self._dirty[user_id] = True
+        self._set_deadline(user_id, time.monotonic() + self.lease)
+        self._publish_local(user_id)
+
+    def heartbeat(self, user_id: int, ip_address: str, port: int) -> bool:
+        """
+        HTTP 心跳或登录：续约在线租约，并记录连接端点。
+        :return: 端点是否与上次记录的不同（调用方需要把新的 IP/端口写入数据库）
+        """
+        self.touch(user_id)
+        endpoint = (ip_address, port)
+        if self._endpoints.get(user_id) == endpoint:
+            return False
+        self._endpoints[user_id] = endpoint
+        return True
+
+    def connect(self, user_id: int):
+        """用户在本 worker 上的第一个 WebSocket 设备已连接。"""
+        self._connected.add(user_id)
+        self._publish_local(user_id)
+
+    def disconnect(self, user_id: int):
+        """
+        用户在本 worker 上的最后一个 WebSocket 设备已断开：清除所有 worker 上的租约（与登出一致），
+        其他 worker 上仍有 WebSocket 连接的用户保持在线。
+        """
+        self._connected.discard(user_id)
+        self._publish_local(user_id)
+        self._bus.drop_leases(user_id)
+
+    def set_offline(self, user_id: int):
+        """
+        登出：清除所有 worker 上的租约和端点记录（数据库中的 IP/端口已被清空，下次心跳会重新写入），
+        仍持有 WebSocket 连接的用户保持在线。
+        """
+        self._bus.drop_leases(user_id)
+
+    def _drop_leases(self, user_id: int):
+        """总线回调：某个 worker 上的用户登出或断开了最后一个 WebSocket。"""
+        self._endpoints.pop(user_id, None)
+        self._deadlines.pop(user_id, None)
+        self._publish_local(user_id)
+
+    def _publish_local(self, user_id: int):
+        """把用户在本 worker 上是否在线声明给总线；集群视图发生转变时总线回调 _on_cluster_presence。"""
+        self._bus.set_presence(user_id, user_id in self._connected or user_id in self._deadlines)
+
+    def _on_cluster_presence(self, user_id: int, is_online: bool, origin: bool):
+        """总线回调：用户在集群范围内上线或离线。只有 origin 为 True 的 worker 写库、记日志和通知好友。"""
+        if not origin:
+            return
+        self._dirty[user_id] = is_online
+        self._transitions[user_id] = is_online
+        presence_notifier.publish(user_id, is_online)
+
+    def _set_deadline(self, user_id: int, deadline: float):
+        self._deadlines[user_id] = deadline
+        heapq.heappush(self._expiry_heap, (deadline, user_id))
+
+    def expire(self, now: Optional[float] = None) -> List[int]:
+        """
+        弹出所有已到期的租约。用户在本 worker 上不再在线时声明给总线，
+        如果其他 worker 上也没有连接或租约，用户随即在集群范围内离线（写库并通知好友）。
+        :return: 本次在本 worker 上不再在线的用户 ID 列表
+        """
+        now = time.monotonic() if now is None else now
+        expired = []
+        while self._expiry_heap and self._expiry_heap[0][0] <= now:
+            deadline, user_id = heapq.heappop(self._expiry_heap)
+            # 已续约或已被显式下线的旧条目
+            if self._deadlines.get(user_id) != deadline:
+                continue
+            del self._deadlines[user_id]
+            # 租约到期的用户不再保留端点记录，重新上线后的第一次心跳会写一次库
+            self._endpoints.pop(user_id, None)
+            if user_id not in self._connected:
+                self._publish_local(user_id)
+                expired.append(user_id)
+        return expired
+
+    async def sync(self):
+        """把脏表中的状态变化用批量 UPDATE 写回 users 表，并把上线/离线转变记入增量同步日志。"""
+        if not self._dirty and not self._transitions:
+            return
+        dirty, self._dirty = self._dirty, {}
+        transitions, self._transitions = self._transitions, {}
+        online_ids = [user_id for user_id, online in dirty.items() if online]
+        offline_ids = [user_id for user_id, online in dirty.items() if not online]
+        try:
+            await db_executor.run(
+                crud.bulk_set_users_online, online_ids=online_ids, offline_ids=offline_ids, transitions=transitions
+            )
+        except Exception as e:
+            print(f"同步在线状态到数据库时出错: {e}")
+            # 保留失败的变化，等待下次同步；期间产生的新变化优先
+            for user_id, online in dirty.items():
+                self._dirty.setdefault(user_id, online)
+            for user_id, online in transitions.items():
+                self._transitions.setdefault(user_id, online)
+
+    async def _sweep_loop(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            expired = self.expire()
+            if expired:
+                print(f"在线状态表：用户 {expired} 在本 worker 上的租约已到期。")
+
+    async def _sync_loop(self):
+        while True:
+            await asyncio.sleep(self.sync_interval)
+            await self.sync()
+
+    def stats(self) -> dict:
+        return {
+            "online": self._bus.online_count(),
+            "connected": len(self._connected),
+            "leases": len(self._deadlines),
+            "endpoints": len(self._endpoints),
+            "heap_size": len(self._expiry_heap),
+            "dirty": len(self._dirty),
+            "transitions": len(self._transitions),
+        }
+
+
+# 全局单例
+presence_registry = PresenceRegistry()
@@ -0,0 +1,144 @@
+import time
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple
+
+from .wire_protocol import Envelope, OutboundMessage
+
+# --- 可靠投递配置 ---
+# 每个用户在内存中保留的未确认消息条数，超出后最旧的消息转存为离线消息
+RELIABLE_BUFFER_SIZE = 256
+# 用户的最后一个设备断开后，未确认消息在内存中保留的时间（秒），
+# 在此期间带 resume_from 重连可以直接从内存续传；超时后转存为离线消息
+RESUME_GRACE_SECONDS = 60.0
+
+
+class _Stream:
+    """单个接收者的未确认消息环形缓冲区。"""
+    __slots__ = ("entries", "expires_at")
+
+    def __init__(self):
+        # (序号, 已带序号的消息)，按序号递增排列
+        self.entries: Deque[Tuple[int, OutboundMessage]] = deque()
+        # 最后一个设备断开后的过期时间 (time.monotonic)，有设备在线时为 None
+        self.expires_at: Optional[float] = None
+
+
+class DeliveryBuffer:
+    """
+    实时消息的可靠投递状态：发给某个接收者的消息带着消息总线按接收者分配的递增序号，保留在有界的内存环形缓冲区中，
+    直到客户端用 {"type": "ack", "seq": n} 累积确认（确认 n 即确认了该接收者所有序号 <= n 的消息）。
+    客户端重连时带上 resume_from=<最后处理的序号>，服务器只重发其后仍未确认的消息，不需要查询数据库；
+    只有缓冲区溢出或断线超过宽限期时，未确认的消息才会被取出转存为离线消息（保留消息的 "id"，客户端据此去重）。
+    超过缓冲区中最大序号的 resume_from 来自计数器重置之前（例如服务器重启），不作为确认。
+    序号只消耗在至少一个设备接收的消息上：接收者离线时转存的消息退还序号，因此通常是连续的；
+    但并发发送时被拒收的序号若已不是最近分配的序号则无法退还，序号可能出现空缺，空缺不表示丢失消息。
+    所有方法都在事件循环中调用，不需要加锁。
+    注意: 缓冲区保存在进程内存中，多 worker 部署时续传只在重连到同一个 worker 时有效。
+    """
+
+    def __init__(self, size: int = RELIABLE_BUFFER_SIZE, grace: float = RESUME_GRACE_SECONDS):
+        self.size = size
+        self.grace = grace
+        self._streams: Dict[int, _Stream] = {}
+        # 运行指标
+        self.acked = 0
+        self.resumed = 0
+        self.spilled = 0
+
+    @staticmethod
+    def stamp(message: OutboundMessage, seq: int) -> OutboundMessage:
+        """
+        为一条 JSON 对象消息或 Envelope 加上 "seq" 字段。
+        JSON 文本直接拼接字符串，不重新解析和序列化消息。
+        """
+        if isinstance(message, Envelope):
+            return Envelope({"seq": seq, **message.fields})
+        return f'{{"seq": {seq}, {message[1:]}'
+
+    def record(self, user_id: int, seq: int, message: OutboundMessage) -> List[OutboundMessage]:
+        """
+        记录一条已放入出站队列、等待确认的消息。
+        :return: 因缓冲区溢出而被挤出的未确认消息（调用方应把它们转存为离线消息）
+        """
+        stream = self._streams.get(user_id)
+        if stream is None:
+            stream = self._streams[user_id] = _Stream()
+        stream.entries.append((seq, message))
+        evicted = []
+        while len(stream.entries) > self.size:
+            evicted.append(stream.entries.popleft()[1])
+        self.spilled += len(evicted)
+        return evicted
+
+    def ack(self, user_id: int, seq: int):
+        """累积确认: 丢弃该接收者所有序号 <= seq 的消息。"""
+        stream = self._streams.get(user_id)
+        if stream is None:
+            return
+        while stream.entries and stream.entries[0][0] <= seq:
+            stream.entries.popleft()
+            self.acked += 1
+        if not stream.entries and stream.expires_at is not None:
+            del self._streams[user_id]
+
+    def resume(self, user_id: int, resume_from: Optional[int]) -> List[OutboundMessage]:
+        """
+        设备连接时调用：resume_from 视为一次累积确认（超过缓冲区中最大序号的旧序号被忽略），
+        返回其后仍未确认、需要重发给该设备的消息。
+        """
+        stream = self._streams.get(user_id)
+        if stream is None:
+            return []
+        if resume_from is not None and stream.entries and resume_from <= stream.entries[-1][0]:
+            self.ack(user_id, resume_from)
+            stream = self._streams.get(user_id)
+            if stream is None:
+                return []
+        self.resumed += len(stream.entries)
+        return [message for _, message in stream.entries]
+
+    def attach(self, user_id: int):
+        """用户的第一个设备已连接，取消宽限期。"""
+        stream = self._streams.get(user_id)
+        if stream is not None:
+            stream.expires_at = None
+
+    def detach(self, user_id: int):
+        """用户的最后一个设备已断开，开始宽限期。"""
+        stream = self._streams.get(user_id)
+        if stream is None:
+            return
+        if not stream.entries:
+            del self._streams[user_id]
+            return
+        stream.expires_at = time.monotonic() + self.grace
+
+    def expire(self, now: Optional[float] = None) -> List[Tuple[int, List[OutboundMessage]]]:
+        """
+        取出所有宽限期已过的接收者的未确认消息。
+        :return: (user_id, 消息列表) 列表
+        """
+        now = time.monotonic() if now is None else now
+        expired = []
+        for user_id, stream in list(self._streams.items()):
+            if stream.expires_at is not None and stream.expires_at <= now:
+                del self._streams[user_id]
+                expired.append((user_id, [message for _, message in stream.entries]))
+                self.spilled += len(stream.entries)
+        return expired
+
+    def drain(self) -> List[Tuple[int, List[OutboundMessage]]]:
+        """取出所有未确认的消息（应用关闭时调用）。"""
+        drained = [(user_id, [message for _, message in stream.entries]) for user_id, stream in self._streams.items()]
+        self._streams.clear()
+        self.spilled += sum(len(messages) for _, messages in drained)
+        return drained
+
+    def stats(self) -> dict:
+        return {
+            "streams": len(self._streams),
+            "unacked": sum(len(stream.entries) for stream in self._streams.values()),
+            "acked": self.acked,
+            "resumed": self.resumed,
+            "spilled": self.spilled,
+        }
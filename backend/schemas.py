@@ -1,7 +1,13 @@
 # 导入 Pydantic 的 BaseModel 用于创建数据模型，EmailStr 用于验证邮箱格式
-from pydantic import BaseModel, EmailStr
+from pydantic import BaseModel, BeforeValidator, EmailStr
 # 导入 datetime 用于处理时间
 from datetime import datetime
+from typing import Annotated, Literal
+
+from ciphertext import CONTENT_KIND_TEXT, to_text
+
+# 数据库中以 BLOB 保存的二进制密文 (bytes) 在 JSON 响应中编码为标准 base64，文本内容原样返回
+CiphertextText = Annotated[str, BeforeValidator(to_text)]
 
 # --- 用户相关的 Pydantic 模型 (Schemas) ---
 
@@ -73,6 +79,19 @@ class Contact(ContactBase):
         "from_attributes": True
     }
 
+# 增量同步 (GET /me/sync) 的响应模型
+class SyncResponse(BaseModel):
+    # 下次同步时作为 since 传回的版本号
+    version: int
+    # 为 True 时返回的是全量快照 (contacts/pending/online)，客户端应整体替换本地状态；
+    # 为 False 时只返回 changes，按顺序应用即可
+    full: bool
+    changes: list[dict] = []
+    contacts: list[Contact] | None = None
+    pending: list[Contact] | None = None
+    # 当前在线的好友 ID
+    online: list[int] | None = None
+
 
 # --- 消息相关的 Pydantic 模型 (Schemas) ---
 
@@ -84,14 +103,16 @@ class MessageBase(BaseModel):
 
 # 创建消息时使用的数据模型
 class MessageCreate(MessageBase):
-    pass  # 目前没有额外字段
+    # encrypted_content 的种类："binary" 表示它是二进制密文的标准 base64 文本，服务器解码后以原始字节保存
+    content_kind: Literal["text", "binary"] = CONTENT_KIND_TEXT
 
 # 从数据库读取消息数据并返回给客户端时使用的数据模型
 class Message(BaseModel):
     id: int
     sender_id: int
     receiver_id: int
-    encrypted_content: str
+    encrypted_content: CiphertextText
+    content_kind: str  # "binary" 时 encrypted_content 是二进制密文的标准 base64 文本
     sent_at: datetime
 
     model_config = {
@@ -99,12 +120,46 @@ class Message(BaseModel):
     }
 
 
+# 会话列表 (GET /me/conversations) 中的一项
+class ConversationSummary(BaseModel):
+    peer_id: int
+    peer_username: str
+    last_message_id: int
+    last_message_at: datetime | None = None
+    last_message_sender_id: int
+    last_message_content: CiphertextText  # 最后一条消息的密文，用于会话列表预览
+    last_message_content_kind: str
+    unread_count: int
+
+
+
+# --- 附件相关的 Pydantic 模型 (Schemas) ---
+
+# 创建附件上传时的请求体
+class AttachmentCreate(BaseModel):
+    size: int  # 附件（密文）的总字节数
+    recipient_username: str  # 附件要发送给的用户；只有上传者和该用户可以下载
+
+# 附件上传的状态：客户端从 offset 处继续上传，每个分块不超过 chunk_size 字节
+class AttachmentUpload(BaseModel):
+    id: str
+    size: int
+    offset: int
+    chunk_size: int
+    complete: bool = False
+
 # --- 用于身份认证的 Token 相关模型 ---
 
 # 响应中返回给客户端的 Token 模型
 class Token(BaseModel):
     access_token: str
     token_type: str
+    # 登录和刷新时签发的刷新令牌；每个刷新令牌只能使用一次，刷新后客户端应改用新的令牌
+    refresh_token: str | None = None
+
+# 客户端用刷新令牌换取新访问令牌时的请求体
+class RefreshTokenRequest(BaseModel):
+    refresh_token: str
 
 # 解码后的 Token 中包含的数据模型
 class TokenData(BaseModel):
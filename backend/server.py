@@ -1,23 +1,43 @@
 # 导入 FastAPI 框架和相关工具
-from fastapi import FastAPI, Depends, HTTPException, APIRouter, status, Request, WebSocket, WebSocketDisconnect
+from fastapi import FastAPI, Depends, HTTPException, APIRouter, status, Request, WebSocket, WebSocketDisconnect, Query
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, Response
+from fastapi.concurrency import run_in_threadpool
 from fastapi.security import OAuth2PasswordRequestForm
 from datetime import timedelta, datetime
-from fastapi_utils.tasks import repeat_every
 # 导入 SQLAlchemy 的 Session 用于类型提示
 from sqlalchemy.orm import Session
-from typing import List
+from typing import List, Optional
 import json
+import asyncio
+import ipaddress
+import os
+import secrets
 
 # 从同级目录导入我们创建的模块
 from . import crud, models, schemas, auth
 from .database import engine, get_db
+from .migrations import run_migrations
 from .connection_manager import manager
+from .contact_events import contact_event_pusher
+from .offline_replay import OfflineReplay
+from .offline_writer import offline_writer
+from .presence_registry import presence_registry
+from .db_executor import db_executor
+from .user_directory import UserEntry
+from .ciphertext import from_declared
+from .password_hasher import password_hasher, PasswordHasherBusy
+from . import wire_protocol
+from .blob_store import (
+    ATTACHMENT_CHUNK_MAX_BYTES, ATTACHMENT_MAX_BYTES, ATTACHMENT_UPLOAD_EXPIRE_SECONDS,
+    UploadOffsetMismatch, blob_etag, blob_store, etag_matches, parse_range,
+)
+from .blob_response import BlobResponse
 
 # --- 数据库初始化 ---
-# 这行代码会根据我们在 models.py 中定义的 ORM 模型，在数据库中创建相应的表。
-# 它只在表不存在时创建，如果表已存在则不会有任何操作。
-models.Base.metadata.create_all(bind=engine)
+# 根据我们在 models.py 中定义的 ORM 模型，在数据库中创建不存在的表（create_all），
+# 已有数据库缺少的列和索引由迁移步骤补齐。多个 worker 同时启动时由 run_migrations 串行执行。
+run_migrations(engine, models.Base.metadata)
 
 # --- FastAPI 应用实例 ---
 # 创建一个 FastAPI 应用实例
@@ -41,38 +61,114 @@ app.add_middleware(
     allow_headers=["*"],  # 允许所有标头
 )
 
-# --- 后台定时任务 ---
+# --- 内存索引预热 ---
+@app.on_event("startup")
+async def load_friend_graph():
+    """启动时从 contacts 表加载好友邻接索引，之后由 crud 中的好友操作增量维护，其他 worker 的变化从增量同步日志中追赶。"""
+    edges = await db_executor.run(crud.load_friend_graph)
+    print(f"好友关系索引已加载: {edges} 条关系。")
+
+@app.on_event("startup")
+async def load_user_search_index():
+    """启动时从 users 表加载用户名搜索索引，之后由 crud.create_user 增量维护，其他 worker 注册的用户在搜索时补进来。"""
+    users = await db_executor.run(crud.load_user_search_index)
+    print(f"用户搜索索引已加载: {users} 个用户。")
+
+# --- 消息总线生命周期 ---
+@app.on_event("startup")
+async def start_message_bus():
+    """启动 ConnectionManager 的消息总线，多 worker 部署时负责跨进程路由。"""
+    manager.set_undelivered_handler(persist_undelivered_messages)
+    await manager.start()
+
+async def persist_undelivered_messages(user_id: int, messages: List[wire_protocol.OutboundMessage]):
+    """
+    可靠投递的实时消息最终未被客户端确认（缓冲区溢出、断线超过宽限期或应用关闭）时，
+    转存为离线消息，由接收者下次连接时的离线消息推送补发。
+    """
+    writes = []
+    for message in messages:
+        payload = wire_protocol.fields_of(message)
+        writes.append(offline_writer.write(
+            sender_id=payload["sender_id"], receiver_id=user_id,
+            encrypted_content=wire_protocol.content_value(payload["content"]),
+            delivery_id=payload.get("id"),
+        ))
+    results = await asyncio.gather(*writes, return_exceptions=True)
+    failed = sum(1 for result in results if isinstance(result, Exception))
+    if failed:
+        print(f"转存用户 {user_id} 的未确认消息时有 {failed} 条写入失败。")
+
+# --- 在线状态表生命周期 ---
 @app.on_event("startup")
-@repeat_every(seconds=60, wait_first=True)
-def cleanup_offline_users():
+async def start_presence_registry():
     """
-    每分钟运行一次的后台任务，用于清理离线用户。
-    它会检查所有标记为在线的用户，如果他们最后一次在线时间是2分钟前，
-    就将他们标记为离线。
+    启动内存在线状态表：它负责租约到期检测和定期批量同步 users.is_online，
+    取代了每分钟扫描一次超时用户的后台任务。各 worker 的在线状态通过消息总线汇总，因此在总线启动之后启动。
     """
-    db: Session = next(get_db())
-    timeout_threshold = datetime.utcnow() - timedelta(minutes=2)
-    
-    # 查找所有在线但已超时的用户
-    offline_users = db.query(models.User).filter(
-        models.User.is_online == True,
-        models.User.last_seen < timeout_threshold
-    ).all()
-
-    if offline_users:
-        user_names = [user.username for user in offline_users]
-        print(f"后台任务：检测到超时的用户: {user_names}，将其标记为离线。")
-        for user in offline_users:
-            user.is_online = False  # type: ignore
-        db.commit()
+    await presence_registry.start(manager.bus)
+
+@app.on_event("shutdown")
+async def stop_presence_registry():
+    await presence_registry.close()
+
+@app.on_event("startup")
+async def start_contact_event_pusher():
+    """把好友请求和好友关系的变化实时推送到相关用户的 WebSocket 连接。"""
+    contact_event_pusher.start()
+
+# --- 过期附件上传清理 ---
+# 每隔这么久（秒）清理一次超过 ATTACHMENT_UPLOAD_EXPIRE_SECONDS 仍未完成的附件上传
+ATTACHMENT_CLEANUP_INTERVAL_SECONDS = 3600
+_attachment_cleanup_task: Optional[asyncio.Task] = None
+
+@app.on_event("startup")
+async def start_attachment_cleanup():
+    global _attachment_cleanup_task
+    _attachment_cleanup_task = asyncio.create_task(clean_expired_uploads())
+
+async def clean_expired_uploads():
+    """删除磁盘上过期的未完成上传及其附件记录；客户端续传时会收到 404，需要重新创建上传。"""
+    while True:
+        await asyncio.sleep(ATTACHMENT_CLEANUP_INTERVAL_SECONDS)
+        try:
+            expired = await run_in_threadpool(blob_store.expired_uploads, ATTACHMENT_UPLOAD_EXPIRE_SECONDS)
+            for upload_id in expired:
+                await run_in_threadpool(blob_store.discard, upload_id)
+            await db_executor.run(crud.delete_incomplete_attachments, attachment_ids=expired)
+        except Exception as e:
+            print(f"清理过期附件上传时出错: {e}")
+
+@app.on_event("shutdown")
+async def stop_attachment_cleanup():
+    if _attachment_cleanup_task is not None:
+        _attachment_cleanup_task.cancel()
+
+@app.on_event("shutdown")
+async def stop_message_bus():
+    contact_event_pusher.close()
+    await manager.close()
+    await offline_writer.flush()
+    db_executor.shutdown()
+    password_hasher.shutdown()
+
+# --- 密码哈希准入控制 ---
+@app.exception_handler(PasswordHasherBusy)
+async def password_hasher_busy_handler(request: Request, exc: PasswordHasherBusy):
+    """哈希队列已满时快速拒绝，让客户端按 Retry-After 稍后重试，而不是占用线程池排队。"""
+    return JSONResponse(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={"detail": "服务器繁忙，请稍后重试"},
+        headers={"Retry-After": str(exc.retry_after)},
+    )
 
 # --- 认证 API (登录) ---
 @app.post("/token", response_model=schemas.Token)
-def login_for_access_token(request: Request, db: Session = Depends(get_db), form_data: OAuth2PasswordRequestForm = Depends()):
-    # 从数据库中通过用户名查找用户
-    user = crud.get_user_by_username(db, username=form_data.username)
-    # 验证用户是否存在以及密码是否正确
-    if not user or not auth.verify_password(form_data.password, user.password_hash):
+async def login_for_access_token(request: Request, form_data: OAuth2PasswordRequestForm = Depends()):
+    # 从数据库中通过用户名查找用户（在数据库线程中执行）
+    user = await db_executor.run(crud.get_user_by_username, username=form_data.username)
+    # 验证用户是否存在以及密码是否正确；bcrypt 在专用进程池中计算，队列满时返回 503
+    if not user or not await password_hasher.verify(form_data.password, user.password_hash):  # type: ignore
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="用户名或密码不正确",
@@ -87,52 +183,163 @@ def login_for_access_token(request: Request, db: Session = Depends(get_db), form
         client_port = request.client.port
     
     # 更新用户的在线状态、IP 和端口
-    crud.update_user_status(db=db, user=user, is_online=True, ip_address=client_ip, port=client_port)
+    await db_executor.run(crud.update_user_status, user=user, is_online=True, ip_address=client_ip, port=client_port)
+    presence_registry.heartbeat(user.id, client_ip, client_port)  # type: ignore
     
     # 创建访问令牌
     access_token_expires = timedelta(minutes=auth.ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = auth.create_access_token(
         data={"sub": user.username}, expires_delta=access_token_expires
     )
+    refresh_token = await db_executor.run(auth.create_refresh_token, user_id=user.id, username=user.username)
     # 返回令牌
-    return {"access_token": access_token, "token_type": "bearer"}
+    return {"access_token": access_token, "token_type": "bearer", "refresh_token": refresh_token}
+
+@app.post("/token/refresh", response_model=schemas.Token)
+async def refresh_access_token(refresh_request: schemas.RefreshTokenRequest):
+    """
+    用刷新令牌换取新的访问令牌和新的刷新令牌，提交的刷新令牌随即失效（令牌轮换）。
+    不计算密码哈希，也不写 users 表；刷新令牌表的读写在数据库线程中执行。
+    """
+    username, refresh_token = await db_executor.run(auth.rotate_refresh_token, token=refresh_request.refresh_token)
+    access_token_expires = timedelta(minutes=auth.ACCESS_TOKEN_EXPIRE_MINUTES)
+    access_token = auth.create_access_token(
+        data={"sub": username}, expires_delta=access_token_expires
+    )
+    return {"access_token": access_token, "token_type": "bearer", "refresh_token": refresh_token}
 
 # --- "我" (当前用户) 相关的 API ---
 @app.put("/me/connection-info", response_model=schemas.UserPublic)
-def update_my_connection_info(
+async def update_my_connection_info(
     info_update: schemas.ConnectionInfoUpdate,
     request: Request,
-    db: Session = Depends(get_db),
-    current_user: models.User = Depends(auth.get_current_active_user)
+    current_user: UserEntry = Depends(auth.get_current_active_user)
 ):
     """
     更新当前用户的连接信息（IP、端口）并将会话标记为在线。
-    客户端应该在登录后和需要更新网络状态时调用此接口。
+    客户端应该在登录后和需要更新网络状态时调用此接口，心跳也通过它续约在线状态。
+    IP 和端口未变化时只在内存在线状态表中续约（last_seen 由状态表定期批量写回），不访问数据库；
+    只有 IP 或端口变化时才立即写入 users 表。
     """
     client_ip = "127.0.0.1"
     if request.client:
         client_ip = request.client.host
 
-    updated_user = crud.update_user_status(
-        db=db,
-        user=current_user,
-        is_online=True,
-        ip_address=client_ip,
-        port=info_update.port
-    )
-    return updated_user
+    if presence_registry.heartbeat(current_user.id, client_ip, info_update.port):
+        await db_executor.run(
+            crud.update_user_connection,
+            user_id=current_user.id,
+            is_online=True,
+            ip_address=client_ip,
+            port=info_update.port,
+        )
+    return {"id": current_user.id, "username": current_user.username, "is_online": True}
 
-@app.post("/logout")
-def logout(
+@app.get("/me/sync", response_model=schemas.SyncResponse, responses={304: {"description": "自 since 以来没有任何变化"}})
+async def sync_my_state(
+    since: Optional[int] = None,
+    current_user: UserEntry = Depends(auth.get_current_active_user)
+):
+    """
+    增量同步好友、收到的好友请求和好友在线状态，替代对三个列表接口的轮询。
+    - 不带 since，或 since 无效（超前于当前版本，例如来自旧版本服务器的内存日志）时返回全量快照 (full=true)；
+    - 自 since 以来没有变化时返回 304，不返回响应体；
+    - 否则只返回 since 之后的变更 (full=false)，每个对象只保留最终状态。
+    客户端每次都应保存响应中的 version，作为下一次请求的 since。
+    变更日志保存在数据库中，版本号在所有 worker 之间一致；增量路径是一次按索引的查询。
+    """
+    if since is not None:
+        delta = await db_executor.run(crud.change_log.changes_since, user_id=current_user.id, since=since)
+        if delta is not None:
+            version, changes = delta
+            if not changes:
+                return Response(status_code=status.HTTP_304_NOT_MODIFIED)
+            return {"version": version, "full": False, "changes": changes}
+
+    version, contacts, pending = await db_executor.run(crud.get_sync_snapshot, user_id=current_user.id)
+    # 好友列表直接取自快照，而不是本 worker 的内存好友索引（可能还没追上其他 worker 的变化）
+    online = presence_registry.filter_online([contact.friend_id for contact in contacts])
+    return {
+        "version": version,
+        "full": True,
+        "contacts": contacts,
+        "pending": pending,
+        "online": online,
+    }
+
+@app.get("/me/conversations", response_model=List[schemas.ConversationSummary])
+def read_my_conversations(
+    before: Optional[int] = None,
+    limit: int = 50,
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(auth.get_current_active_user)
+    current_user: UserEntry = Depends(auth.get_current_active_user)
 ):
     """
-    处理用户登出，将其在线状态设置为 False。
+    获取当前用户的会话列表：每个聊过天的对方、最后一条消息和未读数，按最后一条消息从新到旧排列。
+    数据来自增量维护的会话摘要表，一次索引读取，不会改变消息的已读状态。
+    - **before**: 上一页最后一个会话的 `last_message_id`，省略时从最新的会话开始
+    - **limit**: 每页条数，最多 100
+    """
+    rows = crud.get_conversations(db, user_id=current_user.id, before=before, limit=limit)
+    return [
+        {
+            "peer_id": peer_id,
+            "peer_username": peer_username,
+            "last_message_id": last_message_id,
+            "last_message_at": last_message_at,
+            "last_message_sender_id": last_message_sender_id,
+            "last_message_content": last_message_content,
+            "last_message_content_kind": last_message_content_kind,
+            "unread_count": unread_count,
+        }
+        for (
+            peer_id, peer_username, last_message_id, last_message_at, last_message_sender_id,
+            last_message_content, last_message_content_kind, unread_count,
+        ) in rows
+    ]
+
+@app.post("/logout")
+async def logout(current_user: UserEntry = Depends(auth.get_current_active_user)):
+    """
+    处理用户登出，将其在线状态设置为 False，并吊销该用户已签发的刷新令牌。
     """
-    crud.update_user_status(db=db, user=current_user, is_online=False)
+    await db_executor.run(crud.revoke_refresh_tokens, user_id=current_user.id)
+    await db_executor.run(crud.update_user_connection, user_id=current_user.id, is_online=False)
+    presence_registry.set_offline(current_user.id)
     return {"message": "Successfully logged out"}
 
+# --- 运行指标 ---
+# 指标包含在线人数、会话数等运营数据，默认只允许本机（回环地址）访问，由运维在服务器上抓取。
+# 监控系统需要从内网其他主机抓取时设置 SECURECHAT_METRICS_ALLOW_REMOTE=1，并在网关上屏蔽外部对 /metrics 的访问。
+METRICS_ALLOW_REMOTE = os.environ.get("SECURECHAT_METRICS_ALLOW_REMOTE") == "1"
+
+def _is_loopback(host: Optional[str]) -> bool:
+    try:
+        return host is not None and ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+@app.get("/metrics", tags=["Metrics"])
+async def get_metrics(request: Request):
+    """
+    返回服务端缓存与队列的运行指标，便于观察热路径的命中率和积压情况。
+    在事件循环中执行：连接管理器的会话表只在事件循环线程中修改，不能从线程池中遍历。
+    """
+    if not METRICS_ALLOW_REMOTE and not _is_loopback(request.client.host if request.client else None):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="运行指标只允许本机访问")
+    return {
+        "connections": manager.stats(),
+        "user_directory": crud.user_directory.stats(),
+        "db_executor": {"pending": db_executor.pending},
+        "password_hasher": password_hasher.stats(),
+        "offline_writer": offline_writer.stats(),
+        "presence_registry": presence_registry.stats(),
+        "friend_graph": crud.friend_graph.stats(),
+        "user_search": crud.user_search_index.stats(),
+        "change_log": crud.change_log.stats(),
+        "reliable_delivery": manager.delivery.stats(),
+    }
+
 # --- 用户 API 路由器 ---
 # 创建一个 API 路由器，用于组织与用户相关的 API 端点
 router = APIRouter(
@@ -148,20 +355,20 @@ contact_router = APIRouter(
 )
 
 @router.post("/", response_model=schemas.User)
-def create_user(user_data: schemas.UserCreate, request: Request, db: Session = Depends(get_db)):
+async def create_user(user_data: schemas.UserCreate, request: Request):
     """
     创建新用户的 API 端点。
     - **user_data**: 请求体，需要符合 `schemas.UserCreate` 的结构。
     - **request**: FastAPI 的请求对象，用于获取客户端信息。
-    - **db**: 依赖注入，自动获取数据库会话。
+    数据库操作在数据库线程中执行，密码哈希在专用进程池中计算，队列满时返回 503。
     """
     # 检查用户名是否已存在
-    db_user = crud.get_user_by_username(db, username=user_data.username)
+    db_user = await db_executor.run(crud.get_user_entry_by_username, username=user_data.username)
     if db_user:
         raise HTTPException(status_code=400, detail="用户名已存在")
     
     # 检查邮箱是否已存在
-    db_user_email = crud.get_user_by_email(db, email=user_data.email)
+    db_user_email = await db_executor.run(crud.get_user_by_email, email=user_data.email)
     if db_user_email:
         raise HTTPException(status_code=400, detail="邮箱已被注册")
     
@@ -170,37 +377,45 @@ def create_user(user_data: schemas.UserCreate, request: Request, db: Session = D
     if request.client:
         client_ip = request.client.host
 
+    hashed_password = await password_hasher.hash(user_data.password)
+
     # 调用 crud 函数创建用户，并传入 IP 地址
-    return crud.create_user(db=db, user_data=user_data, ip_address=client_ip)
+    return await db_executor.run(crud.create_user, user_data=user_data, ip_address=client_ip, hashed_password=hashed_password)
 
 @router.get("/search/{query}", response_model=List[schemas.UserPublic])
-def search_users(
+async def search_users(
     query: str,
-    db: Session = Depends(get_db),
-    current_user: models.User = Depends(auth.get_current_active_user)
+    after: Optional[str] = None,
+    limit: int = 10,
+    current_user: UserEntry = Depends(auth.get_current_active_user)
 ):
     """
-    根据用户名关键词模糊搜索用户。
+    根据用户名关键词搜索用户（不区分大小写）。
+    结果依次为完全匹配、前缀匹配、子串匹配；传入上一页最后一个用户名作为 after 获取下一页。
+    搜索使用内存索引，只用一次主键范围查询补上其他 worker 注册的新用户；在线状态来自内存在线状态表。
     """
-    users = crud.search_users_by_username(db, username_query=query)
-    return users
+    users = await db_executor.run(crud.search_users_by_username, username_query=query, after=after, limit=limit)
+    return [
+        {"id": user.id, "username": user.username, "is_online": presence_registry.is_online(user.id)}
+        for user in users
+    ]
 
 @router.get("/{username}/connection-info", response_model=schemas.UserConnectionInfo)
 def get_user_connection_info(
     username: str,
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(auth.get_current_active_user)
+    current_user: UserEntry = Depends(auth.get_current_active_user)
 ):
     """
     获取指定用户的连接信息（公钥、IP、端口）以用于P2P通信。
-    只有当目标用户在线时才能获取成功。
+    只有当目标用户在线时才能获取成功；用户连接在任一 worker 上都算在线。
     """
     target_user = crud.get_user_by_username(db, username=username)
 
     if not target_user:
         raise HTTPException(status_code=404, detail="用户不存在")
 
-    if not target_user.is_online:  # type: ignore
+    if not presence_registry.is_online(target_user.id):  # type: ignore
         raise HTTPException(status_code=404, detail="用户当前不在线")
 
     return target_user
@@ -209,7 +424,7 @@ def get_user_connection_info(
 def add_new_contact(
     contact: schemas.ContactCreate,
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(auth.get_current_active_user)
+    current_user: UserEntry = Depends(auth.get_current_active_user)
 ):
     """
     发送一个新的好友请求。
@@ -232,7 +447,7 @@ def add_new_contact(
 def accept_friend_request(
     friend_id: int,
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(auth.get_current_active_user)
+    current_user: UserEntry = Depends(auth.get_current_active_user)
 ):
     """
     接受一个好友请求。
@@ -257,7 +472,7 @@ def accept_friend_request(
 def delete_friend_or_request(
     friend_id: int,
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(auth.get_current_active_user)
+    current_user: UserEntry = Depends(auth.get_current_active_user)
 ):
     """
     删除好友或拒绝/取消好友请求。
@@ -279,7 +494,7 @@ def read_contacts(
     skip: int = 0,
     limit: int = 100,
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(auth.get_current_active_user)
+    current_user: UserEntry = Depends(auth.get_current_active_user)
 ):
     """
     获取当前用户的好友列表。
@@ -292,7 +507,7 @@ def read_pending_requests(
     skip: int = 0,
     limit: int = 100,
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(auth.get_current_active_user)
+    current_user: UserEntry = Depends(auth.get_current_active_user)
 ):
     """
     获取当前用户收到的、待处理的好友请求列表。
@@ -306,13 +521,13 @@ def read_pending_requests(
 @contact_router.get("/online", response_model=List[schemas.UserConnectionInfo])
 def get_online_friends_info(
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(auth.get_current_active_user)
+    current_user: UserEntry = Depends(auth.get_current_active_user)
 ):
     """
     高效地获取当前用户所有在线好友的连接信息列表。
     """
     assert current_user.id is not None
-    online_friends = crud.get_online_friends(db, user_id=current_user.id) # type: ignore
+    online_friends = crud.get_online_friends(db, user_id=current_user.id, is_online=presence_registry.is_online) # type: ignore
     return online_friends
 
 # --- 消息 API 路由器 ---
@@ -326,14 +541,14 @@ message_router = APIRouter(
 def send_offline_message(
     message_data: schemas.MessageCreate,
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(auth.get_current_active_user)
+    current_user: UserEntry = Depends(auth.get_current_active_user)
 ):
     """
     发送离线消息。
     - 检查接收者是否存在。
     - 如果存在，则将加密消息存储到数据库。
     """
-    recipient = crud.get_user_by_username(db, username=message_data.recipient_username)
+    recipient = crud.get_user_entry_by_username(db, username=message_data.recipient_username)
     if not recipient:
         raise HTTPException(status_code=404, detail="接收者用户不存在")
 
@@ -341,17 +556,23 @@ def send_offline_message(
     assert current_user.id is not None
     assert recipient.id is not None
 
+    # 声明为 binary 的密文在这里解码为字节，以原始字节保存
+    try:
+        encrypted_content = from_declared(message_data.encrypted_content, message_data.content_kind)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="encrypted_content 不是有效的标准 base64")
+
     return crud.create_message(
         db=db,
         sender_id=current_user.id, # type: ignore
         receiver_id=recipient.id, # type: ignore
-        encrypted_content=message_data.encrypted_content
+        encrypted_content=encrypted_content
     )
 
 @message_router.get("/", response_model=List[schemas.Message])
 def get_my_offline_messages(
     db: Session = Depends(get_db),
-    current_user: models.User = Depends(auth.get_current_active_user)
+    current_user: UserEntry = Depends(auth.get_current_active_user)
 ):
     """
     获取当前用户的所有离线消息，并在获取后将其标记为已读。
@@ -371,23 +592,228 @@ def get_my_offline_messages(
     # 3. 返回这些消息
     return unread_messages
 
+@message_router.get("/with/{username}", response_model=List[schemas.Message])
+def get_conversation_history(
+    username: str,
+    before: Optional[int] = None,
+    limit: int = 50,
+    db: Session = Depends(get_db),
+    current_user: UserEntry = Depends(auth.get_current_active_user)
+):
+    """
+    获取与指定用户之间的会话历史（双方发送的、已保存到服务器的消息），按时间从新到旧排列。
+    - **before**: 上一页最后一条（最早的）消息的 `id`，省略时从最新的消息开始
+    - **limit**: 每页条数，最多 100；返回条数少于 limit 说明已经没有更早的消息
+    不会改变消息的已读状态。
+    """
+    peer = crud.get_user_entry_by_username(db, username=username)
+    if not peer:
+        raise HTTPException(status_code=404, detail="用户不存在")
+
+    return crud.get_conversation_page(db, user_id=current_user.id, peer_id=peer.id, before=before, limit=limit)
+
+# --- 附件 API 路由器 ---
+# 附件（加密后的文件）分块上传到 blob 存储，聊天消息中只携带附件 ID。
+# 创建上传时声明接收者，上传者通过聊天消息把附件 ID 发给接收者；只有上传者和接收者可以下载，
+# 其他用户即使得到 ID 也只会收到 404。内容是客户端加密后的密文，服务器不解析。
+attachment_router = APIRouter(
+    prefix="/attachments",
+    tags=["Attachments"],
+    dependencies=[Depends(auth.get_current_active_user)]
+)
+
+def _upload_status(attachment: models.Attachment, offset: int) -> dict:
+    return {
+        "id": attachment.id,
+        "size": attachment.size,
+        "offset": offset,
+        "chunk_size": ATTACHMENT_CHUNK_MAX_BYTES,
+        "complete": attachment.sha256 is not None,
+    }
+
+async def _get_own_upload(attachment_id: str, current_user: UserEntry) -> models.Attachment:
+    attachment = await db_executor.run(crud.get_attachment, attachment_id=attachment_id)
+    if attachment is None or attachment.owner_id != current_user.id:
+        raise HTTPException(status_code=404, detail="附件不存在")
+    return attachment
+
+@attachment_router.post("/", response_model=schemas.AttachmentUpload, status_code=status.HTTP_201_CREATED)
+async def create_attachment_upload(
+    attachment_data: schemas.AttachmentCreate,
+    current_user: UserEntry = Depends(auth.get_current_active_user)
+):
+    """
+    创建一个附件上传，返回附件 ID 和分块大小上限。
+    - **size**: 附件（密文）的总字节数
+    - **recipient_username**: 附件要发送给的用户
+    """
+    if attachment_data.size <= 0:
+        raise HTTPException(status_code=400, detail="附件不能为空")
+    if attachment_data.size > ATTACHMENT_MAX_BYTES:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail="附件过大")
+    recipient = await db_executor.run(crud.get_user_entry_by_username, username=attachment_data.recipient_username)
+    if recipient is None:
+        raise HTTPException(status_code=404, detail="接收者不存在")
+
+    attachment_id = secrets.token_hex(16)
+    await run_in_threadpool(blob_store.create_upload, attachment_id)
+    attachment = await db_executor.run(
+        crud.create_attachment,
+        attachment_id=attachment_id,
+        owner_id=current_user.id,
+        recipient_id=recipient.id,
+        size=attachment_data.size,
+    )
+    return _upload_status(attachment, 0)
+
+@attachment_router.get("/{attachment_id}/upload", response_model=schemas.AttachmentUpload)
+async def get_attachment_upload(
+    attachment_id: str,
+    current_user: UserEntry = Depends(auth.get_current_active_user)
+):
+    """
+    查询上传进度。断线或刷新页面后，客户端从返回的 offset 处继续上传。
+    """
+    attachment = await _get_own_upload(attachment_id, current_user)
+    if attachment.sha256 is not None:
+        return _upload_status(attachment, attachment.size)
+    offset = blob_store.upload_offset(attachment_id)
+    if offset is None:
+        raise HTTPException(status_code=404, detail="上传已过期，请重新上传")
+    return _upload_status(attachment, offset)
+
+@attachment_router.put(
+    "/{attachment_id}/upload",
+    response_model=schemas.AttachmentUpload,
+    responses={409: {"description": "offset 与已上传的字节数不一致，响应中的 offset 为正确的续传位置"}},
+)
+async def upload_attachment_chunk(
+    attachment_id: str,
+    offset: int,
+    request: Request,
+    current_user: UserEntry = Depends(auth.get_current_active_user)
+):
+    """
+    上传一个分块：请求体是原始字节 (application/octet-stream)，从附件的第 offset 个字节开始。
+    分块必须按顺序上传，最后一个分块写入后上传自动完成。
+    - **offset**: 分块在附件中的起始位置，必须等于已上传的字节数
+    """
+    attachment = await _get_own_upload(attachment_id, current_user)
+    if attachment.sha256 is not None:
+        raise HTTPException(status_code=400, detail="附件已上传完成")
+
+    chunks = []
+    received = 0
+    async for chunk in request.stream():
+        received += len(chunk)
+        if received > ATTACHMENT_CHUNK_MAX_BYTES:
+            raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail="分块过大")
+        chunks.append(chunk)
+    if not received:
+        raise HTTPException(status_code=400, detail="分块不能为空")
+    if offset + received > attachment.size:
+        raise HTTPException(status_code=400, detail="分块超出附件的声明大小")
+
+    try:
+        new_offset = await run_in_threadpool(blob_store.append, attachment_id, offset, b"".join(chunks))
+    except UploadOffsetMismatch as e:
+        return JSONResponse(
+            status_code=status.HTTP_409_CONFLICT,
+            content={"detail": "分块偏移不正确", "offset": e.offset},
+        )
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="上传已过期，请重新上传")
+
+    if new_offset == attachment.size:
+        sha256, _ = await run_in_threadpool(blob_store.commit, attachment_id)
+        await db_executor.run(crud.complete_attachment, attachment_id=attachment_id, sha256=sha256)
+        attachment.sha256 = sha256  # type: ignore
+    return _upload_status(attachment, new_offset)
+
+@attachment_router.get(
+    "/{attachment_id}",
+    responses={
+        206: {"description": "Range 请求的部分内容"},
+        304: {"description": "If-None-Match 与附件的 ETag 匹配，客户端缓存仍然有效"},
+    },
+)
+async def download_attachment(
+    attachment_id: str,
+    request: Request,
+    current_user: UserEntry = Depends(auth.get_current_active_user)
+):
+    """
+    下载附件的密文，只有上传者和接收者可以下载。
+    支持单个字节范围的 Range 请求（断点续传），例如 `Range: bytes=1048576-`。
+    ETag 是内容的 SHA-256：If-None-Match 匹配时返回 304；If-Range 不匹配时忽略 Range 返回完整内容。
+    内容通过内存映射（或服务器支持时的 sendfile）发送，不经过 Python 层的读缓冲区。
+    """
+    attachment = await db_executor.run(crud.get_attachment, attachment_id=attachment_id)
+    if (
+        attachment is None
+        or attachment.sha256 is None
+        or current_user.id not in (attachment.owner_id, attachment.recipient_id)
+    ):
+        # 无权下载与不存在返回相同的响应，不暴露附件 ID 是否有效
+        raise HTTPException(status_code=404, detail="附件不存在")
+
+    size = attachment.size
+    etag = blob_etag(attachment.sha256)
+    headers = {
+        "Accept-Ranges": "bytes",
+        "ETag": etag,
+        # 附件 ID 对应的内容上传完成后不会再改变
+        "Cache-Control": "private, max-age=31536000, immutable",
+    }
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if if_range is not None and not etag_matches(if_range, etag):
+        # 客户端已有的部分内容不是这个版本，返回完整内容
+        range_header = None
+    try:
+        byte_range = parse_range(range_header, size)
+    except ValueError:
+        return Response(
+            status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+            headers={**headers, "Content-Range": f"bytes */{size}"},
+        )
+
+    status_code = status.HTTP_200_OK
+    start, end = 0, size - 1
+    if byte_range is not None:
+        start, end = byte_range
+        status_code = status.HTTP_206_PARTIAL_CONTENT
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    headers["Content-Length"] = str(end - start + 1)
+    return BlobResponse(attachment.sha256, start, end, status_code=status_code, headers=headers)
+
 # 将用户路由器包含到主应用中
 app.include_router(router)
 app.include_router(contact_router)
 app.include_router(message_router)
+app.include_router(attachment_router)
 
 # --- WebSocket 端点 ---
 @app.websocket("/ws")
 async def websocket_endpoint(
     websocket: WebSocket,
-    db: Session = Depends(get_db),
-    user: models.User = Depends(auth.get_current_user_from_ws)
+    device: Optional[str] = Query(None),
+    resume_from: Optional[int] = Query(None),
+    user: UserEntry = Depends(auth.get_current_user_from_ws)
 ):
     """
     处理 WebSocket 连接、消息转发和离线消息。
-    - 连接时: 验证用户，推送离线消息。
-    - 接收消息时: 根据接收者是否在线，直接转发或存为离线消息。
-    - 断开时: 更新用户在线状态。
+    同一用户可以同时在多个设备上连接，每个连接是一个独立的设备会话。
+    握手时客户端可以通过 Sec-WebSocket-Protocol 请求二进制协议或带分离消息体的 JSON 协议（见 wire_protocol），
+    否则使用普通 JSON 文本帧。
+    - 连接时: 验证用户，重发序号大于 resume_from 的未确认实时消息，
+      并向当前设备分批推送离线消息，客户端确认每批后才标记为已读。
+    - 接收消息时: 根据接收者是否在线，转发给其所有设备（带序号，等待 ack）或存为离线消息。
+    - 断开时: 最后一个设备断开后才更新用户为离线。
+    所有数据库操作都通过 db_executor 在线程池中执行，事件循环不会阻塞在数据库 I/O 上。
     """
     if not user or not user.id: # type: ignore
         await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
@@ -396,82 +822,101 @@ async def websocket_endpoint(
     user_id = user.id
     
     # --- 1. 用户连接 ---
-    await manager.connect(websocket, user_id) # type: ignore
-    crud.update_user_status(db=db, user=user, is_online=True)
+    protocol = wire_protocol.negotiate(websocket.scope.get("subprotocols"))
+    session_id, first_device = await manager.connect(websocket, user_id, device=device, protocol=protocol) # type: ignore
+    if first_device:
+        # 用户在集群范围内上线时，由在线状态表写库并通知好友
+        presence_registry.connect(user_id) # type: ignore
+    # 重连续传：只重发内存中仍未确认的实时消息，不查询数据库
+    manager.resume(user_id, session_id, resume_from) # type: ignore
 
     # --- 2. 推送离线消息 ---
-    try:
-        unread_messages = crud.get_unread_messages_for_user(db, user_id=user_id) # type: ignore
-        if unread_messages:
-            print(f"为用户 {user.username} (ID: {user_id}) 推送 {len(unread_messages)} 条离线消息。")
-            message_ids_to_mark_read = []
-            for msg in unread_messages:
-                if msg.sender:
-                    message_data = {
-                        "type": "offline_message",
-                        "sender_username": msg.sender.username,
-                        "content": msg.encrypted_content,
-                        "timestamp": msg.sent_at.isoformat()
-                    }
-                    await manager.send_personal_message(json.dumps(message_data), user_id) # type: ignore
-                message_ids_to_mark_read.append(msg.id)
-            
-            # 一次性将所有已推送的消息标记为已读
-            if message_ids_to_mark_read:
-                crud.mark_messages_as_read(db, message_ids=message_ids_to_mark_read)
-
-    except Exception as e:
-        print(f"推送离线消息时出错: {e}")
-
-    # --- 3. 广播上线通知 ---
-    await manager.broadcast(f"系统消息: 用户 {user.username} 已上线。")
-
-    # --- 4. 循环处理消息 ---
+    # 在后台按批推送，客户端确认每批后才标记为已读；确认通过下面的接收循环传入
+    replay = OfflineReplay(user_id, session_id) # type: ignore
+    replay_task = asyncio.create_task(replay.run())
+
+    # --- 3. 循环处理消息 ---
     try:
         while True:
-            data = await websocket.receive_text()
+            frame = await websocket.receive()
+            if frame["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(frame.get("code", status.WS_1000_NORMAL_CLOSURE), frame.get("reason"))
+            # 客户端发来的任何帧都说明连接仍然存活
+            manager.mark_alive(user_id, session_id) # type: ignore
             try:
-                message_data = json.loads(data)
+                message_data = wire_protocol.decode_frame(frame, protocol)
+                message_type = message_data.get("type")
+                if message_type == "pong":
+                    continue
+                if message_type == "offline_ack":
+                    replay.ack(message_data.get("batch_id"))
+                    continue
+                if message_type == "ack":
+                    seq = message_data.get("seq")
+                    if isinstance(seq, int):
+                        manager.ack(user_id, seq) # type: ignore
+                    continue
+
                 recipient_username = message_data.get("recipient_username")
                 content = message_data.get("content")
 
                 if not recipient_username or not content:
-                    await manager.send_personal_message(json.dumps({"error": "消息格式错误，需要 recipient_username 和 content"}), user_id) # type: ignore
+                    await manager.send_to_session(user_id, session_id, json.dumps({"error": "消息格式错误，需要 recipient_username 和 content"})) # type: ignore
+                    continue
+                # 按声明的 content_kind 解释 content：声明为 binary 的 base64 文本在这里解码为字节（见 ciphertext.py）
+                try:
+                    content = wire_protocol.declare_content(content, message_data.get("content_kind"))
+                except wire_protocol.FrameError as e:
+                    await manager.send_to_session(user_id, session_id, json.dumps({"error": str(e)})) # type: ignore
                     continue
                 
-                recipient = crud.get_user_by_username(db, username=recipient_username)
+                # 用户目录命中时不经过数据库线程
+                recipient = crud.get_cached_user_entry(recipient_username)
+                if recipient is None:
+                    recipient = await db_executor.run(crud.get_user_entry_by_username, username=recipient_username)
                 if not recipient or not recipient.id: # type: ignore
-                    await manager.send_personal_message(json.dumps({"error": f"用户 {recipient_username} 不存在"}), user_id) # type: ignore
+                    await manager.send_to_session(user_id, session_id, json.dumps({"error": f"用户 {recipient_username} 不存在"})) # type: ignore
                     continue
                 
                 recipient_id = recipient.id
-                payload = {
+                # content 可能是二进制协议发来的原始密文，或者未经解析的分离消息体（见 wire_protocol），
+                # 由每个接收设备的写协程按其协议编码；同协议的接收者直接收到原始片段
+                # 消息 ID 在实时投递、续传和转存后的离线推送中保持不变，客户端据此去重
+                delivery_id = secrets.token_hex(16)
+                payload = wire_protocol.Envelope({
                     "type": "p2p_message",
+                    "id": delivery_id,
+                    "sender_id": user_id,
                     "sender_username": user.username,
+                    "content_kind": wire_protocol.content_kind_of(content),
                     "content": content,
                     "timestamp": datetime.utcnow().isoformat()
-                }
-
-                if recipient_id in manager.active_connections: # type: ignore
-                    await manager.send_personal_message(json.dumps(payload), recipient_id) # type: ignore
-                else:
-                    crud.create_message(db, sender_id=user_id, receiver_id=recipient_id, encrypted_content=content) # type: ignore
-                    await manager.send_personal_message(json.dumps({"status": f"用户 {recipient_username} 当前离线，消息已保存。"}), user_id) # type: ignore
-
-            except json.JSONDecodeError:
-                await manager.send_personal_message(json.dumps({"error": "无效的JSON格式"}), user_id) # type: ignore
+                })
+
+                # 实时消息带序号投递，客户端确认前保留在内存中，重连时可以续传。
+                # 出站队列拒收（接收者离线或被慢消费者策略丢弃）或总线确认超时时，退回到离线存储。
+                # 超时时消息可能已经送达，离线副本沿用同一个 delivery_id，客户端按 id 去重（至少一次）。
+                # 离线消息与其他连接的离线消息合并为一个事务写入，写入完成后才回执"已保存"
+                if not await manager.send_personal_message(payload, recipient_id, reliable=True): # type: ignore
+                    await offline_writer.write(sender_id=user_id, receiver_id=recipient_id, encrypted_content=wire_protocol.content_value(content), delivery_id=delivery_id) # type: ignore
+                    await manager.send_to_session(user_id, session_id, json.dumps({"status": f"用户 {recipient_username} 当前离线，消息已保存。"})) # type: ignore
+
+            except wire_protocol.FrameError:
+                await manager.send_to_session(user_id, session_id, json.dumps({"error": "无效的消息格式"})) # type: ignore
             except Exception as e:
                 print(f"处理WebSocket消息时出错: {e}")
-                await manager.send_personal_message(json.dumps({"error": "处理消息时发生内部错误"}), user_id) # type: ignore
+                await manager.send_to_session(user_id, session_id, json.dumps({"error": "处理消息时发生内部错误"})) # type: ignore
 
     except WebSocketDisconnect:
         print(f"用户 {user.username} (ID: {user_id}) 的WebSocket连接断开") # type: ignore
     
     finally:
-        # --- 5. 用户断开连接 ---
-        manager.disconnect(user_id) # type: ignore
-        crud.update_user_status(db=db, user=user, is_online=False)
-        await manager.broadcast(f"系统消息: 用户 {user.username} 已下线。")
+        # --- 4. 用户断开连接 ---
+        replay_task.cancel()
+        # 本 worker 上的最后一个设备断开；其他 worker 上也没有设备时，用户在集群范围内离线
+        last_device = await manager.disconnect(user_id, session_id) # type: ignore
+        if last_device:
+            presence_registry.disconnect(user_id) # type: ignore
 
 # 你可以在这里添加更多的路由器，例如用于认证、消息等
 # from .routers import auth_router, messages_router
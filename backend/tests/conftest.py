@@ -0,0 +1,64 @@
+"""
+后端单元测试的公共配置。在仓库根目录运行: python -m pytest backend/tests
+
+后端模块以 backend 包的形式导入。crud、models、schemas 按模块名绝对导入它们依赖的模块 (import models)，
+其他模块用包内相对导入 (from . import crud)；同一个文件以两个模块名导入会重复定义 ORM 表，
+因此先把这些模块名指向 backend 包中对应的模块对象（按依赖顺序，被依赖的模块先注册）。
+"""
+import importlib
+import os
+import sys
+
+import pytest
+from sqlalchemy import create_engine
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, ROOT)
+
+for _name in (
+    "database", "ciphertext", "user_directory", "friend_graph", "user_search", "models",
+    "change_log", "schemas", "crud",
+):
+    sys.modules[_name] = importlib.import_module(f"backend.{_name}")
+
+from backend import database, friend_graph, models, user_search  # noqa: E402
+from backend.migrations import run_migrations  # noqa: E402
+
+
+def make_engine(path: str):
+    return create_engine(f"sqlite:///{path}", connect_args={"check_same_thread": False})
+
+
+@pytest.fixture
+def engine(tmp_path):
+    """
+    一个已建好表并执行过迁移的临时数据库；SessionLocal（以及 db_executor）在测试期间绑定到它。
+    测试结束时清空随数据库读写而更新的内存好友索引和用户搜索索引。
+    """
+    engine = make_engine(tmp_path / "chat.db")
+    run_migrations(engine, models.Base.metadata)
+    original = database.SessionLocal.kw["bind"]
+    database.SessionLocal.configure(bind=engine)
+    yield engine
+    database.SessionLocal.configure(bind=original)
+    friend_graph.friend_graph.load([])
+    user_search.user_search_index.load([])
+    engine.dispose()
+
+
+def add_users(db, *usernames: str) -> list:
+    """直接插入用户行（不经过 crud.create_user，避免写入全局的用户搜索索引），返回用户 ID。"""
+    users = [
+        models.User(username=name, email=f"{name}@example.com", password_hash="x", public_key="k")
+        for name in usernames
+    ]
+    db.add_all(users)
+    db.commit()
+    return [user.id for user in users]
+
+
+@pytest.fixture
+def db(engine):
+    session = database.SessionLocal()
+    yield session
+    session.close()
@@ -0,0 +1,44 @@
+"""测试用的替身对象。"""
+import asyncio
+import json
+from typing import List, Optional
+
+
+class FakeWebSocket:
+    """
+    记录发出的帧的 WebSocket。blocked 为 True 时 send 一直等待，模拟不读数据的慢速客户端。
+    """
+
+    def __init__(self, blocked: bool = False):
+        self.sent: List = []
+        self.accepted_subprotocol: Optional[str] = None
+        self.close_code: Optional[int] = None
+        self._unblocked = asyncio.Event()
+        if not blocked:
+            self._unblocked.set()
+
+    def unblock(self):
+        self._unblocked.set()
+
+    async def accept(self, subprotocol: Optional[str] = None):
+        self.accepted_subprotocol = subprotocol
+
+    async def send_text(self, data: str):
+        await self._unblocked.wait()
+        self.sent.append(data)
+
+    async def send_bytes(self, data: bytes):
+        await self._unblocked.wait()
+        self.sent.append(data)
+
+    async def close(self, code: int = 1000):
+        self.close_code = code
+
+    def json_frames(self) -> list:
+        return [json.loads(frame) for frame in self.sent if isinstance(frame, str)]
+
+
+async def settle(rounds: int = 5):
+    """让已就绪的任务（写协程等）运行若干轮。"""
+    for _ in range(rounds):
+        await asyncio.sleep(0)
@@ -0,0 +1,149 @@
+import asyncio
+import os
+
+import pytest
+
+from backend import blob_response
+from backend.blob_response import ZEROCOPY_SEND_EXTENSION, BlobResponse
+from backend.blob_store import BlobStore, UploadOffsetMismatch, blob_etag, etag_matches, parse_range
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    store = BlobStore(str(tmp_path / "blobs"))
+    monkeypatch.setattr(blob_response, "blob_store", store)
+    return store
+
+
+def put_blob(store: BlobStore, data: bytes) -> str:
+    store.create_upload("upload")
+    store.append("upload", 0, data)
+    sha256, _ = store.commit("upload")
+    return sha256
+
+
+@pytest.mark.parametrize("header, expected", [
+    (None, None),
+    ("bytes=0-9", (0, 9)),
+    ("bytes=90-", (90, 99)),
+    ("bytes=-10", (90, 99)),
+    ("bytes=-1000", (0, 99)),
+    ("bytes=50-1000", (50, 99)),
+    ("bytes=99-99", (99, 99)),
+])
+def test_parse_range(header, expected):
+    assert parse_range(header, 100) == expected
+
+
+@pytest.mark.parametrize("header", [
+    "bytes=9-3",  # a > b 语法无效
+    "bytes=0-1,5-9",  # 多个范围
+    "bytes=-",
+    "bytes=a-b",
+    "bytes=+1-2",
+    "items=0-9",
+])
+def test_parse_range_ignores_invalid_header(header):
+    assert parse_range(header, 100) is None
+
+
+@pytest.mark.parametrize("header", ["bytes=100-", "bytes=100-200", "bytes=-0"])
+def test_parse_range_unsatisfiable(header):
+    with pytest.raises(ValueError):
+        parse_range(header, 100)
+
+
+def test_etag_matches():
+    etag = blob_etag("abc")
+    assert etag == '"abc"'
+    assert etag_matches('"abc"', etag)
+    assert etag_matches('W/"abc"', etag)
+    assert etag_matches('"x", "abc"', etag)
+    assert etag_matches("*", etag)
+    assert not etag_matches('"x"', etag)
+    assert not etag_matches(None, etag)
+
+
+def test_map_range(store):
+    data = os.urandom(3 * 4096 + 17)
+    sha256 = put_blob(store, data)
+    assert bytes(store.map_range(sha256, 0, len(data) - 1)) == data
+    assert bytes(store.map_range(sha256, 4097, 8200)) == data[4097:8201]
+
+
+async def collect(response: BlobResponse, extensions: dict) -> list:
+    messages = []
+
+    async def send(message):
+        messages.append(message)
+
+    await response({"type": "http", "extensions": extensions}, None, send)
+    return messages
+
+
+def test_blob_response_sends_mapped_slices(store, monkeypatch):
+    monkeypatch.setattr(blob_response, "BLOB_SEND_SLICE_BYTES", 1000)
+    data = os.urandom(2500)
+    sha256 = put_blob(store, data)
+    messages = asyncio.run(collect(BlobResponse(sha256, 100, 2399, status_code=206), {}))
+    assert messages[0]["status"] == 206
+    bodies = messages[1:]
+    assert [len(m["body"]) for m in bodies] == [1000, 1000, 300]
+    assert [m["more_body"] for m in bodies] == [True, True, False]
+    assert b"".join(bytes(m["body"]) for m in bodies) == data[100:2400]
+
+
+def test_blob_response_uses_zerocopy_extension(store):
+    data = os.urandom(2500)
+    sha256 = put_blob(store, data)
+    messages = asyncio.run(collect(BlobResponse(sha256, 10, 19), {ZEROCOPY_SEND_EXTENSION: {}}))
+    send_file = messages[1]
+    assert send_file["type"] == ZEROCOPY_SEND_EXTENSION
+    assert (send_file["offset"], send_file["count"]) == (10, 10)
+
+
+def test_upload_resumes_from_stored_offset(store):
+    data = os.urandom(10_000)
+    store.create_upload("u1")
+    assert store.upload_offset("u1") == 0
+    assert store.append("u1", 0, data[:4000]) == 4000
+    # 服务器重启后从磁盘上的 .part 文件恢复偏移
+    restarted = BlobStore(store.root)
+    assert restarted.upload_offset("u1") == 4000
+    assert restarted.append("u1", 4000, data[4000:]) == 10_000
+    sha256, size = restarted.commit("u1")
+    assert size == 10_000
+    assert restarted.upload_offset("u1") is None
+    with open(restarted.blob_path(sha256), "rb") as blob:
+        assert blob.read() == data
+
+
+def test_upload_rejects_wrong_offset(store):
+    store.create_upload("u1")
+    store.append("u1", 0, b"abc")
+    # 重发上一个分块或跳过分块：返回当前偏移，不写入
+    for offset in (0, 10):
+        with pytest.raises(UploadOffsetMismatch) as error:
+            store.append("u1", offset, b"def")
+        assert error.value.offset == 3
+    assert store.upload_offset("u1") == 3
+
+
+def test_upload_of_existing_content_is_deduplicated(store):
+    first = put_blob(store, b"same content")
+    store.create_upload("u2")
+    store.append("u2", 0, b"same content")
+    assert store.commit("u2") == (first, len(b"same content"))
+    assert store.upload_offset("u2") is None
+
+
+def test_expired_uploads(store):
+    store.create_upload("old")
+    store.create_upload("new")
+    past = os.path.getmtime(store._part_path("old")) - 3600
+    os.utime(store._part_path("old"), (past, past))
+    assert store.expired_uploads(max_age=60) == ["old"]
+    store.discard("old")
+    assert store.upload_offset("old") is None
+    with pytest.raises(FileNotFoundError):
+        store.append("old", 0, b"x")
@@ -0,0 +1,89 @@
+import pytest
+from sqlalchemy.orm import sessionmaker
+
+from backend import crud
+from backend.change_log import CHANGE_CONTACT, CHANGE_PRESENCE, CHANGE_REQUEST, change_log
+
+from conftest import add_users, make_engine
+
+
+@pytest.fixture
+def workers(engine, tmp_path):
+    """两个 worker：各自有独立的引擎（连接池）和会话，共用同一个数据库文件。"""
+    engines = [make_engine(tmp_path / "chat.db") for _ in range(2)]
+    sessions = [sessionmaker(bind=worker_engine)() for worker_engine in engines]
+    yield sessions
+    for session, worker_engine in zip(sessions, engines):
+        session.close()
+        worker_engine.dispose()
+
+
+def kinds(changes):
+    return [(change["type"], change.get("user_id", change.get("friend_id")), change["status"]) for change in changes]
+
+
+def test_changes_recorded_on_one_worker_are_visible_on_another(db, workers):
+    a, b = workers
+    alice, bob = add_users(db, "alice", "bob")
+    start = change_log.version(b)
+
+    crud.add_contact(a, user_id=alice, friend_id=bob)
+    version, changes = change_log.changes_since(b, bob, start)
+    assert kinds(changes) == [(CHANGE_REQUEST, alice, "pending")]
+
+    # bob 的下一个请求落在另一个 worker 上，接受请求后两个 worker 上的版本号都继续递增
+    crud.update_contact_status(b, user_id=bob, friend_id=alice, status="accepted")
+    newer, changes = change_log.changes_since(a, bob, version)
+    assert newer > version
+    assert kinds(changes) == [(CHANGE_REQUEST, alice, "accepted"), (CHANGE_CONTACT, alice, "accepted")]
+    assert kinds(change_log.changes_since(a, alice, start)[1]) == [(CHANGE_CONTACT, bob, "accepted")]
+    # 没有新变化
+    assert change_log.changes_since(b, bob, newer) == (newer, [])
+
+
+def test_log_keeps_only_the_final_state_of_each_object(db):
+    alice, bob = add_users(db, "alice", "bob")
+    crud.add_contact(db, user_id=alice, friend_id=bob)
+    crud.delete_contact(db, user_id=bob, friend_id=alice)
+    crud.add_contact(db, user_id=alice, friend_id=bob)
+    version, changes = change_log.changes_since(db, bob, 0)
+    assert kinds(changes) == [(CHANGE_REQUEST, alice, "pending")]
+    assert changes[0]["version"] == version
+
+
+def test_presence_reaches_only_friends(db):
+    alice, bob, carol = add_users(db, "alice", "bob", "carol")
+    crud.add_contact(db, user_id=alice, friend_id=bob)
+    crud.update_contact_status(db, user_id=bob, friend_id=alice, status="accepted")
+    since = change_log.version(db)
+    crud.bulk_set_users_online(db, online_ids=[alice], offline_ids=[], transitions={alice: True})
+    crud.bulk_set_users_online(db, online_ids=[], offline_ids=[alice], transitions={alice: False})
+    _, changes = change_log.changes_since(db, bob, since)
+    assert [(c["type"], c["user_id"], c["is_online"]) for c in changes] == [(CHANGE_PRESENCE, alice, False)]
+    assert change_log.changes_since(db, carol, since)[1] == []
+
+
+def test_since_ahead_of_the_log_requires_a_full_sync(db):
+    # 例如旧版本服务器的内存日志以微秒时间戳作为版本号
+    assert change_log.changes_since(db, 1, 1792258615894644) is None
+    assert change_log.changes_since(db, 1, -1) is None
+    version, contacts, pending = crud.get_sync_snapshot(db, user_id=1)
+    assert (version, contacts, pending) == (0, [], [])
+
+
+def test_listeners_are_notified_after_commit(db, workers):
+    alice, bob = add_users(db, "alice", "bob")
+    received = []
+
+    def listener(kind, changes):
+        # 通知时变更已经提交，另一个 worker 可以读到
+        received.append((kind, changes, change_log.version(workers[1])))
+
+    change_log.add_listener(listener)
+    try:
+        crud.add_contact(db, user_id=alice, friend_id=bob)
+    finally:
+        change_log.remove_listener(listener)
+    [(kind, changes, committed)] = received
+    assert kind == CHANGE_REQUEST
+    assert changes == [(bob, {"type": CHANGE_REQUEST, "user_id": alice, "status": "pending", "version": committed})]
@@ -0,0 +1,148 @@
+import asyncio
+import json
+
+import pytest
+from fastapi import status
+
+from backend.connection_manager import ConnectionManager
+
+from fakes import FakeWebSocket, settle
+
+
+def message(n: int) -> str:
+    return json.dumps({"n": n})
+
+
+def run(scenario):
+    asyncio.run(scenario())
+
+
+async def started(**kwargs) -> ConnectionManager:
+    manager = ConnectionManager(**kwargs)
+    await manager.start()
+    return manager
+
+
+def test_messages_fan_out_to_every_device_in_order():
+    async def scenario():
+        manager = await started()
+        phone, laptop = FakeWebSocket(), FakeWebSocket()
+        _, first = await manager.connect(phone, 1, device="phone")
+        _, second = await manager.connect(laptop, 1, device="laptop")
+        assert (first, second) == (True, False)
+        for n in range(3):
+            assert await manager.send_personal_message(message(n), 1)
+        await settle()
+        assert phone.sent == laptop.sent == [message(n) for n in range(3)]
+        assert await manager.send_personal_message(message(9), 2) is False
+        await manager.close()
+
+    run(scenario)
+
+
+def test_drop_policy_rejects_messages_while_congested():
+    async def scenario():
+        manager = await started(high_watermark=4, low_watermark=1, slow_consumer_policy="drop")
+        websocket = FakeWebSocket(blocked=True)
+        await manager.connect(websocket, 1)
+        # 写协程取出第一条后阻塞在发送上，队列中再积压 4 条即达到高水位
+        results = []
+        for n in range(8):
+            results.append(await manager.send_personal_message(message(n), 1))
+            await settle()
+        assert results == [True] * 5 + [False] * 3
+        stats = manager.stats()
+        assert (stats["queued"], stats["congested"], stats["dropped"]) == (4, 1, 3)
+
+        # 客户端恢复后队列排空到低水位以下，连接不再拥塞
+        websocket.unblock()
+        await settle(20)
+        assert websocket.sent == [message(n) for n in range(5)]
+        assert await manager.send_personal_message(message(9), 1)
+        await settle()
+        assert websocket.sent[-1] == message(9)
+        assert manager.stats()["congested"] == 0
+        await manager.close()
+
+    run(scenario)
+
+
+def test_coalesce_policy_replaces_pending_messages_with_the_same_key():
+    async def scenario():
+        manager = await started(high_watermark=2, low_watermark=0, slow_consumer_policy="coalesce")
+        websocket = FakeWebSocket(blocked=True)
+        await manager.connect(websocket, 1)
+        for n in range(3):
+            await manager.send_personal_message(message(n), 1)
+            await settle()
+        # 拥塞后：同 key 的消息原地覆盖，新 key 在硬上限 (2 x 高水位) 内入队，没有 key 的消息丢弃
+        assert await manager.send_personal_message('{"presence": "a1"}', 1, coalesce_key="a")
+        assert await manager.send_personal_message('{"presence": "a2"}', 1, coalesce_key="a")
+        assert await manager.send_personal_message('{"presence": "b1"}', 1, coalesce_key="b")
+        assert await manager.send_personal_message(message(3), 1) is False
+        websocket.unblock()
+        await settle(20)
+        assert websocket.sent == [message(0), message(1), message(2), '{"presence": "a2"}', '{"presence": "b1"}']
+        await manager.close()
+
+    run(scenario)
+
+
+def test_disconnect_policy_closes_the_slow_session():
+    async def scenario():
+        manager = await started(high_watermark=2, low_watermark=0, slow_consumer_policy="disconnect")
+        websocket = FakeWebSocket(blocked=True)
+        await manager.connect(websocket, 1)
+        results = []
+        for n in range(4):
+            results.append(await manager.send_personal_message(message(n), 1))
+            await settle()
+        assert results == [True, True, True, False]
+        assert websocket.close_code == status.WS_1013_TRY_AGAIN_LATER
+        await manager.close()
+
+    run(scenario)
+
+
+def test_stats_keep_totals_of_disconnected_sessions():
+    async def scenario():
+        manager = await started()
+        websocket = FakeWebSocket()
+        session_id, _ = await manager.connect(websocket, 1)
+        await manager.connect(FakeWebSocket(), 2)
+        await manager.send_personal_message(message(0), 1)
+        await settle()
+        assert await manager.disconnect(1, session_id) is True
+        stats = manager.stats()
+        assert (stats["users"], stats["sessions"], stats["delivered"]) == (1, 1, 1)
+        await manager.close()
+
+    run(scenario)
+
+
+def test_sessions_that_stop_answering_pings_are_closed():
+    async def scenario():
+        manager = await started(ping_interval=0.02, ping_timeout=0.05)
+        silent, alive = FakeWebSocket(), FakeWebSocket()
+        await manager.connect(silent, 1)
+        alive_session, _ = await manager.connect(alive, 2)
+        for _ in range(6):
+            await asyncio.sleep(0.02)
+            manager.mark_alive(2, alive_session)
+        await settle()
+        assert silent.close_code == status.WS_1001_GOING_AWAY
+        assert alive.close_code is None
+        assert {"type": "ping"} in alive.json_frames()
+        await manager.close()
+
+    run(scenario)
+
+
+@pytest.mark.parametrize("kwargs", [
+    {"slow_consumer_policy": "block"},
+    {"high_watermark": 4, "low_watermark": 4},
+    {"ping_interval": 10, "ping_timeout": 5},
+])
+def test_rejects_invalid_configuration(kwargs):
+    with pytest.raises(ValueError):
+        ConnectionManager(**kwargs)
@@ -0,0 +1,46 @@
+from sqlalchemy.orm import sessionmaker
+
+from backend import crud
+from backend.friend_graph import friend_graph
+
+from conftest import add_users, make_engine
+
+
+def befriend(db, user_id, friend_id):
+    crud.add_contact(db, user_id=user_id, friend_id=friend_id)
+    crud.update_contact_status(db, user_id=friend_id, friend_id=user_id, status="accepted")
+
+
+def test_graph_catches_up_with_changes_made_on_another_worker(db, tmp_path):
+    alice, bob, carol = add_users(db, "alice", "bob", "carol")
+    befriend(db, alice, bob)
+    crud.load_friend_graph(db)
+    loaded = friend_graph.version
+    assert friend_graph.friends(alice) == (bob,)
+
+    # 另一个 worker 用自己的连接修改好友关系；本 worker 的索引不会收到 add_edge/remove_edge
+    other_engine = make_engine(tmp_path / "chat.db")
+    other = sessionmaker(bind=other_engine)()
+    try:
+        befriend(other, carol, alice)
+        crud.delete_contact(other, user_id=bob, friend_id=alice)
+    finally:
+        other.close()
+        other_engine.dispose()
+    friend_graph.load([(alice, bob)], loaded)
+
+    online = crud.get_online_friends(db, alice, is_online=lambda user_id: True)
+    assert [user.id for user in online] == [carol]
+    assert friend_graph.friends(bob) == ()
+    assert friend_graph.version > loaded
+    # 已经追上，没有新的变化
+    assert crud.catch_up_friend_graph(db) == 0
+
+
+def test_reapplying_local_changes_is_idempotent(db):
+    alice, bob = add_users(db, "alice", "bob")
+    crud.load_friend_graph(db)
+    befriend(db, alice, bob)
+    assert crud.catch_up_friend_graph(db) == 2
+    assert friend_graph.friends(alice) == (bob,)
+    assert friend_graph.stats()["edges"] == 1
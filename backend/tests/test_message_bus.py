@@ -0,0 +1,243 @@
+import asyncio
+import socket
+
+import pytest
+
+from backend import message_bus
+from backend.connection_manager import ConnectionManager
+from backend.message_bus import LocalMessageBus, MessageBus, UnixSocketMessageBus
+
+from fakes import FakeWebSocket, settle
+
+unix_only = pytest.mark.skipif(not hasattr(socket, "AF_UNIX"), reason="需要 Unix 域套接字")
+
+
+class Worker:
+    """一个 worker 的总线端点，记录收到的投递和广播；accept 决定本地投递是否成功。"""
+
+    def __init__(self, path: str, accept: bool = True):
+        self.bus = UnixSocketMessageBus(path)
+        self.accept = accept
+        self.delivered = []
+        self.broadcasts = []
+        self.release = None
+
+    async def start(self):
+        await self.bus.start(self._deliver, self._broadcast)
+        return self
+
+    async def _deliver(self, user_id, message, coalesce_key, seq):
+        if self.release is not None:
+            await self.release.wait()
+        self.delivered.append((user_id, message, coalesce_key, seq))
+        return self.accept
+
+    async def _broadcast(self, message, coalesce_key):
+        self.broadcasts.append(message)
+
+
+async def propagate():
+    """不同 worker 的连接之间没有顺序保证：等待代理处理完另一个连接上已发出的帧。"""
+    await asyncio.sleep(0.05)
+
+
+@pytest.fixture
+def bus_path(tmp_path):
+    return str(tmp_path / "bus.sock")
+
+
+def test_local_bus_returns_delivery_result():
+    async def scenario():
+        bus = LocalMessageBus()
+        results = iter([True, False])
+
+        async def deliver(user_id, message, coalesce_key, seq):
+            return next(results)
+
+        async def broadcast(message, coalesce_key):
+            pass
+
+        await bus.start(deliver, broadcast)
+        assert await bus.send_personal(1, "a") is True
+        assert await bus.send_personal(1, "b") is False
+
+    asyncio.run(scenario())
+
+
+@unix_only
+def test_routes_to_worker_holding_the_user(bus_path):
+    async def scenario():
+        a = await Worker(bus_path).start()
+        b = await Worker(bus_path).start()
+        assert a.bus._broker is not None and b.bus._broker is None
+        await b.bus.register(7)
+        await propagate()
+        assert await a.bus.send_personal(7, '{"x": 1}', "key", True) is True
+        assert b.delivered == [(7, '{"x": 1}', "key", 1)]
+        assert a.delivered == []
+        assert await a.bus.is_online_elsewhere(7) is True
+        assert await b.bus.is_online_elsewhere(7) is False
+        # 没有任何 worker 持有的用户
+        assert await a.bus.send_personal(8, "{}") is False
+        await b.bus.unregister(7)
+        await propagate()
+        assert await a.bus.send_personal(7, "{}") is False
+        await b.bus.close()
+        await a.bus.close()
+
+    asyncio.run(scenario())
+
+
+@unix_only
+def test_forwards_the_owners_delivery_result(bus_path):
+    async def scenario():
+        a = await Worker(bus_path).start()
+        rejecting = await Worker(bus_path, accept=False).start()
+        await rejecting.bus.register(7)
+        await propagate()
+        # 接收者所在的 worker 没有接收（例如连接刚断开），发送方应得到 False 并转存离线消息
+        assert await a.bus.send_personal(7, "{}") is False
+        assert len(rejecting.delivered) == 1
+        # 两个 worker 都持有该用户时，任一接收即为已投递
+        accepting = await Worker(bus_path).start()
+        await accepting.bus.register(7)
+        await propagate()
+        assert await a.bus.send_personal(7, "{}") is True
+        for worker in (accepting, rejecting, a):
+            await worker.bus.close()
+
+    asyncio.run(scenario())
+
+
+@unix_only
+def test_rejected_reliable_message_releases_its_seq(bus_path):
+    async def scenario():
+        a = await Worker(bus_path).start()
+        rejecting = await Worker(bus_path, accept=False).start()
+        await rejecting.bus.register(7)
+        await propagate()
+        assert await a.bus.send_personal(7, "{}", reliable=True) is False
+        assert rejecting.delivered[-1][3] == 1
+        # 没有设备接收，序号被退还，下一条送达的消息仍然是 1
+        rejecting.accept = True
+        assert await a.bus.send_personal(7, "{}", reliable=True) is True
+        assert rejecting.delivered[-1][3] == 1
+        await rejecting.bus.close()
+        await a.bus.close()
+
+    asyncio.run(scenario())
+
+
+@unix_only
+def test_owner_disconnecting_before_reporting_counts_as_undelivered(bus_path):
+    async def scenario():
+        a = await Worker(bus_path).start()
+        b = await Worker(bus_path).start()
+        b.release = asyncio.Event()
+        await b.bus.register(7)
+        await propagate()
+        send = asyncio.create_task(a.bus.send_personal(7, "{}"))
+        await asyncio.sleep(0.05)
+        await b.bus.close()
+        assert await asyncio.wait_for(send, message_bus.MESSAGE_BUS_ACK_TIMEOUT_SECONDS / 2) is False
+        await a.bus.close()
+
+    asyncio.run(scenario())
+
+
+@unix_only
+def test_ack_timeout_reports_undelivered_even_if_delivered_later(bus_path, monkeypatch):
+    monkeypatch.setattr(message_bus, "MESSAGE_BUS_ACK_TIMEOUT_SECONDS", 0.05)
+
+    async def scenario():
+        a = await Worker(bus_path).start()
+        b = await Worker(bus_path).start()
+        b.release = asyncio.Event()
+        await b.bus.register(7)
+        await propagate()
+        # 至少一次：确认超时按未投递处理（调用方以同一个 id 转存离线副本），迟到的确认被忽略
+        assert await a.bus.send_personal(7, "{}") is False
+        b.release.set()
+        await propagate()
+        assert len(b.delivered) == 1
+        assert a.bus._pending_acks == {}
+        await b.bus.close()
+        await a.bus.close()
+
+    asyncio.run(scenario())
+
+
+@unix_only
+def test_broadcast_reaches_every_worker(bus_path):
+    async def scenario():
+        a = await Worker(bus_path).start()
+        b = await Worker(bus_path).start()
+        await a.bus.broadcast('{"type": "notice"}')
+        await asyncio.sleep(0.05)
+        assert a.broadcasts == b.broadcasts == ['{"type": "notice"}']
+        await b.bus.close()
+        await a.bus.close()
+
+    asyncio.run(scenario())
+
+
+@unix_only
+def test_another_worker_takes_over_the_broker(bus_path, monkeypatch):
+    monkeypatch.setattr(message_bus, "MESSAGE_BUS_RECONNECT_SECONDS", 0.05)
+
+    async def scenario():
+        a = await Worker(bus_path).start()
+        b = await Worker(bus_path).start()
+        await b.bus.register(7)
+        await propagate()
+        await a.bus.close()
+        await asyncio.sleep(0.3)
+        # b 重新连接时接管代理，并重新登记自己持有的用户
+        assert b.bus._broker is not None
+        c = await Worker(bus_path).start()
+        await propagate()
+        assert await c.bus.send_personal(7, "{}") is True
+        await c.bus.close()
+        await b.bus.close()
+
+    asyncio.run(scenario())
+
+
+class RecordingBus(LocalMessageBus):
+    def __init__(self):
+        super().__init__()
+        self.ops = []
+
+    async def register(self, user_id):
+        self.ops.append(("register", user_id))
+        await asyncio.sleep(0)
+
+    async def unregister(self, user_id):
+        self.ops.append(("unregister", user_id))
+        await asyncio.sleep(0)
+
+
+def test_reconnect_right_after_disconnect_stays_registered():
+    async def scenario():
+        bus = RecordingBus()
+        manager = ConnectionManager(bus=bus)
+        await manager.start()
+        session_id, _ = await manager.connect(FakeWebSocket(), 1)
+        # 最后一个设备断开后立即重连：注销必须先于重新登记到达总线
+        disconnect = asyncio.create_task(manager.disconnect(1, session_id))
+        reconnect = asyncio.create_task(manager.connect(FakeWebSocket(), 1))
+        await asyncio.gather(disconnect, reconnect)
+        await settle()
+        assert bus.ops == [("register", 1), ("unregister", 1), ("register", 1)]
+        await manager.close()
+
+    asyncio.run(scenario())
+
+
+def test_bus_without_all_overrides_cannot_be_constructed():
+    class PartialBus(MessageBus):
+        async def start(self, deliver, broadcast):
+            pass
+
+    with pytest.raises(TypeError):
+        PartialBus()
@@ -0,0 +1,89 @@
+import base64
+import os
+
+import pytest
+from sqlalchemy import text
+
+from backend import crud, models, schemas
+from backend.ciphertext import CONTENT_KIND_BINARY, CONTENT_KIND_TEXT, from_declared
+from backend.migrations import run_migrations
+
+
+def stored(engine):
+    with engine.connect() as conn:
+        return conn.execute(text(
+            "SELECT encrypted_content, typeof(encrypted_content), content_kind FROM messages ORDER BY id"
+        )).all()
+
+
+@pytest.mark.parametrize("content", ["good", "1234", "aGVsbG8=", "", "明文 with spaces"])
+def test_text_content_is_stored_as_sent(engine, db, content):
+    # 看起来像 base64 的文本也原样保存，不会被猜测为二进制密文
+    crud.create_messages(db, [{"sender_id": 1, "receiver_id": 2, "encrypted_content": content}])
+    assert stored(engine) == [(content, "text", CONTENT_KIND_TEXT)]
+    message = db.query(models.Message).one()
+    assert schemas.Message.model_validate(message).encrypted_content == content
+
+
+def test_binary_ciphertext_is_stored_as_raw_bytes(engine, db):
+    ciphertext = os.urandom(48)
+    inserted = crud.create_message(db, sender_id=1, receiver_id=2, encrypted_content=ciphertext)
+    assert inserted.encrypted_content == ciphertext
+    assert stored(engine) == [(ciphertext, "blob", CONTENT_KIND_BINARY)]
+    message = db.query(models.Message).one()
+    # JSON 出口编码为标准 base64
+    assert schemas.Message.model_validate(message).encrypted_content == base64.b64encode(ciphertext).decode("ascii")
+
+
+def test_batch_records_each_rows_kind(engine, db):
+    ciphertext = os.urandom(8)
+    crud.create_messages(db, [
+        {"sender_id": 1, "receiver_id": 2, "encrypted_content": "Zm9v"},
+        {"sender_id": 2, "receiver_id": 1, "encrypted_content": ciphertext},
+    ])
+    assert [row[2] for row in stored(engine)] == [CONTENT_KIND_TEXT, CONTENT_KIND_BINARY]
+
+
+def test_migration_records_kind_without_converting_content(engine):
+    # 旧版本的数据库：没有 content_kind 列，部分消息以 BLOB 保存，其余是 TEXT
+    ciphertext = os.urandom(32)
+    with engine.begin() as conn:
+        conn.execute(text("ALTER TABLE messages DROP COLUMN content_kind"))
+        conn.execute(
+            text("INSERT INTO messages (sender_id, receiver_id, encrypted_content, is_read) VALUES (1, 2, :c, 0)"),
+            [{"c": ciphertext}, {"c": "aGVsbG8="}, {"c": "plain text"}],
+        )
+    run_migrations(engine, models.Base.metadata)
+    # BLOB 保持原始字节并记为 binary；TEXT 不做猜测，原样保留
+    assert stored(engine) == [
+        (ciphertext, "blob", CONTENT_KIND_BINARY),
+        ("aGVsbG8=", "text", CONTENT_KIND_TEXT),
+        ("plain text", "text", CONTENT_KIND_TEXT),
+    ]
+    # 再次执行不做任何修改
+    run_migrations(engine, models.Base.metadata)
+    assert len(stored(engine)) == 3
+
+
+def test_declared_binary_content_is_decoded_at_ingress():
+    ciphertext = os.urandom(48)
+    encoded = base64.b64encode(ciphertext).decode("ascii")
+    assert from_declared(encoded, CONTENT_KIND_BINARY) == ciphertext
+    # 没有声明时即使看起来像 base64 也是文本
+    assert from_declared(encoded, None) == from_declared(encoded, CONTENT_KIND_TEXT) == encoded
+    for invalid in ("Zm9", "Zm9v\n", "not base64!"):
+        with pytest.raises(ValueError):
+            from_declared(invalid, CONTENT_KIND_BINARY)
+    with pytest.raises(ValueError):
+        from_declared(encoded, "hex")
+
+
+def test_rest_message_schemas_carry_the_kind(db):
+    assert schemas.MessageCreate(recipient_username="bob", encrypted_content="x").content_kind == CONTENT_KIND_TEXT
+    with pytest.raises(ValueError):
+        schemas.MessageCreate(recipient_username="bob", encrypted_content="x", content_kind="hex")
+    ciphertext = os.urandom(16)
+    # POST /messages/ 直接返回插入的行
+    inserted = crud.create_message(db, sender_id=1, receiver_id=2, encrypted_content=ciphertext)
+    message = schemas.Message.model_validate(inserted)
+    assert (message.encrypted_content, message.content_kind) == (base64.b64encode(ciphertext).decode("ascii"), CONTENT_KIND_BINARY)
@@ -0,0 +1,78 @@
+import threading
+
+import pytest
+from sqlalchemy import inspect, text
+
+from backend import migrations, models
+from backend.migrations import run_migrations
+
+from conftest import make_engine
+
+WORKERS = 6
+
+
+def legacy_database(path):
+    """旧版本的数据库：messages 没有 conversation_key 和 content_kind 列，也没有后来新增的表。"""
+    engine = make_engine(path)
+    with engine.begin() as conn:
+        conn.execute(text(
+            "CREATE TABLE users (id INTEGER PRIMARY KEY, username VARCHAR, email VARCHAR, password_hash VARCHAR)"
+        ))
+        conn.execute(text(
+            "CREATE TABLE messages (id INTEGER PRIMARY KEY, sender_id INTEGER, receiver_id INTEGER, "
+            "encrypted_content TEXT, sent_at DATETIME, is_read BOOLEAN)"
+        ))
+        conn.execute(text(
+            "INSERT INTO messages (sender_id, receiver_id, encrypted_content, is_read) VALUES (1, 2, 'hi', 0)"
+        ))
+    engine.dispose()
+
+
+def test_concurrent_workers_migrate_once(tmp_path):
+    path = tmp_path / "chat.db"
+    legacy_database(path)
+    start = threading.Barrier(WORKERS)
+    errors = []
+
+    def worker():
+        # 每个 worker 进程有自己的引擎和连接
+        engine = make_engine(path)
+        start.wait()
+        try:
+            run_migrations(engine, models.Base.metadata)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            engine.dispose()
+
+    threads = [threading.Thread(target=worker) for _ in range(WORKERS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+
+    engine = make_engine(path)
+    columns = {column["name"] for column in inspect(engine).get_columns("messages")}
+    assert {"conversation_key", "content_kind", "delivery_id"} <= columns
+    with engine.connect() as conn:
+        assert conn.execute(text("SELECT unread_count FROM conversations WHERE user_id = 2")).scalar() == 1
+        assert conn.execute(text("PRAGMA busy_timeout")).scalar() == 5000
+    engine.dispose()
+
+
+def test_failed_migration_rolls_back(tmp_path, monkeypatch):
+    path = tmp_path / "chat.db"
+    legacy_database(path)
+    engine = make_engine(path)
+
+    def broken(conn):
+        raise RuntimeError("迁移失败")
+
+    monkeypatch.setattr(migrations, "MIGRATIONS", migrations.MIGRATIONS + [broken])
+    with pytest.raises(RuntimeError):
+        run_migrations(engine, models.Base.metadata)
+    # 建表和之前的步骤都没有提交
+    assert "conversation_key" not in {column["name"] for column in inspect(engine).get_columns("messages")}
+    assert not inspect(engine).has_table("conversations")
+    engine.dispose()
@@ -0,0 +1,80 @@
+import asyncio
+
+from backend import crud, offline_replay
+from backend.offline_replay import OfflineReplay
+
+from conftest import add_users
+
+
+class FakeManager:
+    """记录发往会话的离线批次；auto_ack 为 True 时模拟客户端在收到每批后立即确认。"""
+
+    def __init__(self, auto_ack: bool = True):
+        self.auto_ack = auto_ack
+        self.replay = None
+        self.batches = []
+
+    async def send_to_session(self, user_id, session_id, frame):
+        self.batches.append(frame.fields)
+        if self.auto_ack:
+            self.replay.ack(frame.fields["batch_id"])
+        return True
+
+
+def replay_with(monkeypatch, fake: FakeManager, user_id: int, **kwargs) -> OfflineReplay:
+    monkeypatch.setattr(offline_replay, "manager", fake)
+    fake.replay = OfflineReplay(user_id, session_id=1, **kwargs)
+    return fake.replay
+
+
+def write_messages(db, sender_id: int, receiver_id: int, count: int):
+    crud.create_messages(db, [
+        {"sender_id": sender_id, "receiver_id": receiver_id, "encrypted_content": f"m{i}", "delivery_id": f"id{i}"}
+        for i in range(count)
+    ])
+
+
+def test_replay_pages_through_unread_messages_in_order(db, monkeypatch):
+    alice, bob = add_users(db, "alice", "bob")
+    write_messages(db, alice, bob, 5)
+    fake = FakeManager()
+    replay = replay_with(monkeypatch, fake, bob, batch_size=2)
+
+    asyncio.run(replay.run())
+
+    assert [batch["batch_id"] for batch in fake.batches] == [1, 2, 3]
+    assert [batch["has_more"] for batch in fake.batches] == [True, True, False]
+    assert [
+        (message["id"], message["content"], message["sender_username"])
+        for batch in fake.batches for message in batch["messages"]
+    ] == [(f"id{i}", f"m{i}", "alice") for i in range(5)]
+    assert crud.get_unread_messages_page(db, user_id=bob) == []
+
+
+def test_unacknowledged_batch_stays_unread(db, monkeypatch):
+    alice, bob = add_users(db, "alice", "bob")
+    write_messages(db, alice, bob, 3)
+    fake = FakeManager(auto_ack=False)
+    replay = replay_with(monkeypatch, fake, bob, batch_size=2, ack_timeout=0.05)
+
+    asyncio.run(replay.run())
+
+    # 第一批未确认：不推送下一批，也不标记为已读
+    assert len(fake.batches) == 1
+    assert len(crud.get_unread_messages_page(db, user_id=bob)) == 3
+
+
+def test_stale_ack_does_not_release_the_current_batch(db, monkeypatch):
+    alice, bob = add_users(db, "alice", "bob")
+    write_messages(db, alice, bob, 1)
+    fake = FakeManager(auto_ack=False)
+    replay = replay_with(monkeypatch, fake, bob, ack_timeout=0.05)
+
+    async def scenario():
+        task = asyncio.create_task(replay.run())
+        await asyncio.sleep(0.01)
+        replay.ack(0)
+        await task
+
+    asyncio.run(scenario())
+    assert len(crud.get_unread_messages_page(db, user_id=bob)) == 1
@@ -0,0 +1,145 @@
+import asyncio
+import socket
+import time
+
+import pytest
+
+from backend import message_bus, presence_registry as presence_registry_module
+from backend.message_bus import UnixSocketMessageBus
+from backend.presence_registry import PresenceRegistry
+
+unix_only = pytest.mark.skipif(not hasattr(socket, "AF_UNIX"), reason="需要 Unix 域套接字")
+
+
+class RecordingNotifier:
+    def __init__(self):
+        self.published = []
+
+    def publish(self, user_id, is_online):
+        self.published.append((user_id, is_online))
+
+
+@pytest.fixture
+def notifier(monkeypatch):
+    notifier = RecordingNotifier()
+    monkeypatch.setattr(presence_registry_module, "presence_notifier", notifier)
+    return notifier
+
+
+async def no_deliver(user_id, message, coalesce_key, seq):
+    return False
+
+
+async def no_broadcast(message, coalesce_key):
+    pass
+
+
+async def start_worker(path: str) -> PresenceRegistry:
+    bus = UnixSocketMessageBus(path)
+    await bus.start(no_deliver, no_broadcast)
+    registry = PresenceRegistry()
+    await registry.start(bus)
+    return registry
+
+
+async def stop_worker(registry: PresenceRegistry):
+    await registry.close()
+    await registry._bus.close()
+
+
+async def propagate():
+    await asyncio.sleep(0.05)
+
+
+def test_lease_expiry_is_a_transition(engine, notifier):
+    async def scenario():
+        registry = PresenceRegistry(lease=30)
+        await registry.start()
+        registry.touch(1)
+        registry.connect(2)
+        assert registry.is_online(1) and registry.is_online(2)
+
+        assert registry.expire(time.monotonic() + 60) == [1]
+        assert not registry.is_online(1)
+        # 持有 WebSocket 的用户不受租约影响
+        assert registry.is_online(2)
+        assert notifier.published == [(1, True), (2, True), (1, False)]
+        assert registry.stats()["transitions"] == 2
+        await registry.close()
+
+    asyncio.run(scenario())
+
+
+def test_logout_keeps_users_with_a_websocket_online(engine, notifier):
+    async def scenario():
+        registry = PresenceRegistry()
+        await registry.start()
+        registry.connect(1)
+        registry.touch(1)
+        registry.set_offline(1)
+        assert registry.is_online(1)
+        registry.disconnect(1)
+        assert not registry.is_online(1)
+        assert notifier.published == [(1, True), (1, False)]
+        await registry.close()
+
+    asyncio.run(scenario())
+
+
+@unix_only
+def test_presence_is_shared_across_workers(engine, notifier, tmp_path):
+    async def scenario():
+        path = str(tmp_path / "bus.sock")
+        a = await start_worker(path)
+        b = await start_worker(path)
+
+        a.connect(7)
+        await propagate()
+        # b 上没有 7 的连接，也能查到 7 在线（例如 GET /users/{username}/connection-info）
+        assert b.is_online(7)
+        # 第二个 worker 上的租约不是新的转变
+        b.touch(7)
+        await propagate()
+        assert notifier.published == [(7, True)]
+
+        # 7 在 a 上的 WebSocket 断开：清除所有 worker 上的租约，只通知一次下线
+        a.disconnect(7)
+        await propagate()
+        assert not a.is_online(7) and not b.is_online(7)
+        assert notifier.published == [(7, True), (7, False)]
+
+        # 租约在 b 上到期时，由 b 负责通知，a 上的视图随之更新
+        b.touch(8)
+        await propagate()
+        assert a.is_online(8)
+        b.expire(time.monotonic() + b.lease + 1)
+        await propagate()
+        assert not a.is_online(8)
+        assert notifier.published[-2:] == [(8, True), (8, False)]
+
+        await stop_worker(b)
+        await stop_worker(a)
+
+    asyncio.run(scenario())
+
+
+@unix_only
+def test_users_of_a_stopped_worker_go_offline(engine, notifier, tmp_path, monkeypatch):
+    monkeypatch.setattr(message_bus, "MESSAGE_BUS_RECONNECT_SECONDS", 0.05)
+
+    async def scenario():
+        path = str(tmp_path / "bus.sock")
+        a = await start_worker(path)
+        b = await start_worker(path)
+        b.connect(9)
+        await propagate()
+        assert a.is_online(9)
+
+        # 持有 9 的 worker 退出（不会再发送下线声明），由仍连接的 worker 通知下线
+        await stop_worker(b)
+        await propagate()
+        assert not a.is_online(9)
+        assert notifier.published == [(9, True), (9, False)]
+        await stop_worker(a)
+
+    asyncio.run(scenario())
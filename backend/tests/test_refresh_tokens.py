@@ -0,0 +1,73 @@
+from datetime import datetime, timedelta
+
+import pytest
+from fastapi import HTTPException
+from jose import jwt
+
+from backend import auth, crud, database, models
+
+
+@pytest.fixture
+def alice(db):
+    user = models.User(username="alice", email="alice@example.com", password_hash="x", public_key="k")
+    db.add(user)
+    db.commit()
+    return user
+
+
+def claims(token: str) -> dict:
+    return jwt.decode(token, auth.SECRET_KEY, algorithms=[auth.ALGORITHM])
+
+
+def rejected(db, token: str) -> bool:
+    with pytest.raises(HTTPException) as error:
+        auth.rotate_refresh_token(db, token)
+    return error.value.status_code == 401
+
+
+def test_refresh_rotates_the_token(db, alice):
+    token = auth.create_refresh_token(db, alice.id, "alice")
+    assert isinstance(claims(token)["iat"], int)
+    username, rotated = auth.rotate_refresh_token(db, token)
+    assert username == "alice"
+    assert claims(rotated)["jti"] != claims(token)["jti"]
+    # 旧令牌只能使用一次，新令牌可以继续刷新
+    assert rejected(db, token)
+    assert auth.rotate_refresh_token(db, rotated)[0] == "alice"
+
+
+def test_logout_revokes_every_token_for_all_workers(engine, db, alice):
+    tokens = [auth.create_refresh_token(db, alice.id, "alice") for _ in range(2)]
+    # 另一个 worker（独立的会话和连接）处理登出请求
+    other = database.SessionLocal()
+    try:
+        crud.revoke_refresh_tokens(other, alice.id)
+    finally:
+        other.close()
+    assert all(rejected(db, token) for token in tokens)
+
+
+def test_deleted_user_cannot_refresh(db, alice):
+    token = auth.create_refresh_token(db, alice.id, "alice")
+    db.delete(alice)
+    db.commit()
+    assert rejected(db, token)
+
+
+def test_rejects_tokens_that_are_not_issued_refresh_tokens(db, alice):
+    access = auth.create_access_token({"sub": "alice"}, expires_delta=timedelta(minutes=5))
+    assert rejected(db, access)
+    assert rejected(db, "not a token")
+    # 签名有效但没有记录的刷新令牌（例如伪造的 jti）
+    forged = auth._encode_refresh_token("alice", "unknown", datetime.utcnow() + timedelta(days=1))
+    assert rejected(db, forged)
+
+
+def test_expired_records_are_not_accepted(db, alice):
+    token = auth.create_refresh_token(db, alice.id, "alice")
+    db.query(models.RefreshToken).update({"expires_at": datetime.utcnow() - timedelta(seconds=1)})
+    db.commit()
+    assert rejected(db, token)
+    # 签发新令牌时清理该用户已过期的记录
+    auth.create_refresh_token(db, alice.id, "alice")
+    assert db.query(models.RefreshToken).count() == 1
@@ -0,0 +1,156 @@
+import asyncio
+import json
+import socket
+
+import pytest
+
+from backend import crud, message_bus
+from backend.connection_manager import ConnectionManager
+from backend.message_bus import UnixSocketMessageBus
+from backend.offline_writer import OfflineMessageWriter
+from backend.reliable_delivery import DeliveryBuffer
+
+from conftest import add_users
+from fakes import FakeWebSocket, settle
+
+unix_only = pytest.mark.skipif(not hasattr(socket, "AF_UNIX"), reason="需要 Unix 域套接字")
+
+
+def chat(message_id: str) -> str:
+    return json.dumps({"type": "p2p_message", "id": message_id})
+
+
+def received(websocket):
+    return [(frame["seq"], frame["id"]) for frame in websocket.json_frames()]
+
+
+async def started(**kwargs) -> ConnectionManager:
+    manager = ConnectionManager(**kwargs)
+    await manager.start()
+    return manager
+
+
+def test_seqs_are_numbered_per_recipient():
+    async def scenario():
+        manager = await started()
+        alice, bob = FakeWebSocket(), FakeWebSocket()
+        await manager.connect(alice, 1)
+        await manager.connect(bob, 2)
+        for message_id, user_id in (("a1", 1), ("b1", 2), ("a2", 1), ("b2", 2)):
+            assert await manager.send_personal_message(chat(message_id), user_id, reliable=True)
+        await settle()
+        assert received(alice) == [(1, "a1"), (2, "a2")]
+        assert received(bob) == [(1, "b1"), (2, "b2")]
+        await manager.close()
+
+    asyncio.run(scenario())
+
+
+def test_messages_for_offline_recipients_do_not_use_up_seqs():
+    async def scenario():
+        manager = await started()
+        # 接收者离线：消息走离线存储，不占用序号
+        assert not await manager.send_personal_message(chat("o1"), 2, reliable=True)
+        assert not await manager.send_personal_message(chat("o2"), 2, reliable=True)
+        bob = FakeWebSocket()
+        await manager.connect(bob, 2)
+        assert await manager.send_personal_message(chat("b1"), 2, reliable=True)
+        await settle()
+        assert received(bob) == [(1, "b1")]
+        await manager.close()
+
+    asyncio.run(scenario())
+
+
+def test_resume_resends_only_unacknowledged_messages():
+    async def scenario():
+        manager = await started()
+        phone = FakeWebSocket()
+        session_id, _ = await manager.connect(phone, 1)
+        for n in range(1, 4):
+            await manager.send_personal_message(chat(f"m{n}"), 1, reliable=True)
+        manager.ack(1, 1)
+        await manager.disconnect(1, session_id)
+
+        # 带最后处理的序号重连：2 被视为已确认，只重发 3
+        laptop = FakeWebSocket()
+        session_id, _ = await manager.connect(laptop, 1)
+        assert manager.resume(1, session_id, resume_from=2) == 1
+        await settle()
+        assert received(laptop) == [(3, "m3")]
+        await manager.disconnect(1, session_id)
+
+        # 超过缓冲区中最大序号的 resume_from（例如来自重启前）不作为确认
+        tablet = FakeWebSocket()
+        session_id, _ = await manager.connect(tablet, 1)
+        assert manager.resume(1, session_id, resume_from=1792259219268919) == 1
+        await settle()
+        assert received(tablet) == [(3, "m3")]
+        assert manager.delivery.stats()["acked"] == 2
+        await manager.close()
+
+    asyncio.run(scenario())
+
+
+def test_spilled_messages_keep_their_id(engine):
+    async def scenario():
+        spilled = []
+
+        async def handler(user_id, messages):
+            spilled.extend((user_id, json.loads(message)) for message in messages)
+
+        manager = await started(delivery=DeliveryBuffer(size=1))
+        manager.set_undelivered_handler(handler)
+        await manager.connect(FakeWebSocket(), 1)
+        await manager.send_personal_message(chat("m1"), 1, reliable=True)
+        await manager.send_personal_message(chat("m2"), 1, reliable=True)
+        await settle()
+        assert spilled == [(1, {"seq": 1, "type": "p2p_message", "id": "m1"})]
+        await manager.close()
+
+    asyncio.run(scenario())
+
+
+def test_offline_messages_are_replayed_with_their_id(db):
+    alice, bob = add_users(db, "alice", "bob")
+
+    async def scenario():
+        writer = OfflineMessageWriter(window=0)
+        await writer.write(sender_id=alice, receiver_id=bob, encrypted_content="hi", delivery_id="m1")
+        await writer.write(sender_id=alice, receiver_id=bob, encrypted_content="legacy")
+
+    asyncio.run(scenario())
+    rows = crud.get_unread_messages_page(db, user_id=bob)
+    assert [(content, sender, delivery_id) for _, _, content, _, sender, delivery_id in rows] == [
+        ("hi", "alice", "m1"), ("legacy", "alice", None),
+    ]
+
+
+@unix_only
+def test_devices_on_different_workers_share_the_seq(tmp_path, monkeypatch):
+    monkeypatch.setattr(message_bus, "MESSAGE_BUS_RECONNECT_SECONDS", 0.05)
+
+    async def scenario():
+        path = str(tmp_path / "bus.sock")
+        sender = await started(bus=UnixSocketMessageBus(path))
+        a = await started(bus=UnixSocketMessageBus(path))
+        b = await started(bus=UnixSocketMessageBus(path))
+        phone, laptop = FakeWebSocket(), FakeWebSocket()
+        await a.connect(phone, 7)
+        await b.connect(laptop, 7)
+        await asyncio.sleep(0.05)
+        for n in (1, 2):
+            assert await sender.send_personal_message(chat(f"m{n}"), 7, reliable=True)
+        await settle()
+        assert received(phone) == received(laptop) == [(1, "m1"), (2, "m2")]
+
+        # 托管代理的 worker 退出后，接管的代理从各 worker 报告的序号继续递增
+        await sender.close()
+        await asyncio.sleep(0.3)
+        assert await a.send_personal_message(chat("m3"), 7, reliable=True)
+        await settle()
+        assert received(phone)[-1] == received(laptop)[-1] == (3, "m3")
+        await b.close()
+        await a.close()
+
+    asyncio.run(scenario())
@@ -0,0 +1,55 @@
+from sqlalchemy.orm import sessionmaker
+
+from backend import crud
+from backend.user_search import UserSearchIndex, user_search_index
+
+from conftest import add_users, make_engine
+
+
+def names(results):
+    return [username for _, username in results]
+
+
+def make_index(*usernames):
+    index = UserSearchIndex()
+    index.load(enumerate(usernames, start=1))
+    return index
+
+
+def test_results_are_ranked_exact_prefix_substring():
+    index = make_index("xbob", "Bobby", "bob", "alice", "bobcat", "jimbob")
+    assert names(index.search("BOB")) == ["bob", "Bobby", "bobcat", "jimbob", "xbob"]
+    # 两个字符的查询使用二元组
+    assert names(index.search("li")) == ["alice"]
+    # 一个字符的查询只返回前缀匹配
+    assert names(index.search("b")) == ["bob", "Bobby", "bobcat"]
+    assert index.search("bobx") == []
+
+
+def test_keyset_paging_continues_after_the_cursor():
+    index = make_index("bob", "bob1", "bob2", "abob", "cbob")
+    first = names(index.search("bob", limit=2))
+    second = names(index.search("bob", after=first[-1], limit=2))
+    third = names(index.search("bob", after=second[-1], limit=2))
+    assert first + second + third == ["bob", "bob1", "bob2", "abob", "cbob"]
+
+
+def test_search_picks_up_users_registered_on_another_worker(db, tmp_path):
+    add_users(db, "alice")
+    crud.load_user_search_index(db)
+    assert user_search_index.high_water == 1
+
+    # 另一个 worker 通过自己的连接注册了新用户，本 worker 的索引没有收到 add
+    other_engine = make_engine(tmp_path / "chat.db")
+    other = sessionmaker(bind=other_engine)()
+    try:
+        add_users(other, "alfred", "bob")
+    finally:
+        other.close()
+        other_engine.dispose()
+
+    assert names(crud.search_users_by_username(db, "al")) == ["alfred", "alice"]
+    assert user_search_index.high_water == 3
+    # 已经补进来的用户不会重复加入
+    assert crud.catch_up_user_search_index(db) == 0
+    assert user_search_index.stats()["users"] == 3
@@ -0,0 +1,174 @@
+import json
+import os
+
+import pytest
+
+from backend.ciphertext import CONTENT_KIND_BINARY, CONTENT_KIND_TEXT
+from backend.wire_protocol import (
+    SUBPROTOCOL_DETACHED, SUBPROTOCOL_MSGPACK, DetachedContent, Envelope, FrameError,
+    content_kind_of, content_text, content_value, decode_frame, declare_content, encode, from_bus, msgpack,
+    negotiate, to_bus,
+)
+
+needs_msgpack = pytest.mark.skipif(msgpack is None, reason="需要 msgpack")
+
+
+def text_frame(text: str) -> dict:
+    return {"type": "websocket.receive", "text": text}
+
+
+def binary_frame(data: bytes) -> dict:
+    return {"type": "websocket.receive", "bytes": data}
+
+
+def relayed(content) -> Envelope:
+    return Envelope({"type": "p2p_message", "sender_id": 1, "content": content})
+
+
+def unpack_all(data: bytes) -> list:
+    """二进制帧中依次出现的 MessagePack 对象（分离的消息体时为路由头和消息体）。"""
+    unpacker = msgpack.Unpacker(raw=False)
+    unpacker.feed(data)
+    return list(unpacker)
+
+
+@pytest.mark.parametrize("offered, expected", [
+    (None, None),
+    (["other"], None),
+    ([SUBPROTOCOL_DETACHED], SUBPROTOCOL_DETACHED),
+    ([SUBPROTOCOL_DETACHED, SUBPROTOCOL_MSGPACK], SUBPROTOCOL_MSGPACK if msgpack else SUBPROTOCOL_DETACHED),
+])
+def test_negotiate(offered, expected):
+    assert negotiate(offered) == expected
+
+
+def test_default_protocol_parses_text_frames_as_plain_json():
+    # 第一行本身是合法 JSON 的多行文本，在默认协议中不是分离的消息体
+    with pytest.raises(FrameError):
+        decode_frame(text_frame('{"recipient_username": "bob"}\nhello'), None)
+    pretty = json.dumps({"recipient_username": "bob", "content": "hi"}, indent=2)
+    assert decode_frame(text_frame(pretty), None)["content"] == "hi"
+
+
+def test_detached_protocol_splits_header_and_body():
+    fields = decode_frame(text_frame('{"recipient_username": "bob"}\nline 1\nline 2'), SUBPROTOCOL_DETACHED)
+    assert fields["recipient_username"] == "bob"
+    assert content_value(fields["content"]) == "line 1\nline 2"
+    # 没有换行的帧和格式化输出的 JSON 仍按普通 JSON 解析
+    assert decode_frame(text_frame('{"type": "pong"}'), SUBPROTOCOL_DETACHED) == {"type": "pong"}
+    pretty = json.dumps({"recipient_username": "bob", "content": "hi"}, indent=2)
+    assert decode_frame(text_frame(pretty), SUBPROTOCOL_DETACHED)["content"] == "hi"
+
+
+def test_binary_frame_requires_msgpack_protocol():
+    for protocol in (None, SUBPROTOCOL_DETACHED):
+        with pytest.raises(FrameError):
+            decode_frame(binary_frame(b"\x80"), protocol)
+
+
+def test_detached_body_is_sent_inline_to_sessions_that_did_not_opt_in():
+    fields = decode_frame(text_frame('{"recipient_username": "bob"}\nsecret\ntext'), SUBPROTOCOL_DETACHED)
+    envelope = relayed(fields["content"])
+    assert json.loads(encode(envelope, None)) == {"type": "p2p_message", "sender_id": 1, "content": "secret\ntext"}
+    header, body = encode(envelope, SUBPROTOCOL_DETACHED).split("\n", 1)
+    assert json.loads(header) == {"type": "p2p_message", "sender_id": 1}
+    assert body == "secret\ntext"
+
+
+def test_detached_body_replaces_only_the_leading_header():
+    # 消息体中出现与路由头相同的文本时，只替换帧开头的路由头
+    frame = '{"recipient_username": "bob"}\n{"recipient_username": "bob"}\ntail'
+    fields = decode_frame(text_frame(frame), SUBPROTOCOL_DETACHED)
+    header, body = encode(relayed(fields["content"]), SUBPROTOCOL_DETACHED).split("\n", 1)
+    assert json.loads(header) == {"type": "p2p_message", "sender_id": 1}
+    assert body == '{"recipient_username": "bob"}\ntail'
+
+
+def test_control_messages_are_the_same_for_both_text_protocols():
+    message = '{"type": "ping"}'
+    assert encode(message, None) == encode(message, SUBPROTOCOL_DETACHED) == message
+    envelope = relayed("inline")
+    assert encode(envelope, SUBPROTOCOL_DETACHED) == encode(envelope, None)
+
+
+@needs_msgpack
+def test_binary_ciphertext_reaches_each_protocol_in_its_own_form():
+    ciphertext = os.urandom(64)
+    fields = decode_frame(binary_frame(msgpack.packb({"recipient_username": "bob", "content": ciphertext})), SUBPROTOCOL_MSGPACK)
+    envelope = relayed(fields["content"])
+    assert msgpack.unpackb(encode(envelope, SUBPROTOCOL_MSGPACK))["content"] == ciphertext
+    assert json.loads(encode(envelope, None))["content"] == content_text(ciphertext)
+    # 控制消息转码为 MessagePack
+    assert msgpack.unpackb(encode('{"type": "ping"}', SUBPROTOCOL_MSGPACK)) == {"type": "ping"}
+
+
+@needs_msgpack
+def test_binary_detached_body_is_forwarded_without_decoding():
+    ciphertext = os.urandom(4096)
+    packed_body = msgpack.packb(ciphertext)
+    frame = binary_frame(msgpack.packb({"recipient_username": "bob"}) + packed_body)
+    fields = decode_frame(frame, SUBPROTOCOL_MSGPACK)
+    assert isinstance(fields["content"], DetachedContent)
+    assert content_value(fields["content"]) == ciphertext
+    outgoing = encode(relayed(fields["content"]), SUBPROTOCOL_MSGPACK)
+    assert outgoing.endswith(packed_body)
+    unpacker = msgpack.Unpacker(raw=False)
+    unpacker.feed(outgoing)
+    assert list(unpacker) == [{"type": "p2p_message", "sender_id": 1}, ciphertext]
+    # 文本会话收到 base64 形式的密文：分离协议仍是分离的消息体，默认协议内联
+    assert encode(relayed(fields["content"]), SUBPROTOCOL_DETACHED).split("\n", 1)[1] == content_text(ciphertext)
+    assert json.loads(encode(relayed(fields["content"]), None))["content"] == content_text(ciphertext)
+
+
+@needs_msgpack
+def test_bus_round_trip_inlines_detached_bodies():
+    ciphertext = os.urandom(32)
+    body = DetachedContent(packed=memoryview(msgpack.packb(ciphertext)))
+    restored = from_bus(json.loads(json.dumps(to_bus(relayed(body)))))
+    assert restored.fields["content"] == ciphertext
+    assert from_bus(to_bus('{"type": "ping"}')) == '{"type": "ping"}'
+
+
+def test_declared_binary_json_content_is_decoded_at_ingress():
+    ciphertext = os.urandom(64)
+    fields = decode_frame(text_frame(json.dumps({
+        "recipient_username": "bob", "content_kind": "binary", "content": content_text(ciphertext),
+    })), None)
+    content = declare_content(fields["content"], fields["content_kind"])
+    assert content == ciphertext and content_kind_of(content) == CONTENT_KIND_BINARY
+    # 没有声明时看起来像 base64 的文本也是文本
+    assert declare_content(content_text(ciphertext), None) == content_text(ciphertext)
+    with pytest.raises(FrameError):
+        declare_content("not base64!", CONTENT_KIND_BINARY)
+    with pytest.raises(FrameError):
+        declare_content("x", "hex")
+
+
+def test_declared_binary_detached_body_keeps_its_text_form():
+    ciphertext = os.urandom(64)
+    encoded = content_text(ciphertext)
+    fields = decode_frame(text_frame('{"recipient_username": "bob", "content_kind": "binary"}\n' + encoded), SUBPROTOCOL_DETACHED)
+    content = declare_content(fields["content"], fields["content_kind"])
+    assert content_kind_of(content) == CONTENT_KIND_BINARY
+    # 离线存储得到字节，JSON 出口转发原来的 base64 文本
+    assert content_value(content) == ciphertext
+    assert encode(relayed(content), SUBPROTOCOL_DETACHED).split("\n", 1)[1] == encoded
+    assert json.loads(encode(relayed(content), None))["content"] == encoded
+    with pytest.raises(FrameError):
+        declare_content(decode_frame(text_frame('{"recipient_username": "bob"}\n***'), SUBPROTOCOL_DETACHED)["content"], "binary")
+
+
+@needs_msgpack
+def test_binary_session_receives_declared_binary_as_bin():
+    ciphertext = os.urandom(64)
+    fields = decode_frame(text_frame('{"recipient_username": "bob"}\n' + content_text(ciphertext)), SUBPROTOCOL_DETACHED)
+    content = declare_content(fields["content"], CONTENT_KIND_BINARY)
+    assert unpack_all(encode(relayed(content), SUBPROTOCOL_MSGPACK))[1] == ciphertext
+    # 二进制帧中的 str 消息体声明为 binary 时同样解码
+    frame = binary_frame(msgpack.packb({"recipient_username": "bob"}) + msgpack.packb(content_text(ciphertext)))
+    body = decode_frame(frame, SUBPROTOCOL_MSGPACK)["content"]
+    assert content_kind_of(body) == CONTENT_KIND_TEXT
+    body = declare_content(body, CONTENT_KIND_BINARY)
+    assert content_kind_of(body) == CONTENT_KIND_BINARY
+    assert unpack_all(encode(relayed(body), SUBPROTOCOL_MSGPACK))[1] == ciphertext
+    assert json.loads(encode(relayed(body), None))["content"] == content_text(ciphertext)
@@ -0,0 +1,138 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, NamedTuple, Optional, Tuple
+
+# --- 用户目录缓存配置 ---
+# 缓存的最大条目数，超出后按最近最少使用 (LRU) 淘汰
+USER_DIRECTORY_MAX_ENTRIES = 10000
+# 每个条目的存活时间（秒），过期后下一次访问会重新查询数据库
+USER_DIRECTORY_TTL_SECONDS = 300.0
+
+
+class UserEntry(NamedTuple):
+    """
+    用户目录中缓存的用户信息，只包含热路径需要的字段。
+    不包含 password_hash、public_key 等敏感或较大的字段。
+    """
+    id: int
+    username: str
+
+
+class UserDirectory:
+    """
+    有界的 LRU + TTL 用户目录缓存，支持按用户名和用户 ID 查询。
+    认证依赖和 WebSocket 收件人解析都通过它完成 username <-> id 的转换，
+    命中时不访问数据库。写操作（创建用户、更新用户状态）需要显式调用 invalidate。
+    """
+
+    def __init__(self, max_entries: int = USER_DIRECTORY_MAX_ENTRIES, ttl: float = USER_DIRECTORY_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        # user_id -> (UserEntry, 过期时间)，按访问顺序排列，末尾为最近使用
+        self._by_id: "OrderedDict[int, Tuple[UserEntry, float]]" = OrderedDict()
+        self._id_by_username: Dict[str, int] = {}
+        # 认证依赖运行在线程池中，数据库执行器也有多个线程，因此需要加锁
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_by_username(self, username: str, loader: Callable[[], Optional[UserEntry]]) -> Optional[UserEntry]:
+        """
+        按用户名查询用户；未命中时调用 loader 从数据库加载并写入缓存。
+        """
+        with self._lock:
+            user_id = self._id_by_username.get(username)
+            entry = self._get_locked(user_id) if user_id is not None else None
+            if entry is not None:
+                self.hits += 1
+                return entry
+            self.misses += 1
+        return self._load(loader)
+
+    def peek_by_username(self, username: str) -> Optional[UserEntry]:
+        """
+        只查询缓存，不调用 loader。命中时计入 hits，未命中不计数（调用方随后会走 get_by_username）。
+        """
+        with self._lock:
+            user_id = self._id_by_username.get(username)
+            entry = self._get_locked(user_id) if user_id is not None else None
+            if entry is not None:
+                self.hits += 1
+            return entry
+
+    def get_by_id(self, user_id: int, loader: Callable[[], Optional[UserEntry]]) -> Optional[UserEntry]:
+        """
+        按用户 ID 查询用户；未命中时调用 loader 从数据库加载并写入缓存。
+        """
+        with self._lock:
+            entry = self._get_locked(user_id)
+            if entry is not None:
+                self.hits += 1
+                return entry
+            self.misses += 1
+        return self._load(loader)
+
+    def invalidate(self, user_id: Optional[int] = None, username: Optional[str] = None):
+        """
+        使指定用户的缓存条目失效。可以只给出 user_id 或 username 中的一个。
+        """
+        with self._lock:
+            if user_id is None and username is not None:
+                user_id = self._id_by_username.get(username)
+            if user_id is not None:
+                self._remove_locked(user_id)
+
+    def clear(self):
+        with self._lock:
+            self._by_id.clear()
+            self._id_by_username.clear()
+
+    def stats(self) -> dict:
+        """返回缓存的命中/未命中计数和当前大小。"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._by_id),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
+
+    def _load(self, loader: Callable[[], Optional[UserEntry]]) -> Optional[UserEntry]:
+        entry = loader()
+        if entry is not None:
+            with self._lock:
+                self._put_locked(entry)
+        return entry
+
+    def _get_locked(self, user_id: int) -> Optional[UserEntry]:
+        cached = self._by_id.get(user_id)
+        if cached is None:
+            return None
+        entry, expires_at = cached
+        if expires_at < time.monotonic():
+            self._remove_locked(user_id)
+            return None
+        self._by_id.move_to_end(user_id)
+        return entry
+
+    def _put_locked(self, entry: UserEntry):
+        self._remove_locked(entry.id)
+        self._by_id[entry.id] = (entry, time.monotonic() + self.ttl)
+        self._id_by_username[entry.username] = entry.id
+        while len(self._by_id) > self.max_entries:
+            evicted_id, (evicted, _) = self._by_id.popitem(last=False)
+            if self._id_by_username.get(evicted.username) == evicted_id:
+                del self._id_by_username[evicted.username]
+
+    def _remove_locked(self, user_id: int):
+        cached = self._by_id.pop(user_id, None)
+        if cached is not None:
+            username = cached[0].username
+            if self._id_by_username.get(username) == user_id:
+                del self._id_by_username[username]
+
+
+# 全局单例
+user_directory = UserDirectory()
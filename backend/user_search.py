@@ -0,0 +1,175 @@
+import bisect
+import heapq
+import threading
+from array import array
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# 倒排表元素类型: 用户 ID，有符号 32 位整数
+POSTING_TYPECODE = "i"
+# 单次搜索最多返回的条数
+USER_SEARCH_MAX_LIMIT = 50
+
+# 排名: 完全匹配 < 前缀匹配 < 子串匹配
+RANK_EXACT = 0
+RANK_PREFIX = 1
+RANK_SUBSTRING = 2
+
+
+def _grams(name: str, n: int) -> set:
+    return {name[i:i + n] for i in range(len(name) - n + 1)}
+
+
+class UserSearchIndex:
+    """
+    用户名搜索的内存 n-gram 索引（不区分大小写），替代 username ILIKE '%q%' 的全表扫描。
+    - 长度 >= 3 的查询: 对查询的所有三元组求倒排表交集，再校验子串；
+    - 长度为 2 的查询: 使用二元组倒排表；
+    - 长度为 1 的查询: 只在按用户名排序的数组上二分查找前缀匹配。
+    结果按 (完全匹配, 前缀匹配, 子串匹配) 排名，同一排名内按用户名排序，
+    并以上一页最后一个用户名作为游标做键集分页。
+    每个 worker 各有一份索引：high_water 记录已经从 users 表读到的最大用户 ID，
+    其他 worker 注册的用户通过 catch_up 从数据库补进来（用户只会新增，不会改名或删除）。
+    """
+
+    def __init__(self):
+        # user_id -> 用户名（原始大小写）
+        self._names: Dict[int, str] = {}
+        # 按小写用户名排序的 (小写用户名, user_id)，用于前缀查找
+        self._sorted: List[Tuple[str, int]] = []
+        # n-gram -> 包含它的 user_id 数组（二元组和三元组）
+        self._postings: Dict[str, array] = {}
+        # 已经从数据库读到的最大用户 ID，本 worker 直接 add 的用户不推进它
+        self.high_water = 0
+        # 注册在请求线程/数据库线程中进行，需要加锁
+        self._lock = threading.Lock()
+
+    def load(self, users: Iterable[Tuple[int, str]]):
+        """用所有 (user_id, username) 重建索引。"""
+        names: Dict[int, str] = {}
+        postings: Dict[str, array] = {}
+        for user_id, username in users:
+            names[user_id] = username
+            self._index_name(postings, user_id, username.lower())
+        sorted_names = sorted((username.lower(), user_id) for user_id, username in names.items())
+        with self._lock:
+            self._names = names
+            self._sorted = sorted_names
+            self._postings = postings
+            self.high_water = max(names, default=0)
+
+    @staticmethod
+    def _index_name(postings: Dict[str, array], user_id: int, lowered: str):
+        for gram in _grams(lowered, 2) | _grams(lowered, 3):
+            posting = postings.get(gram)
+            if posting is None:
+                postings[gram] = array(POSTING_TYPECODE, (user_id,))
+            else:
+                posting.append(user_id)
+
+    def add(self, user_id: int, username: str):
+        """新用户注册后加入索引。"""
+        with self._lock:
+            self._add(user_id, username)
+
+    def _add(self, user_id: int, username: str):
+        if user_id in self._names:
+            return
+        lowered = username.lower()
+        self._names[user_id] = username
+        bisect.insort(self._sorted, (lowered, user_id))
+        self._index_name(self._postings, user_id, lowered)
+
+    def catch_up(self, users: Iterable[Tuple[int, str]]) -> int:
+        """
+        加入从数据库读到的、ID 大于 high_water 的用户，并推进 high_water。
+        :return: 新加入索引的用户数
+        """
+        added = 0
+        with self._lock:
+            for user_id, username in users:
+                if user_id not in self._names:
+                    self._add(user_id, username)
+                    added += 1
+                self.high_water = max(self.high_water, user_id)
+        return added
+
+    def search(self, query: str, after: Optional[str] = None, limit: int = 10) -> List[Tuple[int, str]]:
+        """
+        搜索用户名包含 query 的用户（不区分大小写），按排名返回一页结果。
+        :param query: 搜索关键词
+        :param after: 上一页最后一个用户名，为 None 时返回第一页
+        :param limit: 返回的最大条数
+        :return: (user_id, username) 列表
+        """
+        q = query.lower()
+        limit = max(1, min(limit, USER_SEARCH_MAX_LIMIT))
+        if not q:
+            return []
+
+        cursor = None
+        if after is not None:
+            after_lowered = after.lower()
+            cursor = (self._rank(q, after_lowered), after_lowered, after)
+
+        with self._lock:
+            if len(q) == 1:
+                candidates = self._prefix_candidates(q)
+            else:
+                candidates = self._gram_candidates(q)
+            keyed = []
+            for user_id in candidates:
+                username = self._names[user_id]
+                lowered = username.lower()
+                if q not in lowered:
+                    continue
+                key = (self._rank(q, lowered), lowered, username)
+                if cursor is None or key > cursor:
+                    keyed.append((key, user_id))
+
+        # 只需要最前面的一页，用部分排序代替对所有候选的完整排序
+        return [(user_id, key[2]) for key, user_id in heapq.nsmallest(limit, keyed)]
+
+    @staticmethod
+    def _rank(q: str, lowered: str) -> int:
+        if lowered == q:
+            return RANK_EXACT
+        if lowered.startswith(q):
+            return RANK_PREFIX
+        return RANK_SUBSTRING
+
+    def _prefix_candidates(self, q: str) -> List[int]:
+        start = bisect.bisect_left(self._sorted, (q,))
+        end = bisect.bisect_left(self._sorted, (q + "\uffff",))
+        return [user_id for _, user_id in self._sorted[start:end]]
+
+    def _gram_candidates(self, q: str) -> Iterable[int]:
+        n = 3 if len(q) >= 3 else 2
+        postings = []
+        for gram in _grams(q, n):
+            posting = self._postings.get(gram)
+            if posting is None:
+                return ()
+            postings.append(posting)
+        if len(postings) == 1:
+            return postings[0]
+        # 从最短的倒排表开始求交集，候选集合只会越来越小
+        postings.sort(key=len)
+        candidates = set(postings[0])
+        for posting in postings[1:]:
+            candidates.intersection_update(posting)
+            if not candidates:
+                break
+        return candidates
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "users": len(self._names),
+                "high_water": self.high_water,
+                "grams": len(self._postings),
+                "postings": sum(len(posting) for posting in self._postings.values()),
+            }
+
+
+# 全局单例
+user_search_index = UserSearchIndex()
@@ -0,0 +1,350 @@
+import base64
+import json
+from typing import Optional, Union
+
+from .ciphertext import CONTENT_KIND_BINARY, CONTENT_KIND_TEXT, Ciphertext, from_declared, to_text
+
+try:
+    import msgpack
+except ImportError:  # 可选依赖：未安装时服务器只提供 JSON 文本协议
+    msgpack = None
+
+# --- WebSocket 线路协议 ---
+# 客户端在握手时通过 Sec-WebSocket-Protocol 请求二进制协议，服务器支持时在响应中确认；
+# 没有请求或服务器不支持时使用 JSON 文本帧（默认）。
+# securechat.msgpack.v1: 每个二进制帧是一个 MessagePack map，字段与 JSON 协议相同，
+# 但 content 可以直接是二进制 (bin) 的密文，不需要 base64 编码和 JSON 转义。
+SUBPROTOCOL_MSGPACK = "securechat.msgpack.v1"
+# securechat.detached.v1: JSON 文本帧，双向都可以使用下面的"分离的消息体"。
+# 分离的文本帧不是合法的 JSON，只发给在握手时声明能解析它的客户端；默认协议的会话总是收到内联 content 的 JSON。
+SUBPROTOCOL_DETACHED = "securechat.detached.v1"
+
+# --- 分离的消息体 ---
+# 聊天消息的 content 可以不放在字段里，而是跟在路由头之后（"分离的消息体"）:
+#   JSON 文本帧（仅 securechat.detached.v1）: 路由头 JSON + "\n" + content 原文（紧凑的 JSON 中不会出现换行，第一个换行即分隔符）
+#   二进制帧（securechat.msgpack.v1）:        路由头 map + 紧随其后的第二个 MessagePack 对象（str 或 bin）
+# 服务器只解析路由头，content 保持为客户端帧中的原始片段，转发给同协议的接收者时直接拼接到新的路由头之后；
+# 默认 JSON 协议的接收者收到的是 content 内联的普通 JSON。
+# 复制次数: 解码客户端帧时不复制消息体（文本帧保留整个帧，二进制帧保留 memoryview）；ASGI 的 send_text/send_bytes
+# 只接受一个完整的 str/bytes，因此编码出站帧时把新路由头和消息体合成一个对象，复制一次。编码结果按协议缓存在
+# Envelope 中，同一用户的多个设备共享。bench_wire_protocol 中 1 MB/8 MB 密文的峰值内存约为消息体的 1.0 倍。
+# 二进制帧的路由头先从帧开头的这么多字节中解析，避免为了读路由头而复制整个帧
+HEADER_PEEK_BYTES = 512
+
+
+class FrameError(ValueError):
+    """客户端帧无法解码。"""
+
+
+def negotiate(offered) -> Optional[str]:
+    """
+    从客户端请求的子协议列表中选出服务器支持的协议。
+    二进制协议优先，其次是带分离消息体的 JSON 协议。
+    :return: 选中的子协议；使用默认的 JSON 文本协议时为 None
+    """
+    offered = offered or ()
+    if msgpack is not None and SUBPROTOCOL_MSGPACK in offered:
+        return SUBPROTOCOL_MSGPACK
+    if SUBPROTOCOL_DETACHED in offered:
+        return SUBPROTOCOL_DETACHED
+    return None
+
+
+class DetachedContent:
+    """
+    分离传输的 content：保留客户端帧中的原始片段（JSON 帧中的原文，或二进制帧中未解码的 MessagePack 对象），
+    只在需要另一种形式时才转换一次并缓存。
+    来自 JSON 文本帧的消息体不从帧中切出（Python 的 str 切片会复制），而是保留整个帧和消息体的起始位置。
+    声明为二进制密文的文本消息体（见 declare）同时保存解码后的字节：JSON 出口仍转发原来的 base64 文本。
+    """
+    __slots__ = ("_binary_source", "_text", "_packed", "_frame", "_body_start", "_decoded")
+
+    def __init__(
+        self,
+        text: Optional[str] = None,
+        packed: Optional[memoryview] = None,
+        frame: Optional[str] = None,
+        body_start: int = 0,
+    ):
+        # 原始片段来自二进制帧时，文本形式只是转换结果（二进制密文的 base64），不能当作原值
+        self._binary_source = packed is not None
+        self._text = text
+        self._packed = packed
+        self._frame = frame
+        self._body_start = body_start
+        self._decoded: Optional[bytes] = None
+
+    def value(self) -> Union[str, bytes]:
+        """解码后的 content。"""
+        if self._binary_source:
+            return msgpack.unpackb(self._packed, raw=False)
+        if self._decoded is not None:
+            return self._decoded
+        return self.as_text()
+
+    def is_binary(self) -> bool:
+        """content 是否为二进制密文：二进制帧中的 bin 对象（按类型字节判断，不解码），或声明为 binary 的文本。"""
+        if self._binary_source:
+            return self._packed[0] in _MSGPACK_BIN_TYPES
+        return self._decoded is not None
+
+    def declare(self, kind: Optional[str]):
+        """
+        应用客户端声明的 content_kind。文本消息体声明为 binary 时在这里解码并校验一次（结果用于离线存储和二进制会话）；
+        二进制帧中的 bin 本身即是声明，str 消息体按声明解码。
+        :raises ValueError: 声明无效，或 content 不是有效的标准 base64
+        """
+        if self._binary_source:
+            if not self.is_binary():
+                value = from_declared(self.value(), kind)
+                if isinstance(value, bytes):
+                    # 之后按解码后的字节重新打包（bin），JSON 出口重新编码为 base64
+                    self._binary_source = False
+                    self._packed = self._text = None
+                    self._decoded = value
+        else:
+            value = from_declared(self.as_text(), kind)
+            if isinstance(value, bytes):
+                self._decoded = value
+
+    def as_text(self) -> str:
+        if self._text is None:
+            if self._frame is not None:
+                self._text = self._frame[self._body_start:]
+            else:
+                self._text = content_text(self.value())
+        return self._text
+
+    def detached_text(self, header: str) -> str:
+        """
+        securechat.detached.v1 的文本帧：新的路由头 + "\n" + 消息体。
+        消息体来自文本帧时把原帧的路由头替换为新的路由头：原路由头一定在帧的开头，
+        str.replace(..., 1) 只分配结果并复制一次，不需要先切出消息体再拼接。
+        """
+        if self._frame is not None:
+            return self._frame.replace(self._frame[:self._body_start], header + "\n", 1)
+        return header + "\n" + self.as_text()
+
+    def as_packed(self):
+        if self._packed is None:
+            self._packed = msgpack.packb(self.value(), use_bin_type=True)
+        return self._packed
+
+
+Content = Union[str, bytes, DetachedContent]
+
+# MessagePack bin 8/16/32 的类型字节
+_MSGPACK_BIN_TYPES = (0xC4, 0xC5, 0xC6)
+
+
+def decode_frame(frame: dict, protocol: Optional[str]) -> dict:
+    """
+    把一个 ASGI websocket.receive 消息解码为字段字典。
+    帧带有分离的消息体时只解析路由头，消息体作为 DetachedContent 放在 "content" 字段中；
+    文本帧只在协商了 securechat.detached.v1 的会话中按分离的消息体解析，其他会话的文本帧是普通 JSON。
+    :raises FrameError: 帧格式无效，或者在 JSON 会话中收到二进制帧
+    """
+    data = frame.get("bytes")
+    try:
+        if data is not None:
+            if protocol != SUBPROTOCOL_MSGPACK:
+                raise FrameError("未协商二进制协议")
+            fields = _decode_binary(data)
+        elif protocol == SUBPROTOCOL_DETACHED:
+            fields = _decode_detached_text(frame.get("text") or "")
+        else:
+            fields = json.loads(frame.get("text") or "")
+    except ValueError as e:
+        # json.JSONDecodeError 和 msgpack 的各种解码错误都是 ValueError 的子类
+        raise FrameError(str(e)) from e
+    if not isinstance(fields, dict):
+        raise FrameError("消息必须是对象")
+    return fields
+
+
+def _decode_detached_text(text: str):
+    newline = text.find("\n")
+    if newline != -1:
+        try:
+            header = json.loads(text[:newline])
+        except ValueError:
+            # 不是分离的消息体，而是包含换行的普通 JSON（例如格式化输出的 JSON）
+            header = None
+        if isinstance(header, dict):
+            if newline + 1 < len(text):
+                header["content"] = DetachedContent(frame=text, body_start=newline + 1)
+            return header
+    return json.loads(text)
+
+
+def _decode_binary(data: bytes):
+    unpacker = msgpack.Unpacker(raw=False, max_buffer_size=HEADER_PEEK_BYTES)
+    unpacker.feed(memoryview(data)[:HEADER_PEEK_BYTES])
+    try:
+        header = unpacker.unpack()
+    except msgpack.OutOfData:
+        # 路由头超出预读范围，或者 content 内联在 map 中：完整解码
+        try:
+            return msgpack.unpackb(data, raw=False)
+        except msgpack.ExtraData as e:
+            header, body = e.unpacked, memoryview(e.extra)
+    else:
+        offset = unpacker.tell()
+        if offset == len(data):
+            return header
+        body = memoryview(data)[offset:]
+    if isinstance(header, dict):
+        header["content"] = DetachedContent(packed=body)
+    return header
+
+
+def content_text(content: Content) -> str:
+    """content 的文本形式：二进制密文按标准 base64 编码，与 JSON 客户端发送的密文格式一致。"""
+    if isinstance(content, DetachedContent):
+        return content.as_text()
+    return to_text(content)
+
+
+def declare_content(content: Content, kind: Optional[str]) -> Content:
+    """
+    按消息中声明的 content_kind 解释客户端发来的 content（见 ciphertext.py 中的线路约定）：
+    声明为 binary 的文本在入口解码为字节，bin 原样保留；分离的消息体保留原始片段，同时记录解码结果。
+    :raises FrameError: content_kind 未知，或声明为 binary 的 content 不是有效的标准 base64
+    """
+    if kind not in (None, CONTENT_KIND_TEXT, CONTENT_KIND_BINARY):
+        raise FrameError(f"未知的 content_kind: {kind}")
+    try:
+        if isinstance(content, DetachedContent):
+            content.declare(kind)
+            return content
+        if isinstance(content, str):
+            return from_declared(content, kind)
+    except ValueError as e:
+        raise FrameError(f"content 与 content_kind 不符: {e}") from e
+    return content
+
+
+def content_kind_of(content: Content) -> str:
+    """content 的种类，出站消息据此带上 "content_kind": "binary"。"""
+    if isinstance(content, DetachedContent):
+        return CONTENT_KIND_BINARY if content.is_binary() else CONTENT_KIND_TEXT
+    return CONTENT_KIND_BINARY if isinstance(content, bytes) else CONTENT_KIND_TEXT
+
+
+def content_value(content: Content) -> Ciphertext:
+    """content 的值（文本或二进制密文），例如写入离线消息时使用；分离的消息体在这里解码。"""
+    if isinstance(content, DetachedContent):
+        return content.value()
+    return content
+
+
+def _json_default(value):
+    """JSON 编码时把任意位置的二进制密文（例如离线消息批次中每条消息的 content）转为 base64。"""
+    if isinstance(value, bytes):
+        return to_text(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+class Envelope:
+    """
+    一条出站消息的字段字典，content 可以是文本、二进制密文或分离的消息体；字段中其他位置也可以包含二进制密文。
+    按会话的协议编码，并缓存每种协议的编码结果：扇出到同一用户的多个设备时每种协议只编码一次。
+    分离的消息体发给支持分离形式的协议时仍以分离的形式发出：只编码新的路由头，消息体原样拼接在后面
+    （拼接复制一次消息体，见模块开头的说明）。
+    """
+    __slots__ = ("fields", "_text", "_detached_text", "_binary")
+
+    def __init__(self, fields: dict):
+        self.fields = fields
+        self._text: Optional[str] = None
+        self._detached_text: Optional[str] = None
+        self._binary: Optional[bytes] = None
+
+    def text(self) -> str:
+        """普通 JSON 文本形式，content 内联；二进制密文（包括嵌套在列表中的）转为 base64。"""
+        if self._text is None:
+            content = self.fields.get("content")
+            if isinstance(content, DetachedContent):
+                self._text = json.dumps({**self.fields, "content": content.as_text()}, default=_json_default)
+            else:
+                self._text = json.dumps(self.fields, default=_json_default)
+        return self._text
+
+    def detached_text(self) -> str:
+        """securechat.detached.v1 的文本形式：分离的消息体拼接在路由头之后，其他消息与 text() 相同。"""
+        if self._detached_text is None:
+            content = self.fields.get("content")
+            if isinstance(content, DetachedContent):
+                self._detached_text = content.detached_text(json.dumps(self._header(), default=_json_default))
+            elif isinstance(content, bytes):
+                # 二进制密文的 base64 文本同样作为分离的消息体发送，不需要再经过 JSON 转义
+                self._detached_text = json.dumps(self._header(), default=_json_default) + "\n" + to_text(content)
+            else:
+                self._detached_text = self.text()
+        return self._detached_text
+
+    def binary(self) -> bytes:
+        if self._binary is None:
+            content = self.fields.get("content")
+            if isinstance(content, DetachedContent):
+                self._binary = _pack_small(self._header()) + content.as_packed()
+            else:
+                self._binary = msgpack.packb(self.fields, use_bin_type=True)
+        return self._binary
+
+    def _header(self) -> dict:
+        return {key: value for key, value in self.fields.items() if key != "content"}
+
+
+# ConnectionManager 中流转的出站消息：预先编码好的 JSON 文本，或按协议编码的 Envelope
+OutboundMessage = Union[str, Envelope]
+
+
+def encode(message: OutboundMessage, protocol: Optional[str]) -> Union[str, bytes]:
+    """
+    把出站消息编码为会话协议的帧：str 结果作为文本帧发送，bytes 结果作为二进制帧发送。
+    二进制会话收到的 JSON 文本消息（在线状态、回执等控制消息）会被转码。
+    """
+    if isinstance(message, str):
+        if protocol != SUBPROTOCOL_MSGPACK:
+            return message
+        return _pack_small(json.loads(message))
+    if protocol is None:
+        return message.text()
+    if protocol == SUBPROTOCOL_DETACHED:
+        return message.detached_text()
+    return message.binary()
+
+
+def _pack_small(obj) -> bytes:
+    """打包路由头和控制消息：packb 默认预分配 256 KB 的缓冲区，小对象改用按需增长的小缓冲区。"""
+    return msgpack.packb(obj, use_bin_type=True, buf_size=HEADER_PEEK_BYTES)
+
+
+def fields_of(message: OutboundMessage) -> dict:
+    """出站消息的字段字典（例如把未确认的实时消息转存为离线消息时使用）。"""
+    return message.fields if isinstance(message, Envelope) else json.loads(message)
+
+
+def to_bus(message: OutboundMessage) -> dict:
+    """
+    出站消息在跨 worker 总线帧中的表示。总线帧是 JSON，二进制 content 以 base64 传输，
+    分离的消息体在这里被解码为内联的 content（跨 worker 转发无法保留客户端帧中的原始片段）。
+    """
+    if isinstance(message, str):
+        return {"message": message}
+    content = message.fields.get("content")
+    if isinstance(content, DetachedContent):
+        content = content.value()
+        message = Envelope({**message.fields, "content": content})
+    return {"envelope": message.text(), "binary_content": isinstance(content, bytes)}
+
+
+def from_bus(frame: dict) -> OutboundMessage:
+    """to_bus 的逆操作。"""
+    if "envelope" not in frame:
+        return frame["message"]
+    fields = json.loads(frame["envelope"])
+    if frame.get("binary_content"):
+        fields["content"] = base64.b64decode(fields["content"])
+    return Envelope(fields)
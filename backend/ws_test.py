@@ -59,6 +59,9 @@ class WebSocketClient:
                 try:
                     data = json.loads(message)
                     print(f"  [客户端 {self.name}] 📥 收到JSON消息: {data}")
+                    # 实时消息带序号，处理后需要确认，否则服务器会保留并在断线后转存为离线消息
+                    if data.get("type") == "p2p_message" and "seq" in data:
+                        await self.ws.send(json.dumps({"type": "ack", "seq": data["seq"]}))
                     await self.message_queue.put(data)
                 except json.JSONDecodeError:
                     print(f"  [客户端 {self.name}] 📥 收到非JSON文本消息: '{message}'")
@@ -75,6 +78,11 @@ class WebSocketClient:
         await self.ws.send(json.dumps(message))
         print(f"  [客户端 {self.name}] 📤 向 {recipient_username} 发送消息: '{content}'")
 
+    async def ack_offline_batch(self, batch_id: int):
+        """确认一批离线消息已处理。"""
+        if not self.ws: return
+        await self.ws.send(json.dumps({"type": "offline_ack", "batch_id": batch_id}))
+
     async def get_message(self, timeout: float = 3.0) -> Optional[Dict[str, Any]]:
         """从队列中获取一条消息，可设置超时。"""
         try:
@@ -117,10 +125,7 @@ async def main():
     await client_a.connect()
     await client_b.connect()
 
-    # 清理 B 的上线广播消息
-    await client_a.get_message() 
-    await client_b.get_message()
-    await client_b.get_message()
+    # A 和 B 不是好友，因此不会收到彼此的 presence 事件，无需清理
 
     test_msg_content = "你好 B，在线吗？"
     await client_a.send_message(user_b_name, test_msg_content)
@@ -130,6 +135,8 @@ async def main():
     assert received_msg.get("type") == "p2p_message", "❌ 消息类型不正确"
     assert received_msg.get("sender_username") == user_a_name, "❌ 发送者不正确"
     assert received_msg.get("content") == test_msg_content, "❌ 消息内容不匹配"
+    assert received_msg.get("seq") == 1, "❌ B 收到的第一条实时消息序号不是 1"
+    assert received_msg.get("id"), "❌ 实时消息缺少消息 ID"
     print("✅ 在线消息转发成功")
     await client_a.close()
     await client_b.close()
@@ -140,7 +147,6 @@ async def main():
     assert token_a is not None
     client_a = WebSocketClient(token_a, "A")
     await client_a.connect()
-    await client_a.get_message() # 清理上线广播
 
     offline_msg_content = "C 你好，看到请回复。"
     await client_a.send_message(user_c_name, offline_msg_content)
@@ -157,18 +163,22 @@ async def main():
     client_c = WebSocketClient(token_c, "C")
     await client_c.connect()
 
-    # C上线后，可能会收到多条消息（自己的上线广播、其他用户的上下线广播、离线消息）
+    # C上线后，可能会收到多条消息（好友的 presence 事件、离线消息）
     # 我们需要在这些消息中找到我们关心的那条离线消息
+    # 离线消息按批推送，每批需要确认，服务器才会将其标记为已读
     offline_msg_received = None
     for _ in range(5): # 最多检查5条消息
         msg = await client_c.get_message(timeout=2.0)
-        if msg and msg.get("type") == "offline_message":
-            offline_msg_received = msg
+        if msg and msg.get("type") == "offline_batch":
+            await client_c.ack_offline_batch(msg["batch_id"])
+            if msg.get("messages"):
+                offline_msg_received = msg["messages"][0]
             break # 找到后就退出循环
     
     assert offline_msg_received, "❌ C 上线后未收到任何离线消息"
     assert offline_msg_received.get("sender_username") == user_a_name, "❌ 离线消息发送者不正确"
     assert offline_msg_received.get("content") == offline_msg_content, "❌ 离线消息内容不匹配"
+    assert offline_msg_received.get("id"), "❌ 离线消息缺少消息 ID"
     print("✅ C 上线后成功收到离线消息")
     await client_c.close()
     
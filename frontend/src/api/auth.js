@@ -33,7 +33,15 @@ const authApiRequest = async (url, options = {}) => {
   }
   
   try {
-    const response = await fetch(getApiUrl(url), config)
+    let response = await fetch(getApiUrl(url), config)
+    
+    // 访问token过期时，先用刷新token换取新的访问token再重试一次，避免重新输入密码登录
+    if (response.status === 401 && getRefreshToken() && await refreshAccessTokenApi()) {
+      response = await fetch(getApiUrl(url), {
+        ...config,
+        headers: { ...config.headers, ...getAuthHeaders() }
+      })
+    }
     
     // 处理401错误（token过期或无效）
     if (response.status === 401) {
@@ -208,6 +216,48 @@ export const logoutApi = async () => {
   }
 }
 
+// 正在进行的刷新请求：刷新token只能使用一次，同时收到 401 的多个请求共用同一次刷新
+let refreshInFlight = null
+
+/**
+ * 用刷新token换取新的访问token
+ * 不需要密码；刷新token只能使用一次，响应中的新刷新token由 saveToken 保存
+ * @returns {Promise<boolean>} 是否刷新成功
+ */
+export const refreshAccessTokenApi = () => {
+  if (!refreshInFlight) {
+    refreshInFlight = doRefreshAccessToken().finally(() => {
+      refreshInFlight = null
+    })
+  }
+  return refreshInFlight
+}
+
+const doRefreshAccessToken = async () => {
+  const refreshToken = getRefreshToken()
+  if (!refreshToken) {
+    return false
+  }
+  
+  try {
+    const response = await fetch(getApiUrl('/token/refresh'), {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify({ refresh_token: refreshToken })
+    })
+    
+    if (!response.ok) {
+      return false
+    }
+    
+    saveToken(await response.json())
+    return true
+  } catch (error) {
+    console.error('刷新token失败:', error)
+    return false
+  }
+}
+
 /**
  * 验证token有效性
  * @returns {Promise<Object>} 验证结果
@@ -255,10 +305,14 @@ export const validateTokenApi = async () => {
  * @param {Object} tokenData - token数据
  * @param {string} tokenData.access_token - 访问token
  * @param {string} tokenData.token_type - token类型
+ * @param {string} [tokenData.refresh_token] - 刷新token（登录和刷新时返回）
  */
 export const saveToken = (tokenData) => {
   localStorage.setItem('access_token', tokenData.access_token)
   localStorage.setItem('token_type', tokenData.token_type || 'Bearer')
+  if (tokenData.refresh_token) {
+    localStorage.setItem('refresh_token', tokenData.refresh_token)
+  }
   
   // 保存token获取时间，用于过期检查
   localStorage.setItem('token_timestamp', Date.now().toString())
@@ -271,6 +325,7 @@ export const removeToken = () => {
   localStorage.removeItem('access_token')
   localStorage.removeItem('token_type')
   localStorage.removeItem('token_timestamp')
+  localStorage.removeItem('refresh_token')
 }
 
 /**
@@ -281,6 +336,14 @@ export const getToken = () => {
   return localStorage.getItem('access_token')
 }
 
+/**
+ * 获取刷新token
+ * @returns {string|null} 刷新token
+ */
+export const getRefreshToken = () => {
+  return localStorage.getItem('refresh_token')
+}
+
 /**
  * 获取token类型
  * @returns {string} token类型
@@ -1,5 +1,7 @@
 import { getFullApiUrl, getAuthHeadersForExport } from '@/api/auth.js'
 import { getUserInfo } from '@/api/auth.js' 
+import { encodeChatFrame, decodeFrame, WS_SUBPROTOCOLS } from '@/utils/frame.js'
+import { SeenMessageIds } from '@/utils/messageIds.js'
 const getAuthHeaders = () => {
   const token = localStorage.getItem('access_token')
   const tokenType = localStorage.getItem('token_type') || 'Bearer'
@@ -183,6 +185,75 @@ const getFriendsOnlineStatus = async () => {
   }
 }
 
+/**
+ * 获取与指定用户之间的会话历史（按时间从新到旧）
+ * @param {string} username - 对方用户名
+ * @param {Object} options - before: 上一页最早一条消息的 id；limit: 每页条数（最多 100）
+ * @returns {Promise<Object>} data 为消息列表，hasMore 表示是否还有更早的消息
+ */
+const getConversationHistory = async (username, options = {}) => {
+  try {
+    const { before = null, limit = 50 } = options
+    const params = new URLSearchParams({ limit: String(limit) })
+    if (before !== null) {
+      params.set('before', String(before))
+    }
+    const response = await chatApiRequest(`/messages/with/${encodeURIComponent(username)}?${params}`)
+    
+    if (!response.ok) {
+      const errorText = await response.text()
+      throw new Error(`获取会话历史失败: ${errorText}`)
+    }
+    
+    const data = await response.json()
+    return {
+      success: true,
+      data: data,
+      hasMore: data.length === limit,
+      // 下一页的游标：本页最早一条消息的 id
+      nextBefore: data.length > 0 ? data[data.length - 1].id : before
+    }
+  } catch (error) {
+    return {
+      success: false,
+      message: error.message || '获取会话历史失败'
+    }
+  }
+}
+
+/**
+ * 获取会话列表：每个会话的对方、最后一条消息和未读数（按最后一条消息从新到旧），不会把消息标记为已读
+ * @param {Object} options - before: 上一页最后一个会话的 last_message_id；limit: 每页条数（最多 100）
+ * @returns {Promise<Object>} 会话摘要列表
+ */
+const getConversations = async (options = {}) => {
+  try {
+    const { before = null, limit = 50 } = options
+    const params = new URLSearchParams({ limit: String(limit) })
+    if (before !== null) {
+      params.set('before', String(before))
+    }
+    const response = await chatApiRequest(`/me/conversations?${params}`)
+    
+    if (!response.ok) {
+      const errorText = await response.text()
+      throw new Error(`获取会话列表失败: ${errorText}`)
+    }
+    
+    const data = await response.json()
+    return {
+      success: true,
+      data: data,
+      hasMore: data.length === limit
+    }
+  } catch (error) {
+    return {
+      success: false,
+      message: error.message || '获取会话列表失败'
+    }
+  }
+}
+
 /**
  * 🆕 获取用户连接信息（用于P2P连接）
  * @param {string} username - 用户名
@@ -236,13 +307,18 @@ export class EnhancedWebSocketManager {
     this.heartbeatIntervalTime = 30000 // 30秒心跳
     this.usernameToIdMap = new Map()
     this.idToUsernameMap = new Map()
+    // 最后处理的实时消息序号，重连时作为 resume_from，服务器只重发其后未确认的消息
+    this.lastSeq = 0
+    // 最近处理过的消息 ID，用于丢弃续传和离线推送中重复收到的消息
+    this.seenMessageIds = new SeenMessageIds()
   }
 
   connect(token) {
     return new Promise((resolve, reject) => {
       try {
-        const wsUrl = `ws://127.0.0.1:8080/ws?token=${token}`
-        this.ws = new WebSocket(wsUrl)
+        const resume = this.lastSeq ? `&resume_from=${this.lastSeq}` : ''
+        const wsUrl = `ws://127.0.0.1:8080/ws?token=${token}${resume}`
+        this.ws = new WebSocket(wsUrl, WS_SUBPROTOCOLS)
         this.isManualClose = false
 
         this.ws.onopen = () => {
@@ -255,7 +331,7 @@ export class EnhancedWebSocketManager {
 
         this.ws.onmessage = (event) => {
           try {
-            const data = JSON.parse(event.data)
+            const data = decodeFrame(event.data, this.ws.protocol)
             this.handleIncomingMessage(data)
           } catch (error) {
             // 🆕 处理非JSON消息（如系统广播）
@@ -298,14 +374,38 @@ export class EnhancedWebSocketManager {
     console.log('📨 收到WebSocket消息:', data)
     
     switch (data.type) {
+      case 'ping':
+        // 服务器存活检测，需要回复 pong，否则连接会被服务器关闭
+        if (this.ws && this.ws.readyState === WebSocket.OPEN) {
+          this.ws.send(JSON.stringify({ type: 'pong' }))
+        }
+        break
+      
+      case 'offline_batch':
+        // 离线消息按批推送，处理完整批后需要确认，服务器才会标记为已读并推送下一批
+        this.handleOfflineBatch(data)
+        break
+      
       case 'offline_message':
         // 🆕 处理离线消息推送
         this.handleOfflineMessage(data)
         break
       
       case 'p2p_message':
-        // 🆕 处理实时P2P消息
-        this.handleP2PMessage(data)
+        // 🆕 处理实时P2P消息（确认序号，跳过按 id 判断为重复的消息）
+        if (this.acknowledge(data)) {
+          this.handleP2PMessage(data)
+        }
+        break
+      
+      case 'friend_request':
+      case 'contact_update':
+        // 好友请求/好友关系变化，字段与 GET /me/sync 的 request/contact 变更相同
+        this.notifyMessageHandlers({
+          type: 'contact_event',
+          event: data,
+          timestamp: Date.now()
+        })
         break
       
       case 'system_broadcast':
@@ -341,6 +441,35 @@ export class EnhancedWebSocketManager {
     }
   }
 
+  /**
+   * 确认带序号的实时消息（累积确认），并按消息 id 去重
+   * @param {Object} data - 实时消息
+   * @returns {boolean} 是否为新消息（重连续传时重复收到的消息返回 false，仍然需要确认）
+   */
+  acknowledge(data) {
+    if (data.seq != null) {
+      this.lastSeq = data.seq
+      if (this.ws && this.ws.readyState === WebSocket.OPEN) {
+        this.ws.send(JSON.stringify({ type: 'ack', seq: data.seq }))
+      }
+    }
+    return this.seenMessageIds.add(data.id)
+  }
+
+  /**
+   * 处理一批离线消息并向服务器确认
+   * @param {Object} data - { batch_id, messages, has_more }
+   */
+  handleOfflineBatch(data) {
+    // 未确认而被转存的实时消息可能已经在线收到过，按 id 跳过
+    (data.messages || [])
+      .filter(message => this.seenMessageIds.add(message.id))
+      .forEach(message => this.handleOfflineMessage(message))
+    if (this.ws && this.ws.readyState === WebSocket.OPEN) {
+      this.ws.send(JSON.stringify({ type: 'offline_ack', batch_id: data.batch_id }))
+    }
+  }
+
   /**
    * 🆕 处理离线消息
    * @param {Object} data - 离线消息数据
@@ -397,7 +526,8 @@ export class EnhancedWebSocketManager {
       }
       
       try {
-        this.ws.send(JSON.stringify(message))
+        // 协商了分离消息体的连接上，消息内容跟在路由头之后发送，服务器只解析路由头
+        this.ws.send(encodeChatFrame(recipientUsername, content, this.ws.protocol))
         console.log('📤 发送消息:', message)
         return true
       } catch (error) {
@@ -424,10 +554,10 @@ export class EnhancedWebSocketManager {
   }
 
   /**
-   * 🆕 开始心跳 - 暂时移除，后端会自动检测连接状态
+   * 🆕 开始心跳 - 由服务器发起 ping，客户端在 handleIncomingMessage 中回复 pong
    */
   startHeartbeat() {
-    // 后端通过连接状态自动管理，前端暂不需要主动心跳
+    // 后端通过 ping/pong 检测连接存活，前端不需要主动心跳
     console.log('WebSocket心跳由后端管理')
   }
 
@@ -469,6 +599,8 @@ export class EnhancedWebSocketManager {
       this.ws.close()
       this.ws = null
     }
+    this.lastSeq = 0
+    this.seenMessageIds = new SeenMessageIds()
   }
 
   // 原有方法保持不变
@@ -629,6 +761,10 @@ class WebSocketManager {
     this.connectionListeners = new Set()
     this.chatMessages = new Map() // 存储聊天记录 username -> messages[]
     this.currentUser = null
+    // 最后处理的实时消息序号，重连时作为 resume_from，服务器只重发其后未确认的消息
+    this.lastSeq = 0
+    // 最近处理过的消息 ID，用于丢弃续传和离线推送中重复收到的消息
+    this.seenMessageIds = new SeenMessageIds()
     
     // 用户信息映射
     this.friendsMap = new Map() // username -> friend info
@@ -679,10 +815,11 @@ class WebSocketManager {
 
     this.currentUser = userInfo
     // 直接使用固定地址
-    const wsUrl = `ws://127.0.0.1:8080/ws?token=${token}`
+    const resume = this.lastSeq ? `&resume_from=${this.lastSeq}` : ''
+    const wsUrl = `ws://127.0.0.1:8080/ws?token=${token}${resume}`
     
     try {
-      this.socket = new WebSocket(wsUrl)
+      this.socket = new WebSocket(wsUrl, WS_SUBPROTOCOLS)
       this.setupEventListeners()
       return true
     } catch (error) {
@@ -722,7 +859,7 @@ class WebSocketManager {
     try {
       let message
       try {
-        message = JSON.parse(data)
+        message = decodeFrame(data, this.socket.protocol)
       } catch {
         console.log('📢 系统消息:', data)
         this.notifyListeners({ 
@@ -736,11 +873,27 @@ class WebSocketManager {
       console.log('📨 收到WebSocket消息:', message)
       
       switch (message.type) {
+        case 'ping':
+          // 服务器存活检测，需要回复 pong，否则连接会被服务器关闭
+          this.socket.send(JSON.stringify({ type: 'pong' }))
+          break
+        case 'offline_batch':
+          this.handleOfflineBatch(message)
+          break
         case 'offline_message':
           this.handleOfflineMessage(message)
           break
         case 'p2p_message':
-          this.handleP2PMessage(message)
+          if (this.acknowledge(message)) {
+            this.handleP2PMessage(message)
+          }
+          break
+        case 'presence':
+          this.handlePresenceMessage(message)
+          break
+        case 'friend_request':
+        case 'contact_update':
+          this.handleContactEvent(message)
           break
         default:
           if (message.status) {
@@ -754,6 +907,28 @@ class WebSocketManager {
     }
   }
 
+  // 确认带序号的实时消息（累积确认），并按消息 id 去重；重复收到的消息返回 false
+  acknowledge(message) {
+    if (message.seq != null) {
+      this.lastSeq = message.seq
+      if (this.isConnected && this.socket) {
+        this.socket.send(JSON.stringify({ type: 'ack', seq: message.seq }))
+      }
+    }
+    return this.seenMessageIds.add(message.id)
+  }
+
+  // 离线消息按批推送，处理完整批后确认，服务器才会标记为已读并推送下一批
+  handleOfflineBatch(batch) {
+    // 未确认而被转存的实时消息可能已经在线收到过，按 id 跳过
+    (batch.messages || [])
+      .filter(message => this.seenMessageIds.add(message.id))
+      .forEach(message => this.handleOfflineMessage(message))
+    if (this.isConnected && this.socket) {
+      this.socket.send(JSON.stringify({ type: 'offline_ack', batch_id: batch.batch_id }))
+    }
+  }
+
   handleOfflineMessage(message) {
     console.log('📬 离线消息:', message)
     const senderId = this.getUserIdByUsername(message.sender_username)
@@ -810,6 +985,26 @@ class WebSocketManager {
     })
   }
 
+  // 好友上下线事件，users 为 [{ user_id, username, is_online }]
+  handlePresenceMessage(message) {
+    console.log('👥 好友状态变化:', message.users)
+    this.notifyListeners({ 
+      type: 'presence', 
+      users: message.users || [], 
+      timestamp: message.timestamp 
+    })
+  }
+
+  // 好友请求/好友关系变化事件，字段与 GET /me/sync 的 request/contact 变更相同
+  handleContactEvent(message) {
+    console.log('👥 好友关系变化:', message)
+    this.notifyListeners({ 
+      type: 'contact_event', 
+      event: message, 
+      timestamp: message.timestamp 
+    })
+  }
+
   handleStatusMessage(message) {
     console.log('ℹ️ 状态消息:', message.status)
     this.notifyListeners({ type: 'status', content: message.status })
@@ -845,7 +1040,8 @@ class WebSocketManager {
     }
 
     try {
-      this.socket.send(JSON.stringify(message))
+      // 协商了分离消息体的连接上，消息内容跟在路由头之后发送，服务器只解析路由头
+      this.socket.send(encodeChatFrame(recipientUsername, content, this.socket.protocol))
       console.log('📤 发送消息:', message)
       
       // 创建本地消息记录
@@ -959,6 +1155,8 @@ class WebSocketManager {
     }
     this.isConnected = false
     this.currentUser = null
+    this.lastSeq = 0
+    this.seenMessageIds = new SeenMessageIds()
   }
 
   // 获取连接状态
@@ -993,6 +1191,8 @@ export {
   updateConnectionInfo,
   getFriendsOnlineStatus,
   getUserConnectionInfo,
+  getConversationHistory,
+  getConversations,
 }
 
 // 🆕 命名导出WebSocket管理器
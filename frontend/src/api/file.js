@@ -1,27 +1,97 @@
 import wsManagerInstance from '@/api/chat.js';
+import { getAuthHeadersForExport, getFullApiUrl } from './auth.js';
+
+// 未完成上传的附件 ID 按文件记录在 localStorage 中，发送失败后重新选择同一个文件时从断点继续上传
+const UPLOAD_STORAGE_PREFIX = 'attachment_upload_';
+
+const attachmentRequest = async (url, options = {}) => {
+  const response = await fetch(getFullApiUrl(url), {
+    ...options,
+    headers: {
+      ...getAuthHeadersForExport(),
+      ...options.headers
+    }
+  });
+  if (response.status === 401) {
+    throw new Error('认证失败，请重新登录');
+  }
+  return response;
+};
 
 export class FileTransferAPI {
-  static async sendFile(file, recipientUsername) {
+  // 分块上传文件，聊天消息中只携带附件 ID
+  static async sendFile(file, recipientUsername, onProgress) {
     try {
-      const fileData = await this.fileToBase64(file);
-      
+      const attachmentId = await this.uploadFile(file, recipientUsername, onProgress);
+
       // 改进：使用特殊的消息格式标识
       const fileMessage = `[FILE]${JSON.stringify({
         type: 'file',
         fileName: file.name,
         fileSize: file.size,
         fileType: file.type,
-        fileData: fileData
+        attachmentId: attachmentId
       })}`;
 
       const success = wsManagerInstance.sendMessage(recipientUsername, fileMessage);
-      return { success, fileName: file.name };
+      return { success, fileName: file.name, attachmentId };
     } catch (error) {
       console.error('文件发送失败:', error);
       return { success: false, error: error.message };
     }
   }
 
+  // 上传文件内容，返回附件 ID；同一个文件发给同一个人的上传未完成时从服务器记录的偏移继续。
+  // 只有上传者和 recipientUsername 可以下载该附件
+  static async uploadFile(file, recipientUsername, onProgress) {
+    const storageKey = `${UPLOAD_STORAGE_PREFIX}${recipientUsername}_${file.name}_${file.size}_${file.lastModified}`;
+    let upload = await this.resumeUpload(localStorage.getItem(storageKey));
+    if (!upload) {
+      const response = await attachmentRequest('/attachments/', {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ size: file.size, recipient_username: recipientUsername })
+      });
+      if (!response.ok) {
+        throw new Error(`创建上传失败: ${response.status}`);
+      }
+      upload = await response.json();
+      localStorage.setItem(storageKey, upload.id);
+    }
+
+    let offset = upload.offset;
+    while (!upload.complete) {
+      const chunk = file.slice(offset, offset + upload.chunk_size);
+      const response = await attachmentRequest(`/attachments/${upload.id}/upload?offset=${offset}`, {
+        method: 'PUT',
+        headers: { 'Content-Type': 'application/octet-stream' },
+        body: chunk
+      });
+      if (response.status === 409) {
+        // 上一个分块的响应丢失，服务器实际已写入：从服务器返回的偏移继续
+        offset = (await response.json()).offset;
+        continue;
+      }
+      if (!response.ok) {
+        throw new Error(`上传分块失败: ${response.status}`);
+      }
+      upload = await response.json();
+      offset = upload.offset;
+      if (onProgress) {
+        onProgress(offset / file.size);
+      }
+    }
+    localStorage.removeItem(storageKey);
+    return upload.id;
+  }
+
+  // 查询未完成上传的进度；上传不存在或已过期时返回 null
+  static async resumeUpload(attachmentId) {
+    if (!attachmentId) return null;
+    const response = await attachmentRequest(`/attachments/${attachmentId}/upload`);
+    return response.ok ? await response.json() : null;
+  }
+
   static async fileToBase64(file) {
     return new Promise((resolve, reject) => {
       const reader = new FileReader();
@@ -31,13 +101,26 @@ export class FileTransferAPI {
     });
   }
 
-  static downloadFile(fileData, fileName) {
+  // 下载文件：新格式的文件消息按附件 ID 从服务器获取，旧格式的消息直接使用内嵌的 fileData
+  static async downloadFile(fileInfo, fileName) {
+    let href = fileInfo.fileData;
+    if (fileInfo.attachmentId) {
+      const response = await attachmentRequest(`/attachments/${fileInfo.attachmentId}`);
+      if (!response.ok) {
+        throw new Error(`下载失败: ${response.status}`);
+      }
+      const blob = await response.blob();
+      href = URL.createObjectURL(fileInfo.fileType ? new Blob([blob], { type: fileInfo.fileType }) : blob);
+    }
     const link = document.createElement('a');
-    link.href = fileData;
+    link.href = href;
     link.download = fileName;
     document.body.appendChild(link);
     link.click();
     document.body.removeChild(link);
+    if (fileInfo.attachmentId) {
+      URL.revokeObjectURL(href);
+    }
   }
 
   // 检查是否是文件消息
@@ -55,4 +138,4 @@ export class FileTransferAPI {
       return null;
     }
   }
-}
\ No newline at end of file
+}
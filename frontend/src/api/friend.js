@@ -265,6 +265,36 @@ export const getFriendsOnlineStatus = async () => {
   return await getOnlineFriendsInfo()
 }
 
+// 增量同步好友、好友请求和好友在线状态
+// since 为上一次同步返回的 version；不传时返回全量快照
+// 返回 { success, notModified } 或 { success, data: { version, full, changes, contacts, pending, online } }
+export const syncContacts = async (since = null) => {
+  try {
+    const url = since === null ? '/me/sync' : `/me/sync?since=${since}`
+    const response = await friendApiRequest(url)
+
+    if (response.status === 304) {
+      return { success: true, notModified: true }
+    }
+
+    if (!response.ok) {
+      const errorText = await response.text()
+      throw new Error(`同步好友状态失败: ${errorText}`)
+    }
+
+    return {
+      success: true,
+      notModified: false,
+      data: await response.json()
+    }
+  } catch (error) {
+    return {
+      success: false,
+      message: error.message || '同步好友状态失败'
+    }
+  }
+}
+
 export const searchUsers = async (query) => {
   try {
     const response = await friendApiRequest(`/users/search/${encodeURIComponent(query)}`)
@@ -545,6 +575,7 @@ export const friendManager = new FriendManager()
 
 export default {
   getContacts,
+  syncContacts,
   getPendingRequests,
   addContact,
   acceptFriendRequest,
@@ -0,0 +1,36 @@
+// WebSocket 文本帧的"分离消息体"格式：路由头 JSON + '\n' + content 原文。
+// 服务器只解析路由头，content（例如大的文件消息）原样转发，不再被解析和重新转义。
+// 紧凑的 JSON 中不会出现换行，第一个换行即分隔符。
+// 只有握手时协商了 DETACHED_SUBPROTOCOL 的连接才使用这种格式，否则双向都是普通 JSON。
+
+export const DETACHED_SUBPROTOCOL = 'securechat.detached.v1'
+
+// 创建 WebSocket 连接时请求的子协议
+export const WS_SUBPROTOCOLS = [DETACHED_SUBPROTOCOL]
+
+// content 的种类（见 API_DOCS 4.2.2）：二进制密文以标准 base64 文本发送时声明为 binary，服务器以原始字节保存
+export const CONTENT_KIND_TEXT = 'text'
+export const CONTENT_KIND_BINARY = 'binary'
+
+// 编码一条聊天消息；protocol 为连接协商的子协议 (socket.protocol)，contentKind 省略时为文本
+export function encodeChatFrame(recipientUsername, content, protocol, contentKind = CONTENT_KIND_TEXT) {
+  const header = { recipient_username: recipientUsername }
+  if (contentKind !== CONTENT_KIND_TEXT) {
+    header.content_kind = contentKind
+  }
+  if (protocol !== DETACHED_SUBPROTOCOL) {
+    return JSON.stringify({ ...header, content })
+  }
+  return `${JSON.stringify(header)}\n${content}`
+}
+
+// 解码服务器发来的文本帧，分离的消息体放回 content 字段；不是 JSON 时抛出异常
+export function decodeFrame(data, protocol) {
+  const newline = protocol === DETACHED_SUBPROTOCOL ? data.indexOf('\n') : -1
+  if (newline === -1) {
+    return JSON.parse(data)
+  }
+  const header = JSON.parse(data.slice(0, newline))
+  header.content = data.slice(newline + 1)
+  return header
+}
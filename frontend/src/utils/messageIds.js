@@ -0,0 +1,30 @@
+// 记住最近处理过的消息 ID 的个数，超出后忘记最早的
+export const SEEN_MESSAGE_IDS_LIMIT = 1000
+
+/**
+ * 最近处理过的消息 ID（有界集合）。
+ * 实时消息在重连续传时可能重复收到，未确认而被服务器转存的消息还会再经过离线推送收到一次，
+ * 两次的 id 相同，据此丢弃重复的消息。
+ */
+export class SeenMessageIds {
+  constructor(limit = SEEN_MESSAGE_IDS_LIMIT) {
+    this.limit = limit
+    this.ids = new Set()
+  }
+
+  /**
+   * 记录一条消息的 ID
+   * @param {string|null|undefined} id - 消息 ID（旧版本服务器保存的离线消息没有 ID）
+   * @returns {boolean} 是否为第一次收到（没有 ID 的消息总是返回 true）
+   */
+  add(id) {
+    if (id == null) return true
+    if (this.ids.has(id)) return false
+    this.ids.add(id)
+    if (this.ids.size > this.limit) {
+      // Set 按插入顺序迭代，第一个即最早记录的 ID
+      this.ids.delete(this.ids.values().next().value)
+    }
+    return true
+  }
+}
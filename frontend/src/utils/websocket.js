@@ -1,4 +1,6 @@
 import { getUserInfo, getFullApiUrl } from '@/api/auth.js'
+import { encodeChatFrame, decodeFrame, WS_SUBPROTOCOLS } from '@/utils/frame.js'
+import { SeenMessageIds } from '@/utils/messageIds.js'
 
 class WebSocketManager {
   constructor() {
@@ -11,6 +13,10 @@ class WebSocketManager {
     this.connectionListeners = new Set()
     this.chatMessages = new Map() // 存储聊天记录 username -> messages[]
     this.currentUser = null
+    // 最后处理的实时消息序号，重连时作为 resume_from，服务器只重发其后未确认的消息
+    this.lastSeq = 0
+    // 最近处理过的消息 ID，用于丢弃续传和离线推送中重复收到的消息
+    this.seenMessageIds = new SeenMessageIds()
     
     // 🆕 用户信息映射
     this.friendsMap = new Map() // username -> friend info
@@ -62,10 +68,11 @@ class WebSocketManager {
     this.currentUser = userInfo
     // 🆕 使用动态API地址
     const apiBaseUrl = getFullApiUrl('').replace('http', 'ws')
-    const wsUrl = `${apiBaseUrl}/ws?token=${token}`
+    const resume = this.lastSeq ? `&resume_from=${this.lastSeq}` : ''
+    const wsUrl = `${apiBaseUrl}/ws?token=${token}${resume}`
     
     try {
-      this.socket = new WebSocket(wsUrl)
+      this.socket = new WebSocket(wsUrl, WS_SUBPROTOCOLS)
       this.setupEventListeners()
       return true
     } catch (error) {
@@ -105,7 +112,7 @@ class WebSocketManager {
     try {
       let message
       try {
-        message = JSON.parse(data)
+        message = decodeFrame(data, this.socket.protocol)
       } catch {
         console.log('📢 系统消息:', data)
         this.notifyListeners({ 
@@ -119,11 +126,27 @@ class WebSocketManager {
       console.log('📨 收到WebSocket消息:', message)
       
       switch (message.type) {
+        case 'ping':
+          // 服务器存活检测，需要回复 pong，否则连接会被服务器关闭
+          this.socket.send(JSON.stringify({ type: 'pong' }))
+          break
+        case 'offline_batch':
+          this.handleOfflineBatch(message)
+          break
         case 'offline_message':
           this.handleOfflineMessage(message)
           break
         case 'p2p_message':
-          this.handleP2PMessage(message)
+          if (this.acknowledge(message)) {
+            this.handleP2PMessage(message)
+          }
+          break
+        case 'presence':
+          this.handlePresenceMessage(message)
+          break
+        case 'friend_request':
+        case 'contact_update':
+          this.handleContactEvent(message)
           break
         default:
           if (message.status) {
@@ -137,6 +160,28 @@ class WebSocketManager {
     }
   }
 
+  // 确认带序号的实时消息（累积确认），并按消息 id 去重；重复收到的消息返回 false
+  acknowledge(message) {
+    if (message.seq != null) {
+      this.lastSeq = message.seq
+      if (this.isConnected && this.socket) {
+        this.socket.send(JSON.stringify({ type: 'ack', seq: message.seq }))
+      }
+    }
+    return this.seenMessageIds.add(message.id)
+  }
+
+  // 离线消息按批推送，处理完整批后确认，服务器才会标记为已读并推送下一批
+  handleOfflineBatch(batch) {
+    // 未确认而被转存的实时消息可能已经在线收到过，按 id 跳过
+    (batch.messages || [])
+      .filter(message => this.seenMessageIds.add(message.id))
+      .forEach(message => this.handleOfflineMessage(message))
+    if (this.isConnected && this.socket) {
+      this.socket.send(JSON.stringify({ type: 'offline_ack', batch_id: batch.batch_id }))
+    }
+  }
+
   handleOfflineMessage(message) {
     console.log('📬 离线消息:', message)
     const senderId = this.getUserIdByUsername(message.sender_username)
@@ -193,6 +238,26 @@ class WebSocketManager {
     })
   }
 
+  // 好友上下线事件，users 为 [{ user_id, username, is_online }]
+  handlePresenceMessage(message) {
+    console.log('👥 好友状态变化:', message.users)
+    this.notifyListeners({ 
+      type: 'presence', 
+      users: message.users || [], 
+      timestamp: message.timestamp 
+    })
+  }
+
+  // 好友请求/好友关系变化事件，字段与 GET /me/sync 的 request/contact 变更相同
+  handleContactEvent(message) {
+    console.log('👥 好友关系变化:', message)
+    this.notifyListeners({ 
+      type: 'contact_event', 
+      event: message, 
+      timestamp: message.timestamp 
+    })
+  }
+
   handleStatusMessage(message) {
     console.log('ℹ️ 状态消息:', message.status)
     this.notifyListeners({ type: 'status', content: message.status })
@@ -228,7 +293,8 @@ class WebSocketManager {
     }
 
     try {
-      this.socket.send(JSON.stringify(message))
+      // 协商了分离消息体的连接上，消息内容跟在路由头之后发送，服务器只解析路由头
+      this.socket.send(encodeChatFrame(recipientUsername, content, this.socket.protocol))
       console.log('📤 发送消息:', message)
       
       // 🆕 创建本地消息记录
@@ -368,6 +434,8 @@ class WebSocketManager {
     }
     this.isConnected = false
     this.currentUser = null
+    this.lastSeq = 0
+    this.seenMessageIds = new SeenMessageIds()
   }
 
   clearChatHistory(username) {